@@ -17,30 +17,21 @@ RESULTS_DIR_BASENAME=$2     # Follows the format: results-mix-snrXX-lvXX-startXX
 OUTPUT_DIR=$3
 
 instruments="bass drums other vocals"   # The variable directory name
-decode_type="char word"
-test_set="eval dev"
 
 mkdir -p $OUTPUT_DIR
 
-for instr in $instruments
-do
-
-    for type in $decode_type
-    do
-        for ts in $test_set
-        do
-            results_dir=$DATASET_DIR/$instr/$RESULTS_DIR_BASENAME   # Support wildcards
-            results_dir_basename=$(basename $results_dir)
-            echo $results_dir
-            python3 sort_results.py $results_dir $type $ts \
-                --output-dir $OUTPUT_DIR/sorted-$type-$ts-${instr}__$results_dir_basename
-        done
-    done
-
-
-#   python3 gen_mixes.py --sph2pipe ../kaldi/tools/sph2pipe_v2.5/ --outputFmt mp3 \
+# Error rates (with 95% bootstrap CIs) of every trial under DATASET_DIR in one pass, grouped by condition and by
+# category, and the sorted results of every $RESULTS_DIR_BASENAME trial (wildcards are supported) from the same parse
+python3 aggregate_results.py $DATASET_DIR --layout instrument --output $OUTPUT_DIR/summary.tsv --bootstrap 1000 \
+    --by instrument,snr,level,start,test_set,unit \
+    --by instrument,gender,test_set,unit \
+    --by instrument,noise_source,test_set,unit \
+    --sorted-reports $OUTPUT_DIR --results-name "$RESULTS_DIR_BASENAME"
+
+#for instr in $instruments
+#do
+#   python3 gen_mixes.py --outputFmt mp3 \
 #       --output-dir $OUTPUT_DIR/$instr-mixes $DATASET_DIR/$instr/$RESULTS_DIR_BASENAME/test_dev93_wav.scp
-#   python3 gen_mixes.py --sph2pipe ../kaldi/tools/sph2pipe_v2.5/ --outputFmt mp3 \
+#   python3 gen_mixes.py --outputFmt mp3 \
 #       --output-dir $OUTPUT_DIR/$instr-mixes $DATASET_DIR/$instr/$RESULTS_DIR_BASENAME/test_eval92_wav.scp
-
-done
+#done
@@ -0,0 +1,373 @@
+"""
+Aggregate the decoding results of every trial under a dataset root in one process.
+
+Trials are the results-mix-snrXX-lvXX-startXX directories written by
+decode_music.sh, found at any depth under the root. The directories above a
+trial give its instrument and song as named by --layout: by default the trial's
+parent is its song and the directory above that its instrument
+(DATASET_DIR/$instrument/$song/results-*), and with --layout instrument the
+parent is its instrument (DATASET_DIR/$instrument/results-*, as
+SIGSEP-collectResults4Analysis.sh runs it). Unnamed fields are left empty.
+The char and word results of both test sets of every trial are parsed in a
+process pool into one table with a row per utterance and columns for the
+instrument, song, SNR, level, start, test set, unit, speaker, gender and noise
+source, and error rates are summarized for any grouping of those columns.
+
+Parsed tables are cached by results_cache.py, so a re-run only parses the
+result files that were added or changed since the last one. Error rates can be
+given bootstrap confidence intervals, and two values of a column (i.e. two
+SNRs) compared with a paired bootstrap test over the utterances decoded in both.
+With --sorted-reports the reports of sort_results.py (by speaker, noise source
+and gender) of every trial are written from the same tables, so each result
+file is parsed once.
+
+usage: aggregate_results.py [-h] [--by fields] [--unit {char,word} ...]
+                            [--test-set {dev,eval} ...] [--spk2gender-dir path]
+                            [--layout fields] [--bootstrap N] [--compare field=A,B]
+                            [--cache path] [--no-cache] [--nj N]
+                            [--output path] [--sorted-reports path]
+                            [--results-name pattern] datasetRoot
+
+i.e. `aggregate_results.py SIGSEP --by instrument,snr --by song,gender`
+     `aggregate_results.py SIGSEP --by instrument,unit --compare snr=10,0 --bootstrap 1000`
+"""
+import os
+import re
+import sys
+import fnmatch
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from numpy.lib.recfunctions import repack_fields
+
+from results_table import SCORE_FIELDS, CATEGORY_FIELDS, RESULT_DTYPE, UNKNOWN, ResultTable, encode, \
+        noise_map_path
+from results_cache import RESULTS_CACHE_DIR, cached_table
+from stats import BOOTSTRAP_REPLICATES, errors_and_references, error_rate, error_rate_ci, paired_bootstrap
+from sort_results import report_inputs, reports_up_to_date, write_reports
+
+
+RESULTS_DIR_RE = re.compile(r'^results-mix-snr(.+)-lv(.+)-start(.+)$')
+TEST_SETS = {'dev': 'test_dev93', 'eval': 'test_eval92'}
+RESULT_FILES = {'char': 'result.txt', 'word': 'result.wrd.txt'}
+DECODE_DIR = 'decode_{}_decode_lm_word65000'
+SPK2GENDER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'espnet', 'egs', 'wsj', 'asr1',
+                              'data')
+
+TRIAL_FIELDS = ('instrument', 'song', 'test_set', 'unit')
+DIRECTORY_FIELDS = ('instrument', 'song')    # Trial fields given by the directories above a trial
+LAYOUT = ('instrument', 'song')             # Directory fields of the levels above a trial, outermost first
+CONDITION_FIELDS = ('snr', 'level', 'start')
+AGGREGATE_DTYPE = np.dtype(RESULT_DTYPE.descr + [(field, np.int32) for field in TRIAL_FIELDS] +
+                           [(field, np.float64) for field in CONDITION_FIELDS])
+PAIR_FIELDS = ('utt_id',) + TRIAL_FIELDS + CONDITION_FIELDS     # Identify the same utterance in two trials
+
+
+def parse_condition(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def discover_results(dataset_root, layout=LAYOUT):
+    """
+    Every trial directory under dataset_root, as dicts of its path, instrument, song and condition. The
+    directories right above a trial give the fields of layout, the last one being the trial's parent.
+    """
+    trials = []
+    for dirpath, dirnames, _ in os.walk(dataset_root):
+        dirnames.sort()
+        for dirname in dirnames:
+            match = RESULTS_DIR_RE.match(dirname)
+            if match is None:
+                continue
+            parents = os.path.relpath(dirpath, dataset_root).split(os.sep)
+            parents = [] if parents == ['.'] else parents
+            trial = {'path': os.path.join(dirpath, dirname),
+                     'snr': parse_condition(match.group(1)),
+                     'level': parse_condition(match.group(2)),
+                     'start': parse_condition(match.group(3))}
+            trial.update((field, '') for field in DIRECTORY_FIELDS)
+            trial.update(zip(reversed(layout), reversed(parents)))
+            trials.append(trial)
+        # Trials don't contain other trials
+        dirnames[:] = [dirname for dirname in dirnames if RESULTS_DIR_RE.match(dirname) is None]
+    return trials
+
+
+def _parse_trial(job):
+    trial, test_set, unit, spk2gender_dir, cache_dir = job
+    test_set_name = TEST_SETS[test_set]
+    result_path = os.path.join(trial['path'], DECODE_DIR.format(test_set_name), RESULT_FILES[unit])
+    if not os.path.isfile(result_path):
+        return job, None, False
+    noise_utt_map_path = noise_map_path(trial['path'], test_set_name)
+    spk2gender_path = os.path.join(spk2gender_dir, test_set_name, 'spk2gender')
+    table, hit = cached_table(result_path, noise_utt_map_path, spk2gender_path, cache_dir)
+    return job, table, hit
+
+
+def combine_tables(parsed):
+    """
+    Concatenate the tables of (job, table, cache hit) triples into one table with the trial columns
+    set and the categorical codes of every table mapped onto shared category names.
+    """
+    categories = {field: [] for field in CATEGORY_FIELDS + TRIAL_FIELDS}
+    parts = []
+    nparsed = 0
+    for (trial, test_set, unit, _, _), table, hit in parsed:
+        if table is None:
+            continue
+        nparsed += not hit
+        rows = np.zeros(len(table), dtype=AGGREGATE_DTYPE)
+        for field in RESULT_DTYPE.names:
+            rows[field] = table.rows[field]
+        for field in CATEGORY_FIELDS:
+            mapping, _ = encode(table.categories.get(field, []), categories[field])
+            mapping = np.append(mapping, UNKNOWN)   # UNKNOWN indexes the last element
+            rows[field] = mapping[table.rows[field]]
+        for field, value in zip(TRIAL_FIELDS, (trial['instrument'], trial['song'], test_set, unit)):
+            rows[field] = encode([value], categories[field])[0][0]
+        for field in CONDITION_FIELDS:
+            rows[field] = trial[field]
+        parts.append(rows)
+    rows = np.concatenate(parts) if parts else np.zeros(0, dtype=AGGREGATE_DTYPE)
+    print('Parsed {} of {} result files, the others were cached'.format(nparsed, len(parts)), file=sys.stderr)
+    return ResultTable(rows, categories)
+
+
+def parse_trials(dataset_root, test_sets=('dev', 'eval'), units=('char', 'word'), spk2gender_dir=SPK2GENDER_DIR,
+                 nj=None, cache_dir=RESULTS_CACHE_DIR, layout=LAYOUT):
+    """The (job, table, cache hit) of every trial, test set and unit under dataset_root, parsed by nj processes."""
+    jobs = [(trial, test_set, unit, spk2gender_dir, cache_dir) for trial in discover_results(dataset_root, layout)
+            for test_set in test_sets for unit in units]
+    if nj is None:
+        nj = os.cpu_count()
+    nj = max(1, min(nj, len(jobs)))
+    if nj == 1:
+        return list(map(_parse_trial, jobs))
+    with Pool(nj) as pool:
+        return list(pool.imap(_parse_trial, jobs, chunksize=max(1, len(jobs) // (4 * nj))))
+
+
+def aggregate(dataset_root, test_sets=('dev', 'eval'), units=('char', 'word'), spk2gender_dir=SPK2GENDER_DIR,
+              nj=None, cache_dir=RESULTS_CACHE_DIR, layout=LAYOUT):
+    """Parse every trial under dataset_root in a pool of nj processes into one table."""
+    return combine_tables(parse_trials(dataset_root, test_sets, units, spk2gender_dir, nj, cache_dir, layout))
+
+
+def write_sorted_reports(parsed, dataset_root, output_dir, results_name=None, nboot=BOOTSTRAP_REPLICATES,
+                         use_stamps=True):
+    """
+    Write the sort_results.py reports of every parsed table, of the trials whose directory name matches
+    the results_name pattern, to output_dir/sorted-<unit>-<test set>-<trial parent>__<trial>, from the
+    tables parse_trials already read. Reports whose inputs did not change are left alone.
+    """
+    for (trial, test_set, unit, spk2gender_dir, _), table, _ in parsed:
+        name = os.path.basename(trial['path'])
+        if table is None or (results_name is not None and not fnmatch.fnmatch(name, results_name)):
+            continue
+        parent = os.path.relpath(os.path.dirname(trial['path']), dataset_root).replace(os.sep, '__')
+        report_dir = os.path.join(output_dir, 'sorted-{}-{}-{}__{}'.format(unit, test_set, parent, name))
+        inputs = report_inputs(table.path, noise_map_path(trial['path'], TEST_SETS[test_set]),
+                               os.path.join(spk2gender_dir, TEST_SETS[test_set], 'spk2gender'), nboot)
+        if use_stamps and reports_up_to_date(report_dir, inputs):
+            continue
+        write_reports(table, report_dir, inputs, nboot)
+
+
+def group_rows(table, fields, rows=None):
+    """
+    Group rows (all rows of the table by default) by the combinations of values of fields. Returns
+    the values of every group present (names for categorical fields) and the group of every row.
+    """
+    rows = table.rows if rows is None else rows
+    columns = np.stack([rows[field].astype(np.float64) for field in fields], axis=1)
+    keys, inverse = np.unique(columns, axis=0, return_inverse=True)
+    groups = []
+    for key in keys:
+        group = []
+        for field, value in zip(fields, key):
+            if field in table.categories:
+                group.append('' if value == UNKNOWN else table.categories[field][int(value)])
+            else:
+                group.append('{:g}'.format(value))
+        groups.append(group)
+    return groups, inverse.reshape(-1)
+
+
+def summarize(table, fields, nboot=0):
+    """
+    Scores and error rates of every combination of values of fields present in the table. Returns a
+    list of the group values and a (groups, 6) array of the number of utterances, the summed C/S/D/I
+    and the error rate (S + D + I) / (C + S + D). With nboot bootstrap replicates, two more columns
+    hold the confidence interval of the error rate.
+    """
+    groups, inverse = group_rows(table, fields)
+    scores = table.scores()
+    counts = np.bincount(inverse, minlength=len(groups))
+    sums = np.stack([np.bincount(inverse, weights=scores[:, i], minlength=len(groups))
+                     for i in range(len(SCORE_FIELDS))], axis=1)
+    errors, references = errors_and_references(sums)
+    columns = [counts, sums, error_rate(errors, references)]
+    if nboot:
+        columns.extend(error_rate_ci(scores, inverse, len(groups), nboot)[1:])
+    return groups, np.column_stack(columns)
+
+
+def str_summary(table, fields, nboot=0):
+    groups, summary = summarize(table, fields, nboot)
+    rate_fields = ['error_rate'] + (['ci_low', 'ci_high'] if nboot else [])
+    res = '\t'.join(list(fields) + ['utterances'] + list(SCORE_FIELDS) + rate_fields) + '\n'
+    for group, values in zip(groups, summary):
+        res += '\t'.join(group + ['{:d}'.format(int(value)) for value in values[:-len(rate_fields)]] +
+                         ['{:.4f}'.format(value) for value in values[-len(rate_fields):]]) + '\n'
+    return res
+
+
+def field_value(table, field, value):
+    """Code of a categorical value, or the number of a condition, of field as given on the command line."""
+    if field in table.categories:
+        if value not in table.categories[field]:
+            raise ValueError('No {} {} in the results'.format(field, value))
+        return table.categories[field].index(value)
+    return float(value)
+
+
+def compare(table, field, value_a, value_b, fields, nboot=BOOTSTRAP_REPLICATES):
+    """
+    Paired bootstrap test of the trials with value_b of field against the trials with value_a. The
+    utterances decoded in both are paired on their id and every other trial column, and tested for
+    every combination of values of fields. Returns the values of every group and a (groups, 7) array
+    of the number of pairs, the error rates of A and B, the difference B - A with its confidence
+    interval and the p-value of the difference.
+    """
+    if field in fields:
+        raise ValueError('Can not group a comparison of {} by {}'.format(field, field))
+    key_fields = [name for name in PAIR_FIELDS if name != field]
+    rows_a = table.rows[table.rows[field] == field_value(table, field, value_a)]
+    rows_b = table.rows[table.rows[field] == field_value(table, field, value_b)]
+    _, index_a, index_b = np.intersect1d(repack_fields(rows_a[key_fields]), repack_fields(rows_b[key_fields]),
+                                         assume_unique=True, return_indices=True)
+    rows_a = rows_a[index_a]
+    rows_b = rows_b[index_b]
+    scores_a = np.stack([rows_a[score] for score in SCORE_FIELDS], axis=1)
+    scores_b = np.stack([rows_b[score] for score in SCORE_FIELDS], axis=1)
+    groups, inverse = group_rows(table, fields, rows_a)
+    counts = np.bincount(inverse, minlength=len(groups))
+    rates = [error_rate(*[np.bincount(inverse, weights=column, minlength=len(groups))
+                          for column in errors_and_references(scores)]) for scores in (scores_a, scores_b)]
+    delta, low, high, p_value = paired_bootstrap(scores_a, scores_b, inverse, len(groups), nboot)
+    return groups, np.column_stack([counts] + rates + [delta, low, high, p_value])
+
+
+def str_comparison(table, field, value_a, value_b, fields, nboot=BOOTSTRAP_REPLICATES):
+    groups, comparison = compare(table, field, value_a, value_b, fields, nboot)
+    res = '# {} {} (A) against {} (B)\n'.format(field, value_a, value_b)
+    res += '\t'.join(list(fields) + ['pairs', 'error_rate_a', 'error_rate_b', 'difference', 'ci_low', 'ci_high',
+                                     'p_value']) + '\n'
+    for group, values in zip(groups, comparison):
+        res += '\t'.join(group + ['{:d}'.format(int(values[0]))] + ['{:.4f}'.format(value) for value in values[1:]])
+        res += '\n'
+    return res
+
+
+if __name__ == '__main__':
+
+    def dir_path(string):
+        if os.path.isdir(string):
+            return string
+        else:
+            raise NotADirectoryError(string)
+
+    def field_list(string):
+        fields = string.split(',')
+        for field in fields:
+            if field not in AGGREGATE_DTYPE.names or field in SCORE_FIELDS + ('utt_id', 'block_start', 'block_end'):
+                raise argparse.ArgumentTypeError('Unknown field {}'.format(field))
+        return fields
+
+    def layout_fields(string):
+        fields = string.split('/')
+        if len(set(fields)) != len(fields) or any(field not in DIRECTORY_FIELDS for field in fields):
+            raise argparse.ArgumentTypeError('Expected /-separated fields out of {}, got {}'.format(
+                    ', '.join(DIRECTORY_FIELDS), string))
+        return tuple(fields)
+
+    def comparison(string):
+        field, _, values = string.partition('=')
+        values = values.split(',')
+        if len(values) != 2 or field not in CATEGORY_FIELDS + TRIAL_FIELDS + CONDITION_FIELDS:
+            raise argparse.ArgumentTypeError('Expected field=A,B, got {}'.format(string))
+        return field, values[0], values[1]
+
+    parser = argparse.ArgumentParser(description='Aggregate the results of every results-mix-snrXX-lvXX-startXX \
+            trial under a dataset root and summarize the error rates by any grouping.')
+    parser.add_argument('datasetRoot', type=dir_path,
+            help='Directory searched for trials, i.e. the DATASET_DIR of SIGSEP-collectResults4Analysis.sh.')
+    parser.add_argument('--by', type=field_list, metavar='fields', action='append',
+            help='Comma separated columns to group by, out of {}. May be given several times. Default is \
+                    instrument,snr,test_set,unit.'.format(', '.join(CATEGORY_FIELDS + TRIAL_FIELDS +
+                                                                      CONDITION_FIELDS)))
+    parser.add_argument('--unit', type=str, choices=list(RESULT_FILES), nargs='+', default=list(RESULT_FILES),
+            help='Decoding results to aggregate. Default is both.')
+    parser.add_argument('--test-set', type=str, choices=list(TEST_SETS), nargs='+', default=list(TEST_SETS),
+            help='Test sets to aggregate. Default is both.')
+    parser.add_argument('--spk2gender-dir', type=str, metavar='path', default=SPK2GENDER_DIR,
+            help='Data directory holding <test set>/spk2gender. Default is the espnet wsj recipe data. Without \
+                    it the groupings by gender are skipped.')
+    parser.add_argument('--layout', type=layout_fields, metavar='fields', default=LAYOUT,
+            help='/-separated fields named by the directories above a trial, outermost first, the last being \
+                    the directory holding the trial. Default is {} (DATASET_DIR/$instrument/$song/results-*), \
+                    instrument for DATASET_DIR/$instrument/results-*.'.format('/'.join(LAYOUT)))
+    parser.add_argument('--bootstrap', type=int, metavar='N', default=0,
+            help='Add a bootstrap confidence interval of N replicates to the error rates. Default is none.')
+    parser.add_argument('--compare', type=comparison, metavar='field=A,B',
+            help='Paired bootstrap test of the trials with value B of a field against value A, i.e. snr=10,0, \
+                    grouped by every --by grouping that does not include the field.')
+    parser.add_argument('--cache', type=str, metavar='path', default=RESULTS_CACHE_DIR,
+            help='Directory of the parsed results cache. Default is {}'.format(RESULTS_CACHE_DIR))
+    parser.add_argument('--no-cache', action='store_true',
+            help='Parse every result file without reading or writing the cache.')
+    parser.add_argument('--nj', type=int, metavar='N',
+            help='Number of processes to parse with. Defaults to the number of cores.')
+    parser.add_argument('--output', type=str, metavar='path',
+            help='Write the summaries to this file instead of stdout.')
+    parser.add_argument('--sorted-reports', type=str, metavar='path',
+            help='Also write the reports of sort_results.py of every trial, test set and unit to \
+                    path/sorted-<unit>-<test set>-<trial parent>__<trial>, from the tables parsed here.')
+    parser.add_argument('--results-name', type=str, metavar='pattern',
+            help='Only write the --sorted-reports of the trial directories matching this pattern, \
+                    i.e. results-mix-snr15-lv0-start15. Default is every trial.')
+    args = parser.parse_args()
+
+    groupings = args.by if args.by else [['instrument', 'snr', 'test_set', 'unit']]
+    if not os.path.isdir(args.spk2gender_dir):
+        # Gender is optional, every row would have an unknown gender
+        print('{} is not a directory, the groupings by gender are skipped'.format(args.spk2gender_dir),
+              file=sys.stderr)
+        groupings = [fields for fields in groupings if 'gender' not in fields]
+        if args.compare is not None and args.compare[0] == 'gender':
+            args.compare = None
+
+    parsed = parse_trials(args.datasetRoot, args.test_set, args.unit, args.spk2gender_dir, args.nj,
+                          None if args.no_cache else args.cache, args.layout)
+    table = combine_tables(parsed)
+    if args.sorted_reports is not None:
+        # After combining, the reports rename the noise sources of the parsed tables after their tracks
+        write_sorted_reports(parsed, args.datasetRoot, args.sorted_reports, args.results_name,
+                             args.bootstrap or BOOTSTRAP_REPLICATES, not args.no_cache)
+    output = open(args.output, 'w') if args.output is not None else sys.stdout
+    for fields in groupings:
+        output.write(str_summary(table, fields, args.bootstrap))
+        output.write('\n')
+    if args.compare is not None:
+        field, value_a, value_b = args.compare
+        for fields in groupings:
+            if field not in fields:
+                output.write(str_comparison(table, field, value_a, value_b, fields, args.bootstrap or
+                                            BOOTSTRAP_REPLICATES))
+                output.write('\n')
+    if args.output is not None:
+        output.close()
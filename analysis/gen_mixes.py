@@ -1,4 +1,15 @@
 """
+Render the mixes of an augmented wav.scp for listening.
+
+Mixes are rendered in a pool of processes and written atomically, so an
+interrupted run is resumed by running it again: mixes already present in the
+output directory are skipped. --uttId takes several ids or shell style patterns.
+The mix parameters are read from the mix manifest written with the wav.scp;
+wav.scp files from before manifests are parsed instead. Mixes of the numpy
+backend are rendered again from the noise cache, with the track converted to
+the rate and channels of the speech as mix_wsj_noise.py mixed it, whether the
+wav.scp points at files, an archive or the mixing daemon of --serve.
+
 Note mp3 codec is normally not installed by default:
 $ sudo apt-get install libsox-fmt-mp3
 """
@@ -6,8 +17,24 @@ $ sudo apt-get install libsox-fmt-mp3
 import os
 import sys
 import re
+import io
+import wave
 import argparse
 import subprocess
+from fnmatch import fnmatchcase
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wsj_asr1', 'local', 'mix_wsj_noise'))
+import numpy as np
+from mix_engine import map_wav, wav_data_offset, as_float, gain_factor, read_scp_audio, write_wav, mix_utterance
+from manifest import ManifestReader, is_manifest, manifest_name
+from noise_cache import NOISE_CACHE_DIR, load_noise
+from results_table import read_noise_utt_map
+
+
+# Line of the augmented wav.scp written by the sox backend of mix_wsj_noise.py
+SOX_MIX_RE = re.compile(r'^(\S+) (.+?) \| sox -t wav - -p gain( -n)?( \S+)? \| '
+                        r'sox --combine mix -p "\|sox (\S+) -p trim (\S+) (\S+)" .* gain -n (\S+) \|$')
 
 
 def dir_path(string):
@@ -28,20 +55,24 @@ parser = argparse.ArgumentParser(description='Generate the noise and utterance m
         data augmentation step (step 0.5 of run.sh).')
 parser.add_argument('wavSCP', type=file_path, metavar='path',
         help='Path to the wav.scp.')
-parser.add_argument('--sph2pipe', type=str, metavar='path',
-        help='Path to the sph2pipe program if it is not on the system PATH. It is built by kaldi and can \
-                usually be found at KALDI_ROOT/tools/sph2pipe_X.XX/sph2pipe. Either the path to the \
-                executeable can be specified (program must be named sph2pipe) or a path to the \
-                executable itself.')
-parser.add_argument('--uttId', type=str, metavar='id',
-        help='Generate only the mix for the speficied utterance Id.')
+parser.add_argument('--uttId', type=str, metavar='id', nargs='+',
+        help='Generate only the mixes of these utterance Ids. Shell style wildcards select several, i.e. "4k0*".')
+parser.add_argument('--noise-utt-map', type=file_path, metavar='path',
+        help='The mix manifest (or noise_utt_map) of the wav.scp. Default is the one next to it, if there is one.')
 parser.add_argument('--output-dir', type=str, metavar='path',
         help='Where to place the generated mixes. If not specified, the mixes will be placed in a direcotry \
                 called mixes in the same directory as the noise source that utterance was mixed with.')
 parser.add_argument('--outputFmt', type=str, metavar='format', default='wav',
         help='The desired output format. Default is wave.')
+parser.add_argument('--noise-cache', type=str, metavar='path', default=NOISE_CACHE_DIR,
+        help='Noise cache the mixes of the numpy backend are rendered from, as given to mix_wsj_noise.py. \
+                Default is {}'.format(NOISE_CACHE_DIR))
+parser.add_argument('--nj', type=int, metavar='N',
+        help='Number of processes to render the mixes with. Defaults to the number of cores.')
+parser.add_argument('--force', action='store_true',
+        help='Render every mix again, even those already present in the output directory.')
 parser.add_argument('--dry-run', action='store_true',
-        help='Perform a dry run. Write the mix generaiton command to stdout.')
+        help='Perform a dry run. Write the uttId and output path of every mix to render to stdout.')
 
 
 def get_unique_noise_source_name(path, utt_id):
@@ -50,59 +81,213 @@ def get_unique_noise_source_name(path, utt_id):
     return '{}__{}__{}'.format(utt_id, source_dir, source_file)
 
 
-def generate_mixes(wavSCP, sph2pipe_path=None, target_uttId=None, mix_fmt='wav', dry_run=False, output_dir=None,
-                   output_name_fmt=get_unique_noise_source_name):
+def parse_wavscp_line(line):
+    """
+    Parse a line of the augmented wav.scp into the utterance ID and its mix parameters. Lines written
+    by the numpy backend point at an already rendered mix, a file or an offset of a wav archive, and
+    only have the mix path.
+    """
+    line = line.strip()
+    match = SOX_MIX_RE.search(line)
+    if match is None:
+        uttId, path = line.split(' ', 1)
+        return uttId, {'mix': path}
+    uttId, speech, normalize, speech_level, noise, start, duration, mix_level = match.groups()
+    return uttId, {'speech': speech,
+                   'speech_gain': (float(speech_level) if speech_level else 0, normalize is None),
+                   'noise': noise,
+                   'start': float(start),
+                   'duration': float(duration),
+                   'mix_level': float(mix_level)}
+
+
+def find_noise_utt_map(wavSCP):
+    """
+    The mix manifest (or the noise_utt_map that preceded it) written with a wav.scp: <prefix>mix_manifest
+    next to a <prefix>wav.scp as in the results directories of decode_music.sh, or the one of its data
+    directory.
+    """
+    dirname, basename = os.path.split(wavSCP)
+    prefix = basename[:-len('wav.scp')] if basename.endswith('wav.scp') else None
+    candidates = []
+    for name in (manifest_name(), 'noise_utt_map'):
+        if prefix:
+            candidates.append(os.path.join(dirname, prefix + name))
+        candidates.append(os.path.join(dirname, name))
+    for path in candidates:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def manifest_params(record, backend):
+    """Mix parameters of an utterance from its manifest record and the backend of the manifest."""
+    return {'backend': backend,
+            'speech': record['speech'],
+            'speech_gain': (record['speech_level'], record['speech_relative']),
+            'noise': record['noise_path'],
+            'noise_gain': (record['noise_level'], record['noise_relative']),
+            'start': record['noise_start'],
+            'duration': record['duration'],
+            'mix_level': record['mix_level']}
+
+
+def read_mix_params(wavSCP, noise_utt_map=None):
+    """
+    The mix parameters of every utterance of an augmented wav.scp, in file order, as (uttId, params)
+    pairs. With a mix manifest the parameters are its records, joined on the uttId. Otherwise each
+    line is parsed once, and the noise source of mixes rendered by the numpy backend is taken from
+    the noise_utt_map so all mixes are named after their noise source.
+    """
+    manifest = None
+    file_list, utt2noise = [], {}
+    if noise_utt_map is not None and is_manifest(noise_utt_map):
+        manifest = ManifestReader(noise_utt_map)
+    elif noise_utt_map is not None:
+        file_list, utt2noise = read_noise_utt_map(noise_utt_map)
+    entries = []
     with open(wavSCP, 'r') as f:
         for line in f:
-            match = re.search('^([\w\d]+) (.+)?sph2pipe (.+)', line)
-            uttId = match.group(1)
-            sph2pipe_dirname = match.group(2)
-            command_args = match.group(3)
-
-            if target_uttId is not None and target_uttId != uttId:
+            if not line.strip():
+                continue
+            if manifest is not None and line.split(' ', 1)[0] in manifest:
+                uttId = line.split(' ', 1)[0]
+                entries.append((uttId, manifest_params(manifest[uttId], manifest.header['backend'])))
                 continue
+            uttId, params = parse_wavscp_line(line)
+            if 'noise' not in params and uttId in utt2noise:
+                params['noise'] = file_list[utt2noise[uttId]]
+            entries.append((uttId, params))
+    if manifest is not None:
+        manifest.close()
+    return entries
 
-            if sph2pipe_path is None:
-                if sph2pipe_dirname is None:
-                    command = ['sph2pipe']
-                else:
-                    command = [os.path.join(sph2pipe_dirname, 'sph2pipe')]
-            else:
-                command = [sph2pipe_path]
-
-            command_args = command_args.split(' ')
-            original_mix_filename = command_args[-16]
-            output_name = '{}.{}'.format(output_name_fmt(original_mix_filename, uttId), mix_fmt)
-            if output_dir is None:
-                output_dir = os.path.dirname(original_mix_filename)
-                output_dir = os.path.join(output_dir, 'mixes')
-            output_path = os.path.join(output_dir, output_name)
-            command_args = command_args[:-1]
-            command_args[-4] = '-t'     # Replace '-' (sox output to stdout) with -t (sox output to file of type)
-            command_args.insert(-3, mix_fmt)
-            command_args.insert(-3, output_path)
-            command += command_args
-
-            if dry_run:
-                print(' '.join(command))
-            else:
-                if not os.path.exists(output_dir):
-                    os.mkdir(output_dir)
-                subprocess.call(' '.join(command), shell=True)
-            
-            
 
+def select_utterances(entries, patterns):
+    """The entries whose uttId matches any of the shell style patterns, all of them without patterns."""
+    if not patterns:
+        return entries
+    return [(uttId, params) for uttId, params in entries if any(fnmatchcase(uttId, pattern) for pattern in patterns)]
 
-if __name__ == '__main__':
 
-    args = parser.parse_args()
+def render_mix(params, cache_dir=NOISE_CACHE_DIR, noises={}):
+    """
+    Render a mix from its parameters as float samples and the sample rate. The noise of the numpy backend
+    is the track of the noise cache at the rate of the speech, the one of the sox backend the preprocessed
+    track, already at that rate.
+    """
+    if 'mix' in params:
+        return read_scp_audio(params['mix'])
+    speech, srate = read_scp_audio(params['speech'])
+    key = params['noise'], srate
+    if key not in noises:
+        # Memory mapped, only the segment of the mix is read from the noise track
+        if params.get('backend') == 'numpy':
+            noises[key] = load_noise(params['noise'], srate, 1, cache_dir)
+        else:
+            noise = map_wav(params['noise'])[0]
+            noises[key] = noise, None
+    noise, peak = noises[key]
+    noise_level, noise_relative = params.get('noise_gain', (0, True))
+    if not noise_relative and peak is None:
+        peak = np.max(np.abs(as_float(noise)))
+    noise_gain = gain_factor(noise_level, noise_relative, peak)
+    return mix_utterance(speech, noise, int(round(params['start'] * srate)), *params['speech_gain'],
+                         params['mix_level'], noise_gain), srate
 
-    if args.sph2pipe is None:   # It must be on the PATH
-        sph2pipe_path = None
-    elif os.path.isdir(args.sph2pipe):
-        sph2pipe_path = os.path.join(args.sph2pipe, 'sph2pipe')
-    elif os.path.isfile(args.sph2pipe):
-        sph2pipe_path = args.sph2pipe
 
-    generate_mixes(args.wavSCP, sph2pipe_path, args.uttId, args.outputFmt, args.dry_run, args.output_dir)
+def save_mix(output_path, samples, srate, mix_fmt):
+    """Write a mix to a temporary file renamed to output_path once complete, so it is never left partial."""
+    tmp_path = '{}.{}.tmp'.format(output_path, os.getpid())
+    if mix_fmt == 'wav':
+        write_wav(tmp_path, samples, srate)
+    else:
+        # Other formats are encoded by sox from the rendered wave
+        wav = io.BytesIO()
+        write_wav(wav, samples, srate)
+        command = 'sox -t wav - -t {fmt} {path}'.format(fmt=mix_fmt, path=tmp_path)
+        res = subprocess.run(command, shell=True, input=wav.getvalue())
+        if res.returncode != 0:
+            raise Exception('code {} raised by: {}'.format(res.returncode, command))
+    os.replace(tmp_path, output_path)
+
+
+def is_rendered(output_path, mix_fmt):
+    """Whether a mix is already present: a wave file with all the samples of its header, or any non-empty file."""
+    if not os.path.isfile(output_path) or os.path.getsize(output_path) == 0:
+        return False
+    if mix_fmt != 'wav':
+        return True
+    try:
+        with open(output_path, 'rb') as f:
+            with wave.open(f, 'rb') as w:
+                data_size = w.getnframes() * w.getnchannels() * w.getsampwidth()
+            return os.path.getsize(output_path) >= wav_data_offset(f) + data_size
+    except (wave.Error, EOFError, ValueError):
+        return False
+
+
+def mix_output_path(uttId, params, mix_fmt, output_dir=None, output_name_fmt=get_unique_noise_source_name):
+    """Output path of a mix, named after its noise source when it is known."""
+    if 'noise' in params:
+        output_name = '{}.{}'.format(output_name_fmt(params['noise'], uttId), mix_fmt)
+        default_dir = os.path.join(os.path.dirname(params['noise']), 'mixes')
+    else:
+        output_name = '{}.{}'.format(uttId, mix_fmt)
+        default_dir = os.path.join(os.path.dirname(params['mix']), 'mixes')
+    return os.path.join(output_dir if output_dir is not None else default_dir, output_name)
+
+
+def _render_job(job):
+    params, output_path, mix_fmt, cache_dir = job
+    samples, srate = render_mix(params, cache_dir)
+    save_mix(output_path, samples, srate, mix_fmt)
+    return output_path
+
+
+def generate_mixes(wavSCP, target_uttIds=None, mix_fmt='wav', dry_run=False, output_dir=None,
+                   output_name_fmt=get_unique_noise_source_name, nj=None, noise_utt_map=None, force=False,
+                   cache_dir=NOISE_CACHE_DIR):
+    """
+    Render the mixes of the utterances of an augmented wav.scp matching target_uttIds in a pool of nj
+    processes, those of the numpy backend from the noise cache at cache_dir. Mixes already present are
+    skipped unless force is set.
+    """
+    if noise_utt_map is None:
+        noise_utt_map = find_noise_utt_map(wavSCP)
+    entries = select_utterances(read_mix_params(wavSCP, noise_utt_map), target_uttIds)
+
+    jobs = []
+    skipped = 0
+    for uttId, params in entries:
+        output_path = mix_output_path(uttId, params, mix_fmt, output_dir, output_name_fmt)
+        if not force and is_rendered(output_path, mix_fmt):
+            skipped += 1
+            continue
+        if dry_run:
+            print('{} {}'.format(uttId, output_path))
+            continue
+        jobs.append((params, output_path, mix_fmt, cache_dir))
+    if dry_run:
+        return
+
+    for this_output_dir in set(os.path.dirname(output_path) for _, output_path, _, _ in jobs):
+        if not os.path.exists(this_output_dir):
+            os.makedirs(this_output_dir)
+    if nj is None:
+        nj = os.cpu_count()
+    nj = max(1, min(nj, len(jobs)))
+    if nj == 1:
+        rendered = list(map(_render_job, jobs))
+    else:
+        with Pool(nj) as pool:
+            rendered = list(pool.imap_unordered(_render_job, jobs))
+    print('Rendered {} mixes, skipped {} already present'.format(len(rendered), skipped), file=sys.stderr)
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
 
+    generate_mixes(args.wavSCP, args.uttId, args.outputFmt, args.dry_run, args.output_dir, nj=args.nj,
+                   noise_utt_map=args.noise_utt_map, force=args.force, cache_dir=args.noise_cache)
@@ -0,0 +1,77 @@
+"""
+Cache of parsed result tables, so unchanged trials are not parsed again.
+
+A ResultTable is stored as an .npz file holding its structured array and its
+category names, named after the SHA-1 of the result file path. Each entry
+records the path, mtime and size of every input it was built from (the sclite
+result file, the mix manifest or noise_utt_map and the spk2gender) and is only
+used while all of them are unchanged.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+from results_table import ResultTable, parse_result_txt, parse_noise_utt_map, parse_spk2gender
+
+
+RESULTS_CACHE_DIR = os.path.join(os.environ.get('MIX_WSJ_NOISE_CACHE',
+                                                os.path.join(os.path.expanduser('~'), '.cache', 'mix_wsj_noise')),
+                                 'results')
+
+
+def fingerprints(paths):
+    """(path, mtime_ns, size) of every existing path, the key of a cache entry."""
+    entries = []
+    for path in paths:
+        if path is not None and os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append([os.path.abspath(path), stat.st_mtime_ns, stat.st_size])
+    return entries
+
+
+def entry_path(result_path, cache_dir=RESULTS_CACHE_DIR):
+    key = hashlib.sha1(os.path.abspath(result_path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, '{}.npz'.format(key))
+
+
+def load_table(result_path, inputs, cache_dir=RESULTS_CACHE_DIR):
+    """The cached table of result_path, or None if it is missing or any input changed."""
+    path = entry_path(result_path, cache_dir)
+    if not os.path.isfile(path):
+        return None
+    with np.load(path, allow_pickle=False) as entry:
+        if json.loads(str(entry['inputs'])) != inputs:
+            return None
+        return ResultTable(entry['rows'], json.loads(str(entry['categories'])), result_path)
+
+
+def save_table(table, inputs, cache_dir=RESULTS_CACHE_DIR):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    path = entry_path(table.path, cache_dir)
+    # Write then rename so concurrent runs never load a partial entry
+    tmp_path = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+    np.savez(tmp_path, rows=table.rows, categories=np.array(json.dumps(table.categories)),
+             inputs=np.array(json.dumps(inputs)))
+    os.replace(tmp_path, path)
+
+
+def cached_table(result_path, noise_utt_map_path=None, spk2gender_path=None, cache_dir=RESULTS_CACHE_DIR):
+    """
+    The table of an sclite result file with the noise sources and genders of its utterances, from
+    the cache if none of the inputs changed. Returns the table and whether it was a cache hit.
+    A cache_dir of None disables the cache.
+    """
+    inputs = fingerprints([result_path, noise_utt_map_path, spk2gender_path])
+    table = load_table(result_path, inputs, cache_dir) if cache_dir is not None else None
+    if table is not None:
+        return table, True
+    table = parse_result_txt(result_path)
+    if noise_utt_map_path is not None and os.path.isfile(noise_utt_map_path):
+        parse_noise_utt_map(noise_utt_map_path, table)
+    if spk2gender_path is not None and os.path.isfile(spk2gender_path):
+        parse_spk2gender(spk2gender_path, table)
+    if cache_dir is not None:
+        save_table(table, inputs, cache_dir)
+    return table, False
@@ -0,0 +1,216 @@
+"""
+Columnar table of the per-utterance scores of an sclite result.txt / result.wrd.txt.
+
+Each utterance is one row of a NumPy structured array with integer C/S/D/I
+columns and integer coded categorical columns (speaker, gender, noise source)
+whose names are kept once per table. Groupings are computed with a vectorized
+group-by over the codes instead of building a dict per utterance, and the
+original sclite text of an utterance is not kept in memory: each row records the
+byte range of its block in the result file, which is read back only for reports.
+"""
+import re
+import os
+import sys
+import ast
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wsj_asr1', 'local', 'mix_wsj_noise'))
+from manifest import ManifestReader, is_manifest, manifest_name
+from noise_catalog import Catalog, catalog_path, find_catalog
+
+
+SCORE_FIELDS = ('correct', 'substitution', 'deletion', 'insertion')
+CATEGORY_FIELDS = ('speaker', 'gender', 'noise_source')
+RESULT_DTYPE = np.dtype([('utt_id', 'U32')] + [(field, np.int32) for field in CATEGORY_FIELDS] +
+                        [(field, np.int32) for field in SCORE_FIELDS] + [('block_start', np.int64), ('block_end', np.int64)])
+UNKNOWN = -1    # Code of a categorical value that is not known
+
+# id, Scores, REF, HYP and Eval lines of one utterance of an sclite report, the last one may end the file
+RESULT_BLOCK_RE = re.compile(rb'^id: \(([\d\w]+)-([\d\w]+)\)[^\n]*\n'
+                             rb'Scores: \(#C #S #D #I\) (\d+) (\d+) (\d+) (\d+)[^\n]*\n'
+                             rb'(?:[^\n]*\n){2}[^\n]*(?:\n|\Z)', re.MULTILINE)
+
+
+def get_short_noise_source_name(path):
+    source_file = os.path.splitext(os.path.basename(path))[0]
+    source_dir = os.path.basename(os.path.dirname(path))
+    return '{}__{}'.format(source_dir, source_file)
+
+
+def encode(values, names=None):
+    """Integer codes of values and the list of names they index, extending names if given."""
+    names = [] if names is None else names
+    index = {name: i for i, name in enumerate(names)}
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        if value not in index:
+            index[value] = len(names)
+            names.append(value)
+        codes[i] = index[value]
+    return codes, names
+
+
+class ResultTable:
+    """Rows of a result file with the names of the categorical columns and the path they were read from."""
+
+    def __init__(self, rows, categories, path=None):
+        self.rows = rows
+        self.categories = categories
+        self.path = path
+
+    def __len__(self):
+        return len(self.rows)
+
+    def scores(self):
+        """Scores as an integer matrix of shape (utterances, 4), in the order of SCORE_FIELDS."""
+        return np.stack([self.rows[field] for field in SCORE_FIELDS], axis=1)
+
+    def groups(self, field):
+        """
+        Group the rows by a categorical column. Returns the names of the groups present, in order of
+        first appearance, and for each the indices of its rows in file order.
+        """
+        codes = self.rows[field]
+        present, first = np.unique(codes, return_index=True)
+        present = present[np.argsort(first)]
+        present = present[present != UNKNOWN]
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], present)
+        ends = np.searchsorted(codes[order], present, side='right')
+        names = [self.categories[field][code] for code in present]
+        return names, [order[start:end] for start, end in zip(bounds, ends)]
+
+    def group_sums(self, field):
+        """Summed scores of every category of field, shape (len(categories[field]), 4)."""
+        codes = self.rows[field]
+        known = codes != UNKNOWN
+        ncategories = len(self.categories[field])
+        return np.stack([np.bincount(codes[known], weights=self.rows[score][known], minlength=ncategories)
+                         for score in SCORE_FIELDS], axis=1).astype(np.int64)
+
+    def original_outputs(self, indices=None):
+        """The sclite text of the rows at indices (all rows by default), read back from the result file."""
+        rows = self.rows if indices is None else self.rows[indices]
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        # The block of a file without a trailing newline ends without one
+        return ['{}\n\n'.format(data[start:end].rstrip(b'\n').decode('utf-8'))
+                for start, end in zip(rows['block_start'], rows['block_end'])]
+
+
+def parse_result_txt(filepath):
+    """Parse the per-utterance blocks of an sclite result.txt or result.wrd.txt into a ResultTable."""
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    matches = list(RESULT_BLOCK_RE.finditer(data))
+    rows = np.zeros(len(matches), dtype=RESULT_DTYPE)
+    speakers = [match.group(1).decode('utf-8') for match in matches]
+    rows['utt_id'] = [match.group(2).decode('utf-8') for match in matches]
+    rows['speaker'], speaker_names = encode(speakers)
+    rows['gender'] = UNKNOWN
+    rows['noise_source'] = UNKNOWN
+    if matches:
+        scores = np.array([match.groups()[2:6] for match in matches], dtype=np.int32)
+        for i, field in enumerate(SCORE_FIELDS):
+            rows[field] = scores[:, i]
+        rows['block_start'] = [match.start() for match in matches]
+        rows['block_end'] = [match.end() for match in matches]
+    return ResultTable(rows, {'speaker': speaker_names, 'gender': [], 'noise_source': []}, filepath)
+
+
+def noise_map_path(results_dir, test_set):
+    """
+    The file recording the noise source of every utterance of a test set in a results directory:
+    its mix manifest, or the noise_utt_map that results collected before manifests have.
+    """
+    manifest_path = os.path.join(results_dir, '{}_{}'.format(test_set, manifest_name()))
+    if os.path.isfile(manifest_path):
+        return manifest_path
+    return os.path.join(results_dir, '{}_noise_utt_map'.format(test_set))
+
+
+def read_noise_utt_map(filepath, basepath=None):
+    """The noise source list and the utt_id -> noise index mapping of a mix manifest or noise_utt_map file."""
+    if is_manifest(filepath):
+        with ManifestReader(filepath) as manifest:
+            file_list = list(manifest.strings)
+            utt2noise = manifest.noise_index()
+    else:
+        with open(filepath, 'r') as f:
+            file_list = ast.literal_eval(next(f).strip())
+            utt2noise = {}
+            for line in f:
+                uttId, noise_idx = line.split()
+                utt2noise[uttId] = int(noise_idx)
+    if basepath is not None:
+        file_list = [file_.replace(basepath, '') for file_ in file_list]
+    return file_list, utt2noise
+
+
+def parse_noise_utt_map(filepath, table, basepath=None):
+    """Set the noise_source column of a table from a mix manifest or noise_utt_map. Categories are short source names."""
+    file_list, utt2noise = read_noise_utt_map(filepath, basepath)
+    codes, names = encode([get_short_noise_source_name(path) for path in file_list])
+    noise_idx = np.array([utt2noise.get(uttId, UNKNOWN) for uttId in table.rows['utt_id']], dtype=np.int32)
+    table.rows['noise_source'] = np.where(noise_idx == UNKNOWN, UNKNOWN, codes[noise_idx] if len(codes) else UNKNOWN)
+    table.categories['noise_source'] = names
+    table.categories['noise_path'] = file_list
+    return table
+
+
+def noise_catalog_roots(noise_paths):
+    """The catalog root of every noise path (see noise_catalog.py), None for the paths without one."""
+    return [find_catalog(path) if os.path.exists(path) else None for path in noise_paths]
+
+
+def noise_catalog_paths(noise_paths):
+    """The catalog file of every noise path, None for the paths without one."""
+    return [catalog_path(root) if root is not None else None for root in noise_catalog_roots(noise_paths)]
+
+
+def resolve_noise_sources(table):
+    """
+    Name the noise sources of a table after the catalog tracks of their noise paths, so the tracks
+    preprocessed by the sox backend are named after their source track. Returns the track of every
+    noise_source category, None for the sources that are not in a catalog.
+    """
+    noise_paths = table.categories.get('noise_path', [])
+    catalogs = {}
+    tracks = []
+    for path, root in zip(noise_paths, noise_catalog_roots(noise_paths)):
+        if root is not None and root not in catalogs:
+            catalogs[root] = Catalog(root)
+        tracks.append(catalogs[root].find(path) if root is not None else None)
+    # Sources are named by path, a name may stand for several paths
+    old_names = table.categories['noise_source']
+    name_tracks = {}
+    for path, track in zip(noise_paths, tracks):
+        name = get_short_noise_source_name(path)
+        if track is not None or name not in name_tracks:
+            name_tracks[name] = track
+    new_names = [get_short_noise_source_name(name_tracks[name]['path']) if name_tracks.get(name) is not None
+                 else name for name in old_names]
+    codes, names = encode(new_names)
+    sources = table.rows['noise_source']
+    table.rows['noise_source'] = np.where(sources == UNKNOWN, UNKNOWN, codes[sources] if len(codes) else UNKNOWN)
+    table.categories['noise_source'] = names
+    resolved = {}
+    for old_name, new_name in zip(old_names, new_names):
+        if resolved.get(new_name) is None:
+            resolved[new_name] = name_tracks.get(old_name)
+    return [resolved[name] for name in names]
+
+
+def parse_spk2gender(filepath, table):
+    """Set the gender column of a table from the spk2gender of the data directory."""
+    spk2gender = {}
+    with open(filepath, 'r') as f:
+        for line in f:
+            speaker, gender = line.strip().split()
+            spk2gender[speaker] = gender
+    genders = [spk2gender.get(uttId[:3]) for uttId in table.rows['utt_id']]
+    codes, names = encode(sorted(set(gender for gender in genders if gender is not None)))
+    index = dict(zip(names, codes))
+    table.rows['gender'] = [index.get(gender, UNKNOWN) for gender in genders]
+    table.categories['gender'] = names
+    return table
@@ -0,0 +1,237 @@
+"""
+Score hypotheses against references without sclite.
+
+Reads sclite trn files (one utterance per line, the text followed by its id in
+parentheses, as written by score_sclite.sh), aligns every hypothesis to its
+reference with sclite's Levenshtein weights (substitution 4, insertion 3,
+deletion 3) and writes the per-utterance blocks of sclite's pralign output,
+which parse_result_txt() in results_table.py reads like a result.txt:
+
+    Speaker sentences   0:  4k0   #utts: 1
+    id: (4k0-4k0c0301)
+    Scores: (#C #S #D #I) 3 1 0 1
+    REF:  the * QUICK brown fox
+    HYP:  the A QUACK brown fox
+    Eval:     I S
+
+Correct tokens are printed in lower case and errors in upper case, and tokens
+are compared case insensitively, as sclite does by default. The dynamic
+programming runs on batches of utterances of similar lengths at once: each row
+of the cost matrix is computed for the whole batch with NumPy, the insertion
+recurrence within a row as a cumulative minimum, and the alignments of the batch
+are traced back together.
+
+The hand written results of test/golden are a regression test only; the
+pralign output is compared with sclite's by running test/scorer_golden_test.sh
+on espnet decode directories.
+
+usage: scorer.py [-h] [--unit {word,char}] [--output path] ref hyp
+
+i.e. `scorer.py decode_dir/ref.wrd.trn decode_dir/hyp.wrd.trn --output result.wrd.txt`
+"""
+import re
+import sys
+import argparse
+import numpy as np
+
+
+CORRECT, SUBSTITUTION, DELETION, INSERTION = range(4)
+SUBSTITUTION_COST = 4
+INSERTION_COST = 3
+DELETION_COST = 3
+EVAL_LABELS = ('', 'S', 'D', 'I')
+SPACE = '<space>'       # Word boundary token of the char level trn files of espnet
+BATCH_CELLS = 2 ** 22   # Cells of the backpointer matrices of one batch
+
+TRN_LINE_RE = re.compile(r'^(.*?)\s*\(([^()\s]+)\)\s*$')
+
+
+def read_trn(filepath):
+    """Utterance ids and texts of a trn file, in file order."""
+    ids = []
+    texts = []
+    with open(filepath, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            match = TRN_LINE_RE.match(line)
+            if match is None:
+                raise ValueError('No utterance id in trn line: {}'.format(line.strip()))
+            texts.append(match.group(1))
+            ids.append(match.group(2))
+    return ids, texts
+
+
+def tokenize(text, unit='word'):
+    """Tokens of a text: its words, or its characters with SPACE between words."""
+    words = text.split()
+    if unit == 'word':
+        return words
+    tokens = []
+    for word in words:
+        if tokens:
+            tokens.append(SPACE)
+        tokens.extend(word)
+    return tokens
+
+
+def encode_batch(sequences, vocabulary, pad):
+    """Token sequences as a padded integer matrix, adding new tokens to the vocabulary."""
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    codes = np.full((len(sequences), max(lengths.max(initial=0), 1)), pad, dtype=np.int32)
+    for row, sequence in enumerate(sequences):
+        codes[row, :len(sequence)] = [vocabulary.setdefault(token.lower(), len(vocabulary)) for token in sequence]
+    return codes, lengths
+
+
+def align_batch(refs, hyps, vocabulary):
+    """
+    Minimum cost alignments of a batch of token sequences. Returns for every pair the list of
+    edit operations from the first token on. On equal costs a correct or substituted pair is
+    preferred over a deletion, and a deletion over an insertion.
+    """
+    ref, ref_lengths = encode_batch(refs, vocabulary, -1)
+    hyp, hyp_lengths = encode_batch(hyps, vocabulary, -2)     # Pads never match each other
+    nbatch, nref = ref.shape
+    nhyp = hyp.shape[1]
+    columns = np.arange(nhyp + 1, dtype=np.int32) * INSERTION_COST
+
+    ops = np.empty((nbatch, nref + 1, nhyp + 1), dtype=np.int8)
+    ops[:, 0, :] = INSERTION
+    cost = np.broadcast_to(columns, (nbatch, nhyp + 1)).copy()
+    for i in range(1, nref + 1):
+        match = ref[:, i - 1, None] == hyp
+        mismatch = ~match
+        diagonal = cost[:, :-1] + mismatch * np.int32(SUBSTITUTION_COST)
+        deletion = cost[:, 1:] + DELETION_COST
+        best = np.empty_like(cost)
+        best[:, 0] = cost[:, 0] + DELETION_COST
+        best[:, 1:] = np.minimum(diagonal, deletion)
+        # Insertions chain along the row: cost[j] = min over k <= j of best[k] + (j - k) * INSERTION_COST
+        cost = np.minimum.accumulate(best - columns, axis=1) + columns
+        row = ops[:, i, :]
+        row[:, 0] = DELETION
+        row[:, 1:] = np.where(diagonal <= deletion, mismatch, DELETION)     # CORRECT is 0 and SUBSTITUTION 1
+        np.copyto(row, INSERTION, where=cost < best)
+
+    # Trace every alignment back from its end at once, recording the operations in reverse
+    i = ref_lengths.copy()
+    j = hyp_lengths.copy()
+    batch = np.arange(nbatch)
+    trace = np.full((nbatch, nref + nhyp), -1, dtype=np.int8)
+    for step in range(nref + nhyp):
+        active = (i > 0) | (j > 0)
+        if not active.any():
+            break
+        op = ops[batch, i, j]
+        op[~active] = -1
+        trace[:, step] = op
+        i -= (op == CORRECT) | (op == SUBSTITUTION) | (op == DELETION)
+        j -= (op == CORRECT) | (op == SUBSTITUTION) | (op == INSERTION)
+    return [row[row >= 0][::-1] for row in trace]
+
+
+def align(refs, hyps, batch_cells=BATCH_CELLS):
+    """
+    Alignments of every pair of reference and hypothesis token sequences, as arrays of edit
+    operations. Pairs are batched by length so the padded matrices of a batch stay small.
+    """
+    vocabulary = {}
+    alignments = [None] * len(refs)
+    order = np.argsort([len(ref) * len(hyp) for ref, hyp in zip(refs, hyps)], kind='stable')
+    first = 0
+    while first < len(order):
+        last = first + 1
+        nref = len(refs[order[first]])
+        nhyp = len(hyps[order[first]])
+        while last < len(order):
+            nref = max(nref, len(refs[order[last]]))
+            nhyp = max(nhyp, len(hyps[order[last]]))
+            if (last - first + 1) * (nref + 1) * (nhyp + 1) > batch_cells:
+                break
+            last += 1
+        batch = order[first:last]
+        for index, alignment in zip(batch, align_batch([refs[k] for k in batch], [hyps[k] for k in batch],
+                                                       vocabulary)):
+            alignments[index] = alignment
+        first = last
+    return alignments
+
+
+def count_scores(alignment):
+    """#C #S #D #I of an alignment."""
+    return np.bincount(alignment, minlength=4)
+
+
+def str_alignment(utt_id, ref, hyp, alignment):
+    """The pralign block of one utterance."""
+    ref_columns = []
+    hyp_columns = []
+    eval_columns = []
+    r = 0
+    h = 0
+    for op in alignment:
+        ref_token = ref[r] if op != INSERTION else None
+        hyp_token = hyp[h] if op != DELETION else None
+        width = max(len(token) for token in (ref_token, hyp_token) if token is not None)
+        case = str.lower if op == CORRECT else str.upper
+        ref_columns.append(case(ref_token).ljust(width) if ref_token is not None else '*' * width)
+        hyp_columns.append(case(hyp_token).ljust(width) if hyp_token is not None else '*' * width)
+        eval_columns.append(EVAL_LABELS[op].ljust(width))
+        r += op != INSERTION
+        h += op != DELETION
+    res = 'id: ({})\n'.format(utt_id)
+    res += 'Scores: (#C #S #D #I) {} {} {} {}\n'.format(*count_scores(alignment))
+    res += 'REF:  {}\n'.format(' '.join(ref_columns))
+    res += 'HYP:  {}\n'.format(' '.join(hyp_columns))
+    res += 'Eval: {}'.format(' '.join(eval_columns)).rstrip() + '\n'
+    return res
+
+
+def score(ref_path, hyp_path, unit='word'):
+    """
+    Align the hypotheses of a hyp trn to the references of a ref trn. Returns the utterance ids in
+    reference order, their reference and hypothesis tokens and their alignments. A hypothesis
+    missing from the hyp trn is scored as empty.
+    """
+    ids, ref_texts = read_trn(ref_path)
+    hyp_ids, hyp_texts = read_trn(hyp_path)
+    hyp_texts = dict(zip(hyp_ids, hyp_texts))
+    refs = [tokenize(text, unit) for text in ref_texts]
+    hyps = [tokenize(hyp_texts.get(utt_id, ''), unit) for utt_id in ids]
+    return ids, refs, hyps, align(refs, hyps)
+
+
+def write_result(f, ids, refs, hyps, alignments):
+    """Write the pralign blocks of every utterance, grouped by speaker in sorted order as sclite does."""
+    speakers = {}
+    for index, utt_id in enumerate(ids):
+        speakers.setdefault(utt_id.split('-')[0], []).append(index)
+    for number, speaker in enumerate(sorted(speakers)):
+        indices = speakers[speaker]
+        f.write('\n\nSpeaker sentences {:3d}:  {}   #utts: {}\n'.format(number, speaker, len(indices)))
+        for index in indices:
+            f.write(str_alignment(ids[index], refs[index], hyps[index], alignments[index]))
+            f.write('\n')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Align hypotheses to references and write the per-utterance \
+            scores and alignments in the format of an sclite result.txt.')
+    parser.add_argument('ref', type=str,
+            help='Reference trn, i.e. ref.wrd.trn of a decode directory.')
+    parser.add_argument('hyp', type=str,
+            help='Hypothesis trn, i.e. hyp.wrd.trn of a decode directory.')
+    parser.add_argument('--unit', type=str, choices=['word', 'char'], default='word',
+            help='Score the whitespace separated tokens of the trn (word, the default), or split every word \
+                    into characters with {} between words (char).'.format(SPACE))
+    parser.add_argument('--output', type=str, metavar='path',
+            help='Write the result to this file instead of stdout.')
+    args = parser.parse_args()
+
+    ids, refs, hyps, alignments = score(args.ref, args.hyp, args.unit)
+    output = open(args.output, 'w') if args.output is not None else sys.stdout
+    write_result(output, ids, refs, hyps, alignments)
+    if args.output is not None:
+        output.close()
@@ -1,11 +1,12 @@
 import os
 import sys
-import re
+import json
 import argparse
-import ast
-from scipy.stats import iqr     # statistics doesnt include quantiles until python 3.8
-from statistics import mean, median, variance
-from copy import deepcopy
+from results_table import UNKNOWN, noise_map_path, read_noise_utt_map, noise_catalog_paths, resolve_noise_sources
+from stats import BOOTSTRAP_REPLICATES, CONFIDENCE, describe, error_rate_ci
+from results_cache import RESULTS_CACHE_DIR, fingerprints, cached_table
+
+STAMP_FILE = '.sort_results_inputs'     # Fingerprints of the inputs the reports of an output directory were written from
 
 
 def dir_path(string):
@@ -25,140 +26,114 @@ parser.add_argument('testSet', type=str,
 parser.add_argument('--output-dir', type=str, metavar='path',
         help='Place to put the sorted results. If not specified, the results will be placed in the current \
                 directory.')
+parser.add_argument('--bootstrap', type=int, metavar='N', default=BOOTSTRAP_REPLICATES,
+        help='Bootstrap replicates of the error rate confidence intervals. Default is {}'.format(BOOTSTRAP_REPLICATES))
+parser.add_argument('--cache', type=str, metavar='path', default=RESULTS_CACHE_DIR,
+        help='Directory of the parsed results cache. Default is {}'.format(RESULTS_CACHE_DIR))
+parser.add_argument('--no-cache', action='store_true',
+        help='Parse the result file and rewrite the reports even if the inputs did not change.')
+
+
+def summarize_results(table, field, nboot=BOOTSTRAP_REPLICATES):
+    """
+    Descriptive statistics of the scores and the error rate with its bootstrap confidence interval of
+    every category of a column of the table, as arrays indexed by category code.
+    """
+    codes = table.rows[field]
+    known = codes != UNKNOWN
+    ncategories = len(table.categories[field])
+    scores = table.scores()[known]
+    summary = describe(scores, codes[known], ncategories)
+    summary['error_rate'], summary['ci_low'], summary['ci_high'] = error_rate_ci(scores, codes[known], ncategories,
+                                                                                 nboot)
+    return summary
+
+
+def str_scores(summary, code):
+    res = ''
+    res += 'Number of utterances: {}\n'.format(summary['count'][code])
+    res += 'Sum | Correct: {:.0f}\t\tSubstitution: {:.0f}\t\tDeletion: {:.0f}\t\tInsertion: {:.0f}\n'.format(
+            *summary['sum'][code])
+    for label, statistic in (('Avg', 'mean'), ('Med', 'median'), ('Var', 'variance'), ('IQR', 'iqr')):
+        res += '{} | Correct: {:.3f}\t\tSubstitution: {:.3f}\t\tDeletion: {:.3f}\t\tInsertion: {:.3f}\n'.format(
+                label, *summary[statistic][code])
+    res += 'Err | Rate: {:.4f}\t\t{:.0%} CI: {:.4f} - {:.4f}\n'.format(
+            summary['error_rate'][code], CONFIDENCE, summary['ci_low'][code], summary['ci_high'][code])
+    return res
 
 
-def get_short_noise_source_name(path):
-    source_file = os.path.splitext(os.path.basename(path))[0]
-    source_dir = os.path.basename(os.path.dirname(path))
-    return '{}__{}'.format(source_dir, source_file)
-
-
-def parse_noise_utt_map(filepath, results={}, basepath=None):
-    sorted_results = {}
-    with open(filepath, 'r') as f:
-        file_list_line = next(f).strip()
-        file_list = ast.literal_eval(file_list_line)
-        if basepath is not None:
-            file_list = [file_.replace(basepath, '') for file_ in file_list]
-        for line in f:
-            uttId, noise_idx = line.split()
-            noise_idx = int(noise_idx)
-            noise_source = file_list[noise_idx]
-            short_noise_source = get_short_noise_source_name(noise_source)
-            results[uttId]['noise_source'] = noise_source
-            results[uttId]['shortened_noise_source'] = short_noise_source
-            if short_noise_source not in sorted_results:
-                sorted_results[short_noise_source] = {}
-            sorted_results[short_noise_source][uttId] = results[uttId]
-    return results, sorted_results
-
-
-def parse_spk2gender(filepath, results={}):
-    sorted_results = {}
-    spk2gender = {}
-    with open(filepath, 'r') as f:
-        for line in f:
-            speaker, gender = line.strip().split()
-            spk2gender[speaker] = gender
-    for uttId in results:
-        gender = spk2gender[uttId[:3]]
-        results[uttId]['gender'] = gender
-        if gender not in sorted_results:
-            sorted_results[gender] = {}
-        sorted_results[gender][uttId] = results[uttId]
-    return results, sorted_results
-
-
-def parse_result_txt(filepath, results={}):
-    sorted_results = {}
-    with open(filepath, 'r') as f:
-        while True:
-            try:
-                line = next(f)
-                if line[:3] == 'id:':
-                    match = re.search('^id: \(([\d\w]+)-([\d\w]+)\)', line)
-                    speaker = match.group(1)
-                    uttId = match.group(2)
-                    results[uttId] = {'speaker': speaker}
-
-                    Scores_line = next(f)
-                    match = re.search('^Scores: \(#C #S #D #I\) (\d+) (\d+) (\d+) (\d+)', Scores_line)
-                    results[uttId]['scores'] = {'correct': match.group(1),
-                                               'substitution': match.group(2),
-                                               'deletion': match.group(3),
-                                               'insertion': match.group(4)}
-
-                    REF_line = next(f)
-                    # ref = re.search('^REF:  (.+)', REF_line).group(1).strip()
-                    results[uttId]['reference'] = REF_line[6:].strip()
-
-                    HYP_line = next(f)
-                    # hyp = re.search('^HYP:  (.+)', HYP_line).group(1).strip()
-                    results[uttId]['hypothesis'] = HYP_line[6:].strip()
-
-                    Eval_line = next(f)
-                    # eval = re.search('^Eval: (.+)', Eval_line).group(1).strip()
-                    results[uttId]['evaluation'] = Eval_line[6:].strip()
-
-                    results[uttId]['original_output'] = '{}{}{}{}{}\n'.format(line, Scores_line,
-                            REF_line, HYP_line, Eval_line)
-
-                    if speaker not in sorted_results:
-                        sorted_results[speaker] = {}
-                    sorted_results[speaker][uttId] = results[uttId]
-
-            except StopIteration:
-                break
-
-    return results, sorted_results
-
-
-def summarize_results(results):
-    _scores = {'correct': [],
-               'substitution': [],
-               'deletion': [],
-               'insertion': []}
-    scores = {category: deepcopy(_scores) for category in results.keys()}
-    for category in results.keys():
-        for utterance in results[category]:
-            this_scores = results[category][utterance]['scores']
-            for typ in this_scores.keys():
-                scores[category][typ].append(int(this_scores[typ]))
-    return scores
-
-
-def str_scores(scores):
+def str_track(track):
+    """Description of a noise catalog track."""
     res = ''
-    n = len(scores['correct'])  # All fields SHOULD be the same length
-    res += 'Number of utterances: {}\n'.format(n)
-    res += 'Sum | Correct: {}\t\tSubstitution: {}\t\tDeletion: {}\t\tInsertion: {}\n'.format(
-            sum(scores['correct']), sum(scores['substitution']), sum(scores['deletion']), sum(scores['insertion']))
-    res += 'Avg | Correct: {:.3f}\t\tSubstitution: {:.3f}\t\tDeletion: {:.3f}\t\tInsertion: {:.3f}\n'.format(
-            mean(scores['correct']), mean(scores['substitution']), mean(scores['deletion']), mean(scores['insertion']))
-    res += 'Med | Correct: {:.3f}\t\tSubstitution: {:.3f}\t\tDeletion: {:.3f}\t\tInsertion: {:.3f}\n'.format(
-            median(scores['correct']), median(scores['substitution']), median(scores['deletion']), median(scores['insertion']))
-    res += 'Var | Correct: {:.3f}\t\tSubstitution: {:.3f}\t\tDeletion: {:.3f}\t\tInsertion: {:.3f}\n'.format(
-            variance(scores['correct']), variance(scores['substitution']), variance(scores['deletion']), variance(scores['insertion']))
-    res += 'IQR | Correct: {:.3f}\t\tSubstitution: {:.3f}\t\tDeletion: {:.3f}\t\tInsertion: {:.3f}\n'.format(
-            iqr(scores['correct']), iqr(scores['substitution']), iqr(scores['deletion']), iqr(scores['insertion']))
+    res += 'Noise source: {} (catalog id {})\n'.format(track['path'], track['id'])
+    res += 'Duration: {} s\t\tRate: {} Hz\t\tChannels: {}\n'.format(
+            '-' if track['duration'] is None else '{:.3f}'.format(track['duration']), track['srate'] or '-',
+            track['channels'] or '-')
+    for key, value in sorted(track['info'].items()):
+        res += '{}: {}\n'.format(key.capitalize(), value)
     return res
 
 
-def write_results(results, output_dir):
-    scores = summarize_results(results)
-    for category in results.keys():
+def write_results(table, field, output_dir, nboot=BOOTSTRAP_REPLICATES, tracks=None):
+    """Write the report of every category of field. tracks are the catalog tracks of the categories, if any."""
+    summary = summarize_results(table, field, nboot)
+    codes = {name: code for code, name in enumerate(table.categories[field])}
+    names, groups = table.groups(field)
+    original_outputs = table.original_outputs()
+    for category, indices in zip(names, groups):
         output_path = os.path.join(output_dir, category)
         if not os.path.isdir(output_path):
             os.mkdir(output_path)
         output_file = os.path.join(output_path, 'results.txt')
         with open(output_file, 'w') as f:
-            f.write(str_scores(scores[category]))
+            if tracks is not None and tracks[codes[category]] is not None:
+                f.write(str_track(tracks[codes[category]]))
+            f.write(str_scores(summary, codes[category]))
             f.write('\n\n')
-            for uttId in results[category]:
-                f.write(results[category][uttId]['original_output'])
+            for i in indices:
+                f.write(original_outputs[i])
                 f.write('\n')
 
 
+REPORTS = (('speaker', 'by_speaker'), ('noise_source', 'by_noise'), ('gender', 'by_gender'))
+
+
+def report_inputs(result_txt_path, noise_utt_map_path, spk2gender_path, nboot=BOOTSTRAP_REPLICATES):
+    """Fingerprints of the inputs of the reports of a result file, stored in the stamp of their output directory."""
+    # Noise sources are named after their tracks in the noise catalogs
+    noise_paths = read_noise_utt_map(noise_utt_map_path)[0] if os.path.isfile(noise_utt_map_path) else []
+    catalog_paths = sorted(set(path for path in noise_catalog_paths(noise_paths) if path is not None))
+    return {'inputs': fingerprints([result_txt_path, noise_utt_map_path, spk2gender_path] + catalog_paths),
+            'bootstrap': nboot}
+
+
+def reports_up_to_date(output_dir, inputs):
+    stamp_path = os.path.join(output_dir, STAMP_FILE)
+    if not os.path.isfile(stamp_path):
+        return False
+    with open(stamp_path, 'r') as f:
+        return json.load(f) == inputs
+
+
+def write_reports(results, output_dir, inputs, nboot=BOOTSTRAP_REPLICATES):
+    """
+    Write the reports by speaker, noise source and gender of a result table to output_dir, and the
+    stamp of their inputs. Groupings without categories (i.e. no spk2gender) are skipped.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    noise_tracks = resolve_noise_sources(results)
+    for field, dirname in REPORTS:
+        if not results.categories.get(field):
+            continue
+        report_dir = os.path.join(output_dir, dirname)
+        if not os.path.isdir(report_dir):
+            os.mkdir(report_dir)
+        write_results(results, field, report_dir, nboot, noise_tracks if field == 'noise_source' else None)
+    with open(os.path.join(output_dir, STAMP_FILE), 'w') as f:
+        json.dump(inputs, f)
+
+
 if __name__ == '__main__':
 
     args = parser.parse_args()
@@ -174,15 +149,9 @@ if __name__ == '__main__':
         result_txt_path = os.path.join(args.resultsDir, decode_result_dir(test_set), 'result.txt')
     elif args.type == 'word':
         result_txt_path = os.path.join(args.resultsDir, decode_result_dir(test_set), 'result.wrd.txt')
-    results, sorted_results_by_speaker = parse_result_txt(result_txt_path)
-
-    noise_utt_map_file = lambda s: '{}_noise_utt_map'.format(s)
-    noise_utt_map_path = os.path.join(args.resultsDir, noise_utt_map_file(test_set))
-    results, sorted_results_by_noise = parse_noise_utt_map(noise_utt_map_path, results)
-    
+    noise_utt_map_path = noise_map_path(args.resultsDir, test_set)
     spk2gender_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'espnet', 'egs',
             'wsj', 'asr1', 'data', test_set, 'spk2gender')
-    results, sorted_results_by_gender  = parse_spk2gender(spk2gender_path, results)
 
     if args.output_dir is None:
         output_dir = '.'
@@ -190,19 +159,12 @@ if __name__ == '__main__':
         output_dir = args.output_dir
         if not os.path.exists(output_dir):
             os.mkdir(output_dir)
-    
-    speaker_dir = os.path.join(output_dir, 'by_speaker')
-    if not os.path.isdir(speaker_dir):
-        os.mkdir(speaker_dir)
-    write_results(sorted_results_by_speaker, speaker_dir)
-
-    noise_dir = os.path.join(output_dir, 'by_noise')
-    if not os.path.isdir(noise_dir):
-        os.mkdir(noise_dir)
-    write_results(sorted_results_by_noise, noise_dir)
-
-    gender_dir = os.path.join(output_dir, 'by_gender')
-    if not os.path.isdir(gender_dir):
-        os.mkdir(gender_dir)
-    write_results(sorted_results_by_gender, gender_dir)
 
+    # The reports only depend on the inputs, skip rewriting them when none changed since the last run
+    inputs = report_inputs(result_txt_path, noise_utt_map_path, spk2gender_path, args.bootstrap)
+    if not args.no_cache and reports_up_to_date(output_dir, inputs):
+        print('Results of {} are up to date in {}'.format(result_txt_path, output_dir), file=sys.stderr)
+        sys.exit(0)
+    results, _ = cached_table(result_txt_path, noise_utt_map_path, spk2gender_path,
+                              None if args.no_cache else args.cache)
+    write_reports(results, output_dir, inputs, args.bootstrap)
@@ -0,0 +1,171 @@
+"""
+Vectorized statistics of per-utterance sclite scores.
+
+Scores are an integer matrix with a row per utterance and a column per score
+type (C/S/D/I), and groups are integer category codes as in results_table.py.
+Descriptive statistics of every group and column are computed in one pass over
+the matrix sorted by group. Error rate confidence intervals and paired
+significance tests resample utterances with replacement within each group
+(utterance-level bootstrap); replicates are drawn as batches of index arrays so
+no Python loop runs per replicate or per group.
+"""
+import warnings
+import numpy as np
+
+
+BOOTSTRAP_REPLICATES = 1000
+BOOTSTRAP_SEED = 0          # Fixed so reports are reproducible
+BOOTSTRAP_BATCH = 2 ** 22   # Elements of the resampled array held in memory at once
+CONFIDENCE = 0.95
+
+
+def group_bounds(codes, ngroups):
+    """Order sorting codes into groups, the number of rows of every group and the offset of its first row."""
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=ngroups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    return order, counts, starts
+
+
+def sorted_sums(values, counts, starts):
+    """Column sums of every group of values sorted by group, shape (groups, columns)."""
+    sums = np.zeros((len(counts), values.shape[1]))
+    nonempty = counts > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, starts[nonempty], axis=0)
+    return sums
+
+
+def sorted_quantile(values, counts, starts, q):
+    """Quantile q (linear interpolation) of the groups of values, sorted within each group. NaN if empty."""
+    pos = q * np.maximum(counts - 1, 0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    last = max(len(values) - 1, 0)
+    lo_values = values[np.minimum(starts + lo, last)] if len(values) else np.zeros((len(counts),) + values.shape[1:])
+    hi_values = values[np.minimum(starts + hi, last)] if len(values) else lo_values
+    frac = (pos - lo).reshape((-1,) + (1,) * (values.ndim - 1))
+    res = lo_values + frac * (hi_values - lo_values)
+    res[counts == 0] = np.nan
+    return res
+
+
+def describe(scores, codes, ngroups):
+    """
+    Descriptive statistics of every column of scores for every group, as a dict of (ngroups, columns)
+    arrays: count, sum, mean, median, variance (sample) and iqr. Statistics that are undefined for
+    a group (i.e. the variance of one utterance) are NaN.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if scores.ndim == 1:
+        scores = scores[:, None]
+    codes = np.asarray(codes, dtype=np.int64)
+    order, counts, starts = group_bounds(codes, ngroups)
+    scores = scores[order]
+    codes = codes[order]
+
+    sums = sorted_sums(scores, counts, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts[:, None]
+        variances = sorted_sums((scores - means[codes]) ** 2, counts, starts) / (counts[:, None] - 1)
+    variances[counts < 2] = np.nan
+
+    # Sort every column within its group: the groups are contiguous, so sorting by (code, value) suffices
+    within = np.lexsort((scores, np.broadcast_to(codes[:, None], scores.shape)), axis=0)
+    ranked = np.take_along_axis(scores, within, axis=0)
+    median = sorted_quantile(ranked, counts, starts, 0.5)
+    iqr = sorted_quantile(ranked, counts, starts, 0.75) - sorted_quantile(ranked, counts, starts, 0.25)
+
+    return {'count': counts, 'sum': sums, 'mean': means, 'median': median, 'variance': variances, 'iqr': iqr}
+
+
+def errors_and_references(scores):
+    """Errors (S + D + I) and reference lengths (C + S + D) of every row of a C/S/D/I score matrix."""
+    correct, substitution, deletion, insertion = np.asarray(scores, dtype=np.float64).T
+    return substitution + deletion + insertion, correct + substitution + deletion
+
+
+def error_rate(errors, references):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return errors / references
+
+
+def bootstrap_sums(values, codes, ngroups, nboot=BOOTSTRAP_REPLICATES, seed=BOOTSTRAP_SEED,
+                   batch_size=BOOTSTRAP_BATCH):
+    """
+    Column sums of values over the rows of every group resampled with replacement, for nboot
+    replicates. Rows are only resampled within their own group. Returns an (nboot, ngroups, columns)
+    array. Replicates are drawn in batches of at most batch_size resampled elements.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    codes = np.asarray(codes, dtype=np.int64)
+    order, counts, starts = group_bounds(codes, ngroups)
+    values = values[order]
+    codes = codes[order]
+    nrows, ncolumns = values.shape
+    sums = np.zeros((nboot, ngroups, ncolumns))
+    if nrows == 0:
+        return sums
+    nonempty = counts > 0
+    # Every row of a group is replaced by a random row of the same group
+    row_starts = starts[codes]
+    row_counts = counts[codes]
+    rng = np.random.default_rng(seed)
+    replicates_per_batch = max(1, batch_size // (nrows * ncolumns))
+    for first in range(0, nboot, replicates_per_batch):
+        n = min(replicates_per_batch, nboot - first)
+        indices = row_starts + rng.integers(0, row_counts, size=(n, nrows))
+        batch = np.add.reduceat(values[indices], starts[nonempty], axis=1)
+        sums[first:first + n, nonempty] = batch
+    return sums
+
+
+def confidence_interval(replicates, confidence=CONFIDENCE):
+    """Percentile interval of bootstrap replicates along the first axis, ignoring undefined (NaN) replicates."""
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)     # Groups without any defined replicate are NaN
+        low, high = np.nanquantile(replicates, [alpha, 1 - alpha], axis=0)
+    return low, high
+
+
+def error_rate_ci(scores, codes, ngroups, nboot=BOOTSTRAP_REPLICATES, confidence=CONFIDENCE, seed=BOOTSTRAP_SEED):
+    """
+    Error rate (WER or CER, depending on the units of the scores) of every group with a bootstrap
+    confidence interval. Returns the rates and the lower and upper bounds, each of shape (ngroups,).
+    """
+    errors, references = errors_and_references(scores)
+    codes = np.asarray(codes, dtype=np.int64)
+    rate = error_rate(np.bincount(codes, weights=errors, minlength=ngroups),
+                      np.bincount(codes, weights=references, minlength=ngroups))
+    sums = bootstrap_sums(np.column_stack([errors, references]), codes, ngroups, nboot, seed)
+    low, high = confidence_interval(error_rate(sums[..., 0], sums[..., 1]), confidence)
+    return rate, low, high
+
+
+def paired_bootstrap(scores_a, scores_b, codes, ngroups, nboot=BOOTSTRAP_REPLICATES, confidence=CONFIDENCE,
+                     seed=BOOTSTRAP_SEED):
+    """
+    Paired bootstrap test of the difference of error rates of two systems (or trials) scored on the
+    same utterances: row i of scores_a and scores_b must be the same utterance. Utterances are
+    resampled jointly within every group. Returns the difference B - A of every group, its confidence
+    interval and the two sided p-value of the difference being zero, each of shape (ngroups,).
+    """
+    errors_a, references_a = errors_and_references(scores_a)
+    errors_b, references_b = errors_and_references(scores_b)
+    codes = np.asarray(codes, dtype=np.int64)
+    columns = np.column_stack([errors_a, references_a, errors_b, references_b])
+    totals = np.stack([np.bincount(codes, weights=column, minlength=ngroups) for column in columns.T], axis=1)
+    delta = error_rate(totals[:, 2], totals[:, 3]) - error_rate(totals[:, 0], totals[:, 1])
+    sums = bootstrap_sums(columns, codes, ngroups, nboot, seed)
+    replicates = error_rate(sums[..., 2], sums[..., 3]) - error_rate(sums[..., 0], sums[..., 1])
+    low, high = confidence_interval(replicates, confidence)
+    with np.errstate(invalid='ignore'):
+        defined = np.maximum((~np.isnan(replicates)).sum(axis=0), 1)
+        below = (replicates <= 0).sum(axis=0) / defined
+        above = (replicates >= 0).sum(axis=0) / defined
+    p_value = np.minimum(1, 2 * np.minimum(below, above))
+    p_value[np.isnan(delta)] = np.nan
+    return delta, low, high, p_value
@@ -0,0 +1,69 @@
+# Mixes rendered by gen_mixes.py from the manifest of the numpy backend must match the mixes mix_wsj_noise.py
+# wrote. Synthetic 16 kHz speech is mixed with a 44.1 kHz stereo noise track, once to mix files and once
+# with --serve, whose wav.scp points at a daemon that is stopped before gen_mixes.py runs.
+OUT=$(realpath .)/gen_mixes
+MIX_WSJ_NOISE=$(realpath ../../wsj_asr1/local/mix_wsj_noise)
+
+set -e
+rm -rf $OUT
+mkdir -p $OUT/files $OUT/serve $OUT/noise/song
+
+python3 - $OUT <<EOF
+import os, sys, wave
+import numpy as np
+out = sys.argv[1]
+rng = np.random.default_rng(0)
+with wave.open(os.path.join(out, 'noise', 'song', 'track.wav'), 'wb') as w:
+    w.setnchannels(2)
+    w.setsampwidth(2)
+    w.setframerate(44100)
+    w.writeframes((rng.standard_normal((44100 * 8, 2)) * 3000).astype('<i2').tobytes())
+for data_dir in ('files', 'serve'):
+    with open(os.path.join(out, data_dir, 'wav.scp'), 'w') as scp, \
+            open(os.path.join(out, data_dir, 'utt2dur'), 'w') as utt2dur:
+        for i in range(3):
+            utt_id = 'utt{}'.format(i)
+            path = os.path.join(out, '{}.wav'.format(utt_id))
+            with wave.open(path, 'wb') as w:
+                w.setnchannels(1)
+                w.setsampwidth(2)
+                w.setframerate(16000)
+                w.writeframes((np.sin(np.arange(16000 * (i + 1)) * 0.05) * 8000).astype('<i2').tobytes())
+            scp.write('{} {}\n'.format(utt_id, path))
+            utt2dur.write('{} {}\n'.format(utt_id, i + 1))
+EOF
+
+mix_opts="--noise-ext wav --backend numpy --mix-snr 5 --mix-level 0 --noise-timestamp 1.5 --seed 0 --nj 1
+    --noise-cache $OUT/cache --level-cache $OUT/levels.sqlite"
+python3 $MIX_WSJ_NOISE/mix_wsj_noise.py $OUT/files $OUT/noise $mix_opts
+python3 $MIX_WSJ_NOISE/mix_wsj_noise.py $OUT/serve $OUT/noise $mix_opts --serve $OUT/mix.sock &
+while [ ! -S $OUT/mix.sock ]
+do
+    sleep 1
+done
+python3 -S $MIX_WSJ_NOISE/mix_client.py $OUT/mix.sock --shutdown
+wait
+
+for data_dir in files serve
+do
+    python3 ../gen_mixes.py $OUT/$data_dir/augmented_wav.scp --noise-cache $OUT/cache --nj 1 \
+        --output-dir $OUT/$data_dir-mixes
+done
+
+python3 - $OUT <<EOF
+import os, sys, glob, wave
+import numpy as np
+out = sys.argv[1]
+def samples(path):
+    with wave.open(path, 'rb') as w:
+        return np.frombuffer(w.readframes(w.getnframes()), dtype='<i2').astype(np.int32)
+for data_dir in ('files', 'serve'):
+    rendered = sorted(glob.glob(os.path.join(out, data_dir + '-mixes', '*.wav')))
+    assert len(rendered) == 3, rendered
+    for path in rendered:
+        utt_id = os.path.basename(path).split('__')[0]
+        reference = samples(os.path.join(out, 'files', 'augmented_wav', utt_id + '.wav'))
+        mix = samples(path)
+        assert len(mix) == len(reference) and np.max(np.abs(mix - reference)) <= 1, path
+    print('The {} mixes rendered from the manifest match those of mix_wsj_noise.py'.format(data_dir))
+EOF
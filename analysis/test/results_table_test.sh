@@ -0,0 +1,49 @@
+# The utterances of a result file must be parsed the same whether or not the file ends with a newline.
+# The result files of golden/ are copied with their trailing newlines stripped and parsed by
+# results_table.py next to the originals. Trials of the SIGSEP layout are then aggregated by
+# aggregate_results.py, which must group them by instrument.
+OUT=results_table
+RESULTS=${@:-golden/result.txt golden/result.wrd.txt}
+
+set -e
+mkdir -p $OUT
+
+for result in $RESULTS
+do
+    stripped=$OUT/$(basename $result)
+    python3 - $result $stripped <<EOF
+import sys
+data = open(sys.argv[1], 'rb').read().rstrip(b'\n')
+open(sys.argv[2], 'wb').write(data)
+EOF
+    python3 - $result $stripped <<EOF
+import sys
+sys.path.insert(0, '..')
+from results_table import SCORE_FIELDS, parse_result_txt
+original, stripped = [parse_result_txt(path) for path in sys.argv[1:]]
+assert len(original.rows) > 0, 'No utterance was parsed from {}'.format(sys.argv[1])
+assert len(stripped.rows) == len(original.rows), '{} of {} utterances parsed without the trailing newline'.format(
+    len(stripped.rows), len(original.rows))
+for field in ('utt_id',) + SCORE_FIELDS:
+    assert (stripped.rows[field] == original.rows[field]).all(), '{} differs'.format(field)
+assert stripped.original_outputs() == original.original_outputs()
+print('{}: {} utterances match without the trailing newline'.format(sys.argv[1], len(stripped.rows)))
+EOF
+done
+
+# The trials of the SIGSEP layout DATASET_DIR/$instrument/results-* are grouped by their instrument
+for instrument in bass drums
+do
+    decode_dir=$OUT/SIGSEP/$instrument/results-mix-snr10-lv0-start15/decode_test_dev93_decode_lm_word65000
+    mkdir -p $decode_dir
+    cp golden/result.txt $decode_dir/result.txt
+done
+python3 ../aggregate_results.py $OUT/SIGSEP --layout instrument --by instrument,song --unit char --test-set dev \
+    --spk2gender-dir $OUT --no-cache --nj 1 --output $OUT/SIGSEP.tsv
+cat $OUT/SIGSEP.tsv
+python3 - $OUT/SIGSEP.tsv <<EOF
+import sys
+rows = [line.rstrip('\n').split('\t') for line in open(sys.argv[1]) if line.strip()][1:]
+assert [row[:3] for row in rows] == [['bass', '', '6'], ['drums', '', '6']], rows
+print('The SIGSEP trials are grouped by instrument')
+EOF
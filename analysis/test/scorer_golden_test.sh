@@ -0,0 +1,29 @@
+# Per-utterance scores of scorer.py must match the result.txt / result.wrd.txt next to the trn files.
+# Without arguments the trn files of golden/ are scored against golden/result*.txt. Those were written
+# and checked by hand, not by sclite, so they are only a regression test of scorer.py. Parity with
+# sclite is checked by giving espnet decode directories (written by score_sclite.sh --wer true, i.e.
+# exp/*/decode_test_dev93_decode_lm_word65000): the char and word trn files of each are rescored and
+# compared with the result files sclite wrote there.
+OUT=scorer_golden
+DECODE_DIRS=${@:-golden}
+
+set -e
+mkdir -p $OUT
+
+python3 ../scorer.py --help
+
+# "id Scores" of every utterance of a result file, sorted
+scores() {
+    grep -E '^(id|Scores):' $1 | paste -d ' ' - - | sort
+}
+
+for dir in $DECODE_DIRS
+do
+    for unit in "" ".wrd"
+    do
+        result=$OUT/$(basename $dir)-result$unit.txt
+        time python3 ../scorer.py $dir/ref$unit.trn $dir/hyp$unit.trn --output $result
+        diff <(scores $dir/result$unit.txt) <(scores $result)
+        echo "$dir/result$unit.txt: $(scores $result | wc -l) utterances match"
+    done
+done
@@ -0,0 +1,389 @@
+"""
+Benchmarks of the mixing and analysis hot paths on synthetic WSJ-like data.
+
+A work directory is filled with a synthetic test set (speech-like utterances of
+a few speakers, half of them SPHERE files read through `sph2pipe` entries and
+half wave files, with wav.scp, utt2dur and spk2gender), music-like noise tracks
+and the sclite result.txt of synthetic references and hypotheses, all from one
+seed. Then each benchmark is timed --repeat times:
+
+    mix_wsj_noise.main     numpy backend, materialized, one condition
+    levels.analyze         peak and active speech level of every utterance
+    gen_mixes.generate     listening mixes rendered from a mix manifest
+    scorer.score           char level alignment of the references and hypotheses
+    sort_results.parse     result.txt, manifest and spk2gender into a ResultTable
+    sort_results.summarize statistics and bootstrap CIs by speaker, noise and gender
+    sort_results.write     the reports of the three groupings
+
+Nothing needs sox, sph2pipe, Kaldi or a network: noise tracks are decoded into
+the work directory's noise cache before timing. The best and median times are
+appended to a JSON history with the scale, host and commit, and a benchmark
+whose best time is more than --threshold times the best of the last run with
+the same scale on the same host is reported as a regression (exit code 1).
+The history is local to the host, so it is kept in the cache directory of
+mix_wsj_noise.py ($MIX_WSJ_NOISE_CACHE) rather than in the repository.
+
+usage: benchmark.py [-h] [--utterances N] [--seconds s] [--speakers N]
+                    [--noise-tracks N] [--noise-seconds s] [--repeat N] [--nj N]
+                    [--seed N] [--only name [name ...]] [--work-dir path]
+                    [--history path] [--threshold x]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'analysis'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'wsj_asr1', 'local', 'mix_wsj_noise'))
+import mix_wsj_noise
+import gen_mixes
+import scorer
+from mix_engine import read_wav, write_wav, quantize
+from levels import read_wavscp, analyze_entries
+from noise_cache import load_noise
+from level_cache import CACHE_DIR
+from manifest import manifest_name, write_manifest_header, write_manifest_record
+from results_cache import cached_table
+from sort_results import summarize_results, write_results
+
+
+HISTORY_PATH = os.path.join(CACHE_DIR, 'benchmark_history.json')
+SRATE = 16000
+BITDEPTH = 16
+MIX_SNR = 15
+NOISE_START = 15
+THRESHOLD = 1.2         # Best time relative to the last run above which a benchmark has regressed
+VOCABULARY_SIZE = 2000
+GROUPINGS = ('speaker', 'noise_source', 'gender')
+TEST_SET = 'test_dev93'
+RESULTS_DIR = 'results-mix-snr{}-lv0-start{}'.format(MIX_SNR, NOISE_START)
+DECODE_DIR = 'decode_{}_decode_lm_word65000'.format(TEST_SET)
+BENCHMARKS = ('mix_wsj_noise.main', 'levels.analyze', 'gen_mixes.generate', 'scorer.score', 'sort_results.parse',
+              'sort_results.summarize', 'sort_results.write')
+
+
+def write_sphere(path, pcm, srate):
+    """Write 16 bit PCM samples as an uncompressed SPHERE file."""
+    fields = 'sample_count -i {}\nsample_n_bytes -i 2\nchannel_count -i 1\nsample_byte_format -s2 01\n' \
+             'sample_rate -i {}\nsample_coding -s3 pcm\nend_head\n'.format(len(pcm), srate)
+    header = 'NIST_1A\n   1024\n{}'.format(fields).encode('ascii')
+    with open(path, 'wb') as f:
+        f.write(header.ljust(1024, b' '))
+        f.write(pcm.astype('<i2').tobytes())
+
+
+def synth_speech(rng, seconds, f0, srate=SRATE):
+    """
+    Speech-like samples: a harmonic source with a wandering pitch around f0 and a little breath
+    noise, gated into syllables and pauses, peak normalized to a random level.
+    """
+    n = int(seconds * srate)
+    t = np.arange(n) / srate
+    pitch = f0 * (1 + 0.1 * np.sin(2 * np.pi * rng.uniform(0.3, 1) * t + rng.uniform(0, 2 * np.pi)))
+    phase = 2 * np.pi * np.cumsum(pitch) / srate
+    weights = rng.uniform(0.2, 1, 12) / np.arange(1, 13)
+    source = sum(weight * np.sin((k + 1) * phase) for k, weight in enumerate(weights))
+    source += 0.05 * rng.standard_normal(n)
+    # 60 ms syllable slots, voiced with probability 0.7, smoothed by a 30 ms moving average
+    slot = int(0.06 * srate)
+    width = int(0.03 * srate)
+    gate = np.repeat(rng.random(n // slot + 2) < 0.7, slot)[:n + width].astype(np.float64)
+    cumulative = np.concatenate([[0], np.cumsum(gate)])
+    envelope = (cumulative[width:width + n] - cumulative[:n]) / width
+    speech = source * envelope
+    peak = np.max(np.abs(speech))
+    return (speech / peak if peak else speech) * 10 ** (rng.uniform(-12, -1) / 20)
+
+
+def synth_music(rng, seconds, srate=SRATE):
+    """Music-like samples: a chord changing every half second over pink-ish noise, peak normalized."""
+    n = int(seconds * srate)
+    t = np.arange(n) / srate
+    notes = 110 * 2 ** (rng.integers(0, 36, size=(int(seconds * 2) + 1, 3)) / 12)
+    freqs = np.repeat(notes, srate // 2, axis=0)[:n]
+    music = np.sin(2 * np.pi * np.cumsum(freqs, axis=0) / srate).sum(axis=1) * (0.6 + 0.4 * np.sin(2 * np.pi * 2 * t))
+    noise = np.cumsum(rng.standard_normal(n))
+    noise -= np.convolve(noise, np.ones(64) / 64, mode='same')     # Remove the drift of the random walk
+    music += 0.5 * noise / np.max(np.abs(noise))
+    return 0.9 * music / np.max(np.abs(music))
+
+
+def synth_text(rng, vocabulary, nwords, error_rate):
+    """A reference of Zipf distributed words and a hypothesis with substitutions, deletions and insertions."""
+    ranks = np.minimum(rng.zipf(1.3, nwords), len(vocabulary)) - 1
+    ref = [vocabulary[rank] for rank in ranks]
+    hyp = []
+    for word in ref:
+        draw = rng.random()
+        if draw < error_rate / 2:
+            hyp.append(vocabulary[rng.integers(len(vocabulary))])
+        elif draw < error_rate * 3 / 4:
+            continue
+        else:
+            hyp.append(word)
+            if draw > 1 - error_rate / 4:
+                hyp.append(vocabulary[rng.integers(len(vocabulary))])
+    return ' '.join(ref), ' '.join(hyp)
+
+
+def make_dataset(work_dir, utterances=200, seconds=6, speakers=10, noise_tracks=4, noise_seconds=60, seed=0):
+    """
+    Write the synthetic data set under work_dir: data/ (a Kaldi data directory), noise/song/*.wav and
+    the trn files of the hypotheses. Returns the paths the benchmarks use.
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(work_dir, 'data', TEST_SET)
+    audio_dir = os.path.join(work_dir, 'audio')
+    noise_dir = os.path.join(work_dir, 'noise', 'song')
+    for path in (data_dir, audio_dir, noise_dir):
+        os.makedirs(path)
+
+    speaker_ids = ['{:03x}'.format(0x400 + 17 * i)[-3:] for i in range(speakers)]
+    f0s = rng.uniform(90, 240, speakers)
+    with open(os.path.join(data_dir, 'spk2gender'), 'w') as f:
+        for speaker, f0 in zip(speaker_ids, f0s):
+            f.write('{} {}\n'.format(speaker, 'm' if f0 < 160 else 'f'))
+
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    vocabulary = [''.join(rng.choice(letters, rng.integers(2, 10))) for _ in range(VOCABULARY_SIZE)]
+    wavscp_f = open(os.path.join(data_dir, 'wav.scp'), 'w')
+    utt2dur_f = open(os.path.join(data_dir, 'utt2dur'), 'w')
+    ref_f = open(os.path.join(work_dir, 'ref.trn'), 'w')
+    hyp_f = open(os.path.join(work_dir, 'hyp.trn'), 'w')
+    total_seconds = 0
+    for i in range(utterances):
+        speaker = i % speakers
+        utt_id = '{}c{:04d}'.format(speaker_ids[speaker], i)
+        duration = max(1, rng.normal(seconds, seconds / 4))
+        pcm = quantize(synth_speech(rng, duration, f0s[speaker]))
+        if i % 2:
+            path = os.path.join(audio_dir, '{}.wv1'.format(utt_id))
+            write_sphere(path, pcm, SRATE)
+            wavscp_f.write('{} sph2pipe -f wav {} |\n'.format(utt_id, path))
+        else:
+            path = os.path.join(audio_dir, '{}.wav'.format(utt_id))
+            write_wav(path, pcm / np.float32(2 ** (BITDEPTH - 1)), SRATE)
+            wavscp_f.write('{} {}\n'.format(utt_id, path))
+        utt2dur_f.write('{} {:.4f}\n'.format(utt_id, len(pcm) / SRATE))
+        total_seconds += len(pcm) / SRATE
+        ref, hyp = synth_text(rng, vocabulary, max(1, int(duration * 2.5)), rng.uniform(0.05, 0.4))
+        ref_f.write('{} ({}-{})\n'.format(ref, speaker_ids[speaker], utt_id))
+        hyp_f.write('{} ({}-{})\n'.format(hyp, speaker_ids[speaker], utt_id))
+    for f in (wavscp_f, utt2dur_f, ref_f, hyp_f):
+        f.close()
+
+    noise_paths = []
+    for i in range(noise_tracks):
+        path = os.path.join(noise_dir, 'track{:02d}.wav'.format(i))
+        write_wav(path, synth_music(rng, noise_seconds).astype(np.float32), SRATE)
+        noise_paths.append(path)
+    return {'data_dir': data_dir, 'noise_dir': noise_dir, 'noise_paths': noise_paths,
+            'ref': os.path.join(work_dir, 'ref.trn'), 'hyp': os.path.join(work_dir, 'hyp.trn'),
+            'audio_seconds': total_seconds}
+
+
+def decode_wav(path, srate, nchannels):
+    """Stands in for the sox decode of the noise cache: the synthetic tracks are already 16 kHz mono wave files."""
+    return read_wav(path)[0]
+
+
+def write_listening_wavscp(dataset, wavscp_path, manifest_path):
+    """
+    A wav.scp of sox mix pipes and its manifest, as mix_wsj_noise.py writes for the sox backend,
+    with the noise gains of the numpy backend so gen_mixes scales every noise track by its peak.
+    """
+    rng = np.random.default_rng(1)
+    with open(os.path.join(dataset['data_dir'], 'utt2dur'), 'r') as f:
+        utt2dur = dict(line.split() for line in f)
+    wavscp_f = open(wavscp_path, 'w')
+    manifest_f = open(manifest_path, 'w')
+    write_manifest_header(manifest_f, dataset['noise_paths'], 'sox', 0,
+                          {'snr': MIX_SNR, 'mix_level': 0, 'start': NOISE_START})
+    for utt_id, scp_cmd in read_wavscp(os.path.join(dataset['data_dir'], 'wav.scp')):
+        noise = int(rng.integers(len(dataset['noise_paths'])))
+        wavscp_f.write('{} {} | sox -t wav - -p gain -n 0 | sox --combine mix -p "|sox {} -p trim {} {}" '
+                       '-t wav -b 16 -e signed-integer - gain -n 0 |\n'.format(
+                               utt_id, scp_cmd, dataset['noise_paths'][noise], NOISE_START, utt2dur[utt_id]))
+        write_manifest_record(manifest_f, {
+                'utt_id': utt_id, 'noise': noise, 'noise_start': NOISE_START, 'duration': float(utt2dur[utt_id]),
+                'speech': scp_cmd, 'speech_level': 0, 'speech_relative': False, 'noise_level': -MIX_SNR,
+                'noise_relative': False, 'mix_level': 0, 'speech_peak': None, 'speech_active': None})
+    wavscp_f.close()
+    manifest_f.close()
+
+
+def make_benchmarks(work_dir, dataset, nj=None):
+    """The benchmarks as name -> function, with the inputs they need prepared (untimed)."""
+    data_dir = dataset['data_dir']
+    noise_cache = os.path.join(work_dir, 'cache', 'noise')
+    for path in dataset['noise_paths']:
+        load_noise(path, cache_dir=noise_cache, decode=decode_wav)
+
+    listening_wavscp = os.path.join(work_dir, 'listening_wav.scp')
+    listening_manifest = os.path.join(work_dir, 'listening_' + manifest_name())
+    write_listening_wavscp(dataset, listening_wavscp, listening_manifest)
+
+    results_dir = os.path.join(work_dir, 'results', RESULTS_DIR)
+    decode_dir = os.path.join(results_dir, DECODE_DIR)
+    os.makedirs(decode_dir)
+    result_path = os.path.join(decode_dir, 'result.txt')
+
+    def mix():
+        mix_wsj_noise.main(os.path.join(data_dir, 'wav.scp'), os.path.join(data_dir, 'utt2dur'),
+                           dataset['noise_dir'], noise_ext='wav', mix_snr=[str(MIX_SNR)], mix_level=[0],
+                           noise_timestamp=[NOISE_START], backend='numpy', nj=nj, seed=0, materialize=True,
+                           noise_cache=noise_cache, level_cache=os.path.join(work_dir, 'cache', 'levels.sqlite'))
+
+    def score():
+        ids, refs, hyps, alignments = scorer.score(dataset['ref'], dataset['hyp'], 'char')
+        with open(result_path, 'w') as f:
+            scorer.write_result(f, ids, refs, hyps, alignments)
+
+    # The later benchmarks read the outputs of the earlier ones
+    mix()
+    score()
+    shutil.copy(os.path.join(data_dir, manifest_name()),
+                os.path.join(results_dir, '{}_{}'.format(TEST_SET, manifest_name())))
+    manifest_path = os.path.join(results_dir, '{}_{}'.format(TEST_SET, manifest_name()))
+    spk2gender_path = os.path.join(data_dir, 'spk2gender')
+    table = cached_table(result_path, manifest_path, spk2gender_path, None)[0]
+    report_dir = os.path.join(work_dir, 'reports')
+
+    def write():
+        for field in GROUPINGS:
+            output_dir = os.path.join(report_dir, field)
+            if not os.path.isdir(output_dir):
+                os.makedirs(output_dir)
+            write_results(table, field, output_dir)
+
+    return {'mix_wsj_noise.main': mix,
+            'levels.analyze': lambda: analyze_entries(read_wavscp(os.path.join(data_dir, 'wav.scp')), nj),
+            'gen_mixes.generate': lambda: gen_mixes.generate_mixes(listening_wavscp, output_dir=os.path.join(
+                    work_dir, 'mixes'), nj=nj, noise_utt_map=listening_manifest, force=True),
+            'scorer.score': score,
+            'sort_results.parse': lambda: cached_table(result_path, manifest_path, spk2gender_path, None),
+            'sort_results.summarize': lambda: [summarize_results(table, field) for field in GROUPINGS],
+            'sort_results.write': write}
+
+
+def time_benchmark(function, repeat=3):
+    """Seconds of every run of function."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def git_commit():
+    res = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT, stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL)
+    return res.stdout.decode('utf-8').strip() if res.returncode == 0 else None
+
+
+def read_history(history_path=HISTORY_PATH):
+    if not os.path.isfile(history_path):
+        return []
+    with open(history_path, 'r') as f:
+        return json.load(f)
+
+
+def write_history(history, history_path=HISTORY_PATH):
+    history_dir = os.path.dirname(os.path.abspath(history_path))
+    if not os.path.isdir(history_dir):
+        os.makedirs(history_dir)
+    tmp_path = '{}.{}.tmp'.format(history_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp_path, history_path)
+
+
+def regressions(run, history, threshold=THRESHOLD):
+    """(name, best, previous best) of the benchmarks slower than threshold times the last comparable run."""
+    previous = [entry for entry in history if entry['scale'] == run['scale'] and entry['host'] == run['host']]
+    if not previous:
+        return []
+    last = previous[-1]['results']
+    return [(name, result['min'], last[name]['min']) for name, result in run['results'].items()
+            if name in last and result['min'] > threshold * last[name]['min']]
+
+
+def str_run(run, audio_seconds):
+    res = '{:<24} {:>10} {:>10} {:>10}\n'.format('benchmark', 'best s', 'median s', 'x realtime')
+    for name, result in run['results'].items():
+        speed = audio_seconds / result['min'] if name in ('mix_wsj_noise.main', 'levels.analyze',
+                                                         'gen_mixes.generate') else None
+        res += '{:<24} {:>10.3f} {:>10.3f} {:>10}\n'.format(name, result['min'], result['median'],
+                                                            '{:.1f}'.format(speed) if speed else '-')
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the mixing and analysis hot paths on a synthetic WSJ-like \
+            data set and record the times in a JSON history.')
+    parser.add_argument('--utterances', type=int, metavar='N', default=200,
+            help='Number of utterances. Default is 200.')
+    parser.add_argument('--seconds', type=float, metavar='s', default=6,
+            help='Mean utterance duration. Default is 6.')
+    parser.add_argument('--speakers', type=int, metavar='N', default=10,
+            help='Number of speakers. Default is 10.')
+    parser.add_argument('--noise-tracks', type=int, metavar='N', default=4,
+            help='Number of noise tracks. Default is 4.')
+    parser.add_argument('--noise-seconds', type=float, metavar='s', default=60,
+            help='Duration of every noise track. Default is 60.')
+    parser.add_argument('--repeat', type=int, metavar='N', default=3,
+            help='Runs of every benchmark. Default is 3.')
+    parser.add_argument('--nj', type=int, metavar='N',
+            help='Processes of the benchmarks that run a pool. Defaults to the number of cores.')
+    parser.add_argument('--seed', type=int, metavar='N', default=0,
+            help='Seed of the synthetic data. Default is 0.')
+    parser.add_argument('--only', type=str, metavar='name', nargs='+', choices=BENCHMARKS,
+            help='Run only these benchmarks.')
+    parser.add_argument('--work-dir', type=str, metavar='path',
+            help='Keep the synthetic data and outputs in this directory (which must not exist) instead of a \
+                    temporary directory.')
+    parser.add_argument('--history', type=str, metavar='path', default=HISTORY_PATH,
+            help='JSON history of the runs. Default is {}'.format(HISTORY_PATH))
+    parser.add_argument('--threshold', type=float, metavar='x', default=THRESHOLD,
+            help='Ratio to the best time of the last comparable run above which a benchmark has regressed. \
+                    Default is {}'.format(THRESHOLD))
+    args = parser.parse_args()
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='mix_wsj_noise_benchmark.')
+    if args.work_dir is not None:
+        os.makedirs(work_dir)
+    scale = {'utterances': args.utterances, 'seconds': args.seconds, 'speakers': args.speakers,
+             'noise_tracks': args.noise_tracks, 'noise_seconds': args.noise_seconds, 'seed': args.seed, 'nj': args.nj}
+    try:
+        dataset = make_dataset(work_dir, args.utterances, args.seconds, args.speakers, args.noise_tracks,
+                               args.noise_seconds, args.seed)
+        benchmarks = make_benchmarks(work_dir, dataset, args.nj)
+        results = {}
+        for name in BENCHMARKS:
+            if args.only is None or name in args.only:
+                times = time_benchmark(benchmarks[name], args.repeat)
+                results[name] = {'min': min(times), 'median': float(np.median(times)), 'times': times}
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    run = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'host': platform.node(),
+           'cpus': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__, 'scale': scale,
+           'audio_seconds': dataset['audio_seconds'], 'results': results}
+    history = read_history(args.history)
+    print(str_run(run, dataset['audio_seconds']), end='')
+    slower = regressions(run, history, args.threshold)
+    history.append(run)
+    write_history(history, args.history)
+    for name, best, previous_best in slower:
+        print('REGRESSION {}: {:.3f} s, {:.3f} s in the last run'.format(name, best, previous_best))
+    if slower:
+        sys.exit(1)
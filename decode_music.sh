@@ -23,7 +23,16 @@
 # ├─ SongID - Artist Name - Song Title/
 # ├─ SongID - Artist Name - Song Title/
 # ...
-# 
+#
+# Trials are listed from the noise catalog of DATASET_DIR (wsj_asr1/local/mix_wsj_noise/noise_catalog.py),
+# which is updated incrementally and only reads the headers of the tracks. Entries without a track
+# longer than NOISE_START are skipped.
+#
+# With RECOG_SWEEP the trials are decoded by one recog_sweep.py daemon (wsj_asr1/local/mix_wsj_noise/recog_sweep.py),
+# which loads the model and LM once for all of them and batches the utterances by length over a process per core.
+# The utterances per second and real-time factor of each trial are saved in decode_stats.json of its decode results.
+# It is off by default: run wsj_asr1/local/mix_wsj_noise/test/recog_sweep_parity_test.sh first, which checks that
+# its hypotheses and WER match those of asr_recog.py.
 
 
 PROJECT_ROOT=$(pwd)             # Location of this script. Shouldn't need to change
@@ -32,6 +41,7 @@ MIX_LEVEL=0                     # Output level of mix
 NOISE_START=15                  # Number of seconds into the noise source to start mixing
 DATASET_DIR=SIGSEP/12-4_Other_12dBSNR_Start15
 NOISE_FILE_EXT=wav              # Used to search for audio files
+RECOG_SWEEP=false               # Decode every trial with one loaded model instead of 64 asr_recog.py loads per trial
 
 
 # Name of the directory to put the results in. The output directory is placed in the
@@ -40,18 +50,32 @@ OUTPUT_DIR=results-mix-snr${MIX_SNR}-lv${MIX_LEVEL}-start${NOISE_START}
 
 
 
+mapfile -t song_dirs < <(python3 $PROJECT_ROOT/wsj_asr1/local/mix_wsj_noise/noise_catalog.py \
+    "$PROJECT_ROOT/$DATASET_DIR" --trials --ext $NOISE_FILE_EXT --min-duration $NOISE_START)
+# noise_catalog.py fails when no track is found, which the process substitution does not pass on
+[ ${#song_dirs[@]} -gt 0 ] || exit 1
+
 pushd espnet/egs/wsj/asr1
-for song_dir in $PROJECT_ROOT/$DATASET_DIR/*
+decode_opts=
+if $RECOG_SWEEP
+then
+    # The daemon keeps the model loaded until this script exits
+    RECOG_SOCKET=${TMPDIR:-/tmp}/recog_sweep.$$.sock
+    ./run.sh --stage 5 --stop_stage 5 --ngpu 0 --recog_sweep true --recog_socket $RECOG_SOCKET --recog_serve true &
+    recog_pid=$!
+    trap "kill $recog_pid 2>/dev/null" EXIT
+    while [ ! -S $RECOG_SOCKET ]
+    do
+        kill -0 $recog_pid 2>/dev/null || exit 1
+        sleep 1
+    done
+    decode_opts="--recog_sweep true --recog_socket $RECOG_SOCKET"
+fi
+for song_dir in "${song_dirs[@]}"
 do
     echo -e "\n\n================================================================="
     echo "$(date)            $song_dir"
 
-
-    if [ "$(basename $song_dir)" == "info" ]    # Skip info file which may exist in DATASET_DIR
-    then
-        continue
-    fi
-
     $PROJECT_ROOT/reset_wavscp.sh   # Reset the wav.scp back to the original from stage 0
 
     # Augment data and extract features from the augmented data
@@ -62,7 +86,7 @@ do
         --mix_level $MIX_LEVEL \
         --noise_timestamp $NOISE_START
     # Decode
-    ./run.sh --stage 5 --ngpu 0
+    ./run.sh --stage 5 --ngpu 0 $decode_opts
 
     pushd exp/train_si284_pytorch_train_no_preprocess
     mkdir -v $song_dir/$OUTPUT_DIR
@@ -73,12 +97,12 @@ do
 
     pushd test_dev93
     cp -v wav.scp $song_dir/$OUTPUT_DIR/test_dev93_wav.scp     # Save the augmented wav.scp
-    cp -v noise_utt_map $song_dir/$OUTPUT_DIR/test_dev93_noise_utt_map  
+    cp -v mix_manifest $song_dir/$OUTPUT_DIR/test_dev93_mix_manifest     # Save the mixing decisions
     popd
 
     pushd test_eval92
     cp -v wav.scp $song_dir/$OUTPUT_DIR/test_eval92_wav.scp    # Save the augmented wav.scp
-    cp -v noise_utt_map $song_dir/$OUTPUT_DIR/test_eval92_noise_utt_map  
+    cp -v mix_manifest $song_dir/$OUTPUT_DIR/test_eval92_mix_manifest    # Save the mixing decisions
     popd
 
     popd
@@ -0,0 +1,374 @@
+"""
+Run the trials of decode_music.sh concurrently.
+
+decode_music.sh mixes, extracts features and decodes one song at a time in the
+shared espnet/egs/wsj/asr1 directory. Here every trial gets its own workspace,
+a directory of symlinks to the recipe with its own data and exp. The data
+directories that the trial rewrites are copied, and the trained models are
+linked. The stages of all trials form a dependency graph:
+
+    workspace -> mix (stage 0.5) -> features (stage 1) -> decode (stage 5) -> collect
+
+The mix and features tasks are separate run.sh calls, so run.sh --mix_serve
+(whose daemons only live until the end of the call) can't be used here.
+
+It runs on a pool of --nj workers, with at most --decode-jobs decodes at once.
+With --recog-sweep the decodes are sent to one recog_sweep.py daemon started
+in the recipe (run.sh --recog_serve), which loads the model and LM once for
+the whole sweep, and the decode task of every trial records its utterances per
+second and real-time factor.
+A finished task leaves a stamp in its workspace, so an interrupted sweep
+resumes from the first unfinished task of each trial when run again. A failed
+trial is reported and the others go on.
+
+With --trace every task is traced as a stage span, with the audio duration of
+the test sets for mixing, features and decoding, and the trace is passed on to
+mix_wsj_noise.py through $MIX_WSJ_NOISE_TRACE (see instrumentation.py).
+
+usage: run_trials.py [-h] [--mix-snr snr] [--mix-level db] [--noise-start s]
+                     [--noise-ext ext] [--workspace-root path] [--recipe-dir path]
+                     [--nj N] [--decode-jobs N] [--recog-sweep] [--trace path] [--dry-run]
+                     datasetDir
+
+i.e. `run_trials.py SIGSEP/12-4_Other_12dBSNR_Start15 --mix-snr 12 --nj 4 --decode-jobs 2`
+"""
+import os
+import sys
+import json
+import shutil
+import time
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wsj_asr1', 'local', 'mix_wsj_noise'))
+from instrumentation import TRACE_ENV, span
+from noise_catalog import Catalog, trials as catalog_trials
+from recog_sweep import STATS_NAME as DECODE_STATS_NAME
+
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+RECIPE_DIR = os.path.join(PROJECT_ROOT, 'espnet', 'egs', 'wsj', 'asr1')
+WORKSPACE_ROOT = os.path.join(PROJECT_ROOT, 'trials')
+TEST_SETS = ('test_dev93', 'test_eval92')
+COPIED_DATA_SETS = ('train_si284',) + TEST_SETS     # Rewritten by stages 0.5 and 1, other data directories are linked
+OWN_DIRS = ('dump', 'fbank')                        # Written by the recipe, created in each workspace
+OWN_EXP_DIRS = ('make_fbank', 'dump_feats')         # Logs of stage 1, created in each workspace
+MODEL_DIR = os.path.join('exp', 'train_si284_pytorch_train_no_preprocess')
+STAMP_DIR = '.run_trials'
+LOG_DIR = 'log'
+
+
+def copy_data_dir(src, dst):
+    """Copy the files of a Kaldi data directory, with the wav.scp from before any augmentation (see reset_wavscp.sh)."""
+    if not os.path.isdir(dst):
+        os.mkdir(dst)
+    for filename in os.listdir(src):
+        path = os.path.join(src, filename)
+        if os.path.isfile(path):
+            shutil.copy2(path, dst)
+    original = os.path.join(src, 'wav.scp.original')
+    if os.path.isfile(original):
+        shutil.copy2(original, os.path.join(dst, 'wav.scp'))
+
+
+def make_workspace(workspace, recipe_dir=RECIPE_DIR):
+    """
+    Create the workspace of a trial. Everything in the recipe is linked except data and exp: the
+    data directories of COPIED_DATA_SETS are copied and the rest linked, and every directory of exp
+    is recreated with links to its contents, so decode results are written in the workspace.
+    path.sh locates espnet relative to $PWD, so it is copied with $PWD replaced by the recipe.
+    A workspace left part way by an interrupted run is created again.
+    """
+    if os.path.isdir(workspace):
+        shutil.rmtree(workspace)    # Removes the links, not what they point to
+    os.makedirs(workspace)
+    for name in sorted(os.listdir(recipe_dir)):
+        src = os.path.join(recipe_dir, name)
+        dst = os.path.join(workspace, name)
+        if name in OWN_DIRS:
+            continue
+        if name == 'path.sh':
+            with open(src, 'r') as f:
+                script = f.read()
+            with open(dst, 'w') as f:
+                f.write(script.replace('$PWD', recipe_dir))
+            continue
+        if name not in ('data', 'exp') or not os.path.isdir(src):
+            os.symlink(src, dst)
+            continue
+        os.mkdir(dst)
+        for child in sorted(os.listdir(src)):
+            child_src = os.path.join(src, child)
+            child_dst = os.path.join(dst, child)
+            if name == 'data' and child in COPIED_DATA_SETS:
+                copy_data_dir(child_src, child_dst)
+            elif name == 'exp' and child in OWN_EXP_DIRS:
+                continue
+            elif name == 'exp' and os.path.isdir(child_src):
+                os.mkdir(child_dst)
+                for entry in sorted(os.listdir(child_src)):
+                    if not entry.startswith('decode_'):     # Results of earlier decodes in the shared recipe
+                        os.symlink(os.path.join(child_src, entry), os.path.join(child_dst, entry))
+            else:
+                os.symlink(child_src, child_dst)
+
+
+def reset_test_sets(workspace, recipe_dir=RECIPE_DIR):
+    """Restore the data directories of the test sets, so a mix interrupted part way can be run again."""
+    for test_set in TEST_SETS:
+        src = os.path.join(recipe_dir, 'data', test_set)
+        if os.path.isdir(src):
+            copy_data_dir(src, os.path.join(workspace, 'data', test_set))
+
+
+def collect_results(workspace, results_dir):
+    """Move the decode results of a trial and save the augmented wav.scp and mix manifest of each test set."""
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    model_dir = os.path.join(workspace, MODEL_DIR)
+    for entry in sorted(os.listdir(model_dir)):
+        if entry.startswith('decode_'):
+            dst = os.path.join(results_dir, entry)
+            if os.path.isdir(dst):
+                shutil.rmtree(dst)
+            shutil.move(os.path.join(model_dir, entry), dst)
+    for test_set in TEST_SETS:
+        for filename in ('wav.scp', 'mix_manifest'):
+            path = os.path.join(workspace, 'data', test_set, filename)
+            if os.path.isfile(path):
+                shutil.copy2(path, os.path.join(results_dir, '{}_{}'.format(test_set, filename)))
+
+
+def discover_trials(dataset_dir, results_name, workspace_root=WORKSPACE_ROOT, ext=None, min_duration=None):
+    """
+    A trial for every song directory of dataset_dir holding a track longer than min_duration, listed from
+    the noise catalog as in decode_music.sh.
+    """
+    trials = []
+    catalog = Catalog(dataset_dir)
+    catalog.update(ext=ext)
+    for song_dir in catalog_trials(catalog, ext, min_duration):
+        song = os.path.basename(song_dir)
+        if not os.path.isdir(song_dir):
+            continue
+        trials.append({'name': song,
+                       'song_dir': song_dir,
+                       'results_dir': os.path.join(song_dir, results_name),
+                       'workspace': os.path.join(workspace_root, os.path.basename(os.path.normpath(dataset_dir)),
+                                                 song, results_name)})
+    return trials
+
+
+def trial_tasks(trial, mix_args, recipe_dir=RECIPE_DIR, decode_args=()):
+    """
+    The tasks of one trial in dependency order. A task has a name, the names of the tasks it
+    depends on, and either a command run in the workspace or a function.
+    """
+    workspace = trial['workspace']
+
+    def mix():
+        reset_test_sets(workspace, recipe_dir)
+        return ['./run.sh', '--stage', '0.5', '--stop_stage', '0.5', '--ngpu', '0',
+                '--noise_file', trial['song_dir']] + mix_args
+
+    return [{'name': 'workspace', 'deps': [], 'function': lambda: make_workspace(workspace, recipe_dir)},
+            {'name': 'mix', 'deps': ['workspace'], 'command': mix},
+            {'name': 'features', 'deps': ['mix'], 'command': lambda: ['./run.sh', '--stage', '1', '--stop_stage', '1',
+                                                                      '--ngpu', '0']},
+            {'name': 'decode', 'deps': ['features'],
+             'command': lambda: ['./run.sh', '--stage', '5', '--ngpu', '0'] + list(decode_args)},
+            {'name': 'collect', 'deps': ['decode'],
+             'function': lambda: collect_results(workspace, trial['results_dir'])}]
+
+
+def audio_seconds(workspace):
+    """Total duration of the utterances of the test sets of a workspace, from their utt2dur."""
+    total = 0
+    for test_set in TEST_SETS:
+        path = os.path.join(workspace, 'data', test_set, 'utt2dur')
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                total += sum(float(line.split()[1]) for line in f if line.strip())
+    return total
+
+
+def decode_stats(workspace):
+    """The decode stats of the trial that recog_sweep.py writes in its decode directories, or None."""
+    model_dir = os.path.join(workspace, MODEL_DIR)
+    for entry in sorted(os.listdir(model_dir)) if os.path.isdir(model_dir) else []:
+        path = os.path.join(model_dir, entry, DECODE_STATS_NAME)
+        if entry.startswith('decode_') and os.path.isfile(path):
+            with open(path, 'r') as f:
+                return json.load(f)['trial']
+    return None
+
+
+def start_recog_daemon(socket_path, recipe_dir=RECIPE_DIR, log_path=None):
+    """Run the recog_sweep.py daemon of the recipe on socket_path and wait until it listens."""
+    command = ['./run.sh', '--stage', '5', '--stop_stage', '5', '--ngpu', '0', '--recog_sweep', 'true',
+               '--recog_socket', socket_path, '--recog_serve', 'true']
+    log = open(log_path if log_path is not None else os.devnull, 'w')
+    daemon = subprocess.Popen(command, cwd=recipe_dir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    while not os.path.exists(socket_path):
+        if daemon.poll() is not None:
+            raise Exception('code {} raised by: {} (see {})'.format(daemon.returncode, ' '.join(command), log_path))
+        time.sleep(1)
+    return daemon
+
+
+def stamp_path(trial, task):
+    return os.path.join(trial['workspace'], STAMP_DIR, '{}.done'.format(task['name']))
+
+
+def run_task(trial, task):
+    """Run a task of a trial in a stage span. Commands log to the log directory of the workspace."""
+    with span(task['name'], 'stage', trial=trial['name']) as s:
+        if 'function' in task:
+            task['function']()
+        else:
+            command = task['command']()
+            log_dir = os.path.join(trial['workspace'], LOG_DIR)
+            if not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+            log_path = os.path.join(log_dir, '{}.log'.format(task['name']))
+            with open(log_path, 'w') as log:
+                return_code = subprocess.call(command, cwd=trial['workspace'], stdout=log, stderr=subprocess.STDOUT)
+            if return_code != 0:
+                raise Exception('code {} raised by: {} (see {})'.format(return_code, ' '.join(command), log_path))
+        if task['name'] in ('mix', 'features', 'decode'):
+            s.add(audio_seconds=audio_seconds(trial['workspace']))
+        stats = decode_stats(trial['workspace']) if task['name'] == 'decode' else None
+        if stats is not None:
+            s.add(utterances_per_second=stats['utterances_per_second'], real_time_factor=stats['real_time_factor'])
+            print('{}: decoded {:.2f} utt/s, real-time factor {:.3f}'.format(
+                    trial['name'], stats['utterances_per_second'], stats['real_time_factor']), file=sys.stderr)
+    stamp = stamp_path(trial, task)
+    if not os.path.isdir(os.path.dirname(stamp)):
+        os.makedirs(os.path.dirname(stamp))
+    open(stamp, 'w').close()
+
+
+def schedule(trials, tasks, nj=None, decode_jobs=1, dry_run=False):
+    """
+    Run the tasks of every trial on a pool of nj workers, each once its dependencies are done and
+    at most decode_jobs decode tasks at a time. Tasks with a stamp from an earlier run are done
+    already. Returns the names of the trials that failed.
+    """
+    done = {(trial['name'], task['name']) for trial, trial_tasks in zip(trials, tasks) for task in trial_tasks
+            if os.path.isfile(stamp_path(trial, task))}
+    failed = set()
+    running = {}
+    if nj is None:
+        nj = os.cpu_count()
+
+    def ready():
+        for trial, trial_tasks in zip(trials, tasks):
+            if trial['name'] in failed:
+                continue
+            for task in trial_tasks:
+                key = (trial['name'], task['name'])
+                if key in done or key in running.values():
+                    continue
+                if all((trial['name'], dep) in done for dep in task['deps']):
+                    yield trial, task
+
+    if dry_run:
+        for trial, trial_tasks in zip(trials, tasks):
+            todo = [task['name'] for task in trial_tasks if (trial['name'], task['name']) not in done]
+            print('{}\t{}\t{}'.format(trial['name'], trial['workspace'], ' '.join(todo) if todo else 'done'))
+        return []
+
+    with ThreadPoolExecutor(nj) as pool:
+        while True:
+            for trial, task in list(ready()):
+                if len(running) >= nj:
+                    break
+                decoding = sum(name == 'decode' for _, name in running.values())
+                if task['name'] == 'decode' and decoding >= decode_jobs:
+                    continue
+                print('{}: {} started'.format(trial['name'], task['name']), file=sys.stderr)
+                running[pool.submit(run_task, trial, task)] = (trial['name'], task['name'])
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                key = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.add(key[0])
+                    print('{}: {} failed: {}'.format(key[0], key[1], e), file=sys.stderr)
+                else:
+                    done.add(key)
+                    print('{}: {} done'.format(*key), file=sys.stderr)
+    return sorted(failed)
+
+
+if __name__ == '__main__':
+
+    def dir_path(string):
+        if os.path.isdir(string):
+            return string
+        else:
+            raise NotADirectoryError(string)
+
+    parser = argparse.ArgumentParser(description='Run a trial (mixing, feature extraction and decoding) for \
+            every song directory of a dataset concurrently, like decode_music.sh does one after another.')
+    parser.add_argument('datasetDir', type=dir_path,
+            help='Directory of song directories, the DATASET_DIR of decode_music.sh.')
+    parser.add_argument('--mix-snr', type=str, metavar='snr', default='15',
+            help='Relative SNR between utterance and noise. Default is 15.')
+    parser.add_argument('--mix-level', type=str, metavar='db', default='0',
+            help='Output level of the mix. Default is 0.')
+    parser.add_argument('--noise-start', type=str, metavar='s', default='15',
+            help='Number of seconds into the noise source to start mixing. Default is 15.')
+    parser.add_argument('--noise-ext', type=str, metavar='ext', default='wav',
+            help='Extension of the audio files of a song directory. Default is wav.')
+    parser.add_argument('--workspace-root', type=str, metavar='path', default=WORKSPACE_ROOT,
+            help='Where the trial workspaces are created. Default is {}'.format(WORKSPACE_ROOT))
+    parser.add_argument('--recipe-dir', type=dir_path, metavar='path', default=RECIPE_DIR,
+            help='The espnet recipe the workspaces link to. Default is {}'.format(RECIPE_DIR))
+    parser.add_argument('--nj', type=int, metavar='N',
+            help='Number of tasks run at once. Defaults to the number of cores.')
+    parser.add_argument('--decode-jobs', type=int, metavar='N', default=1,
+            help='Number of decodes run at once, each uses the decoding jobs of run.sh. Default is 1.')
+    parser.add_argument('--recog-sweep', action='store_true',
+            help='Decode every trial with one recog_sweep.py daemon, loading the model once for the sweep. '
+                 'The decodes run at once share its processes.')
+    parser.add_argument('--trace', type=str, metavar='path',
+            help='Append a trace of the tasks of every trial and of the mixing to this file.')
+    parser.add_argument('--dry-run', action='store_true',
+            help='Write the tasks left to run for every trial to stdout.')
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        os.environ[TRACE_ENV] = os.path.abspath(args.trace)     # Inherited by the commands of the tasks
+    results_name = 'results-mix-snr{}-lv{}-start{}'.format(args.mix_snr, args.mix_level, args.noise_start)
+    trials = discover_trials(args.datasetDir, results_name, os.path.abspath(args.workspace_root), args.noise_ext,
+                             float(args.noise_start))
+    mix_args = ['--noise_ext', args.noise_ext, '--mix_snr', args.mix_snr, '--mix_level', args.mix_level,
+                '--noise_timestamp', args.noise_start]
+    decode_args = []
+    recog_daemon = None
+    if args.recog_sweep:
+        decode_args = ['--recog_sweep', 'true']
+        if not args.dry_run:
+            socket_path = os.path.join(tempfile.gettempdir(), 'recog_sweep.{}.sock'.format(os.getpid()))
+            if not os.path.isdir(args.workspace_root):
+                os.makedirs(args.workspace_root)
+            recog_daemon = start_recog_daemon(socket_path, os.path.abspath(args.recipe_dir),
+                                              os.path.join(args.workspace_root, 'recog_sweep.log'))
+            decode_args += ['--recog_socket', socket_path]
+    tasks = [trial_tasks(trial, mix_args, os.path.abspath(args.recipe_dir), decode_args) for trial in trials]
+    try:
+        failed = schedule(trials, tasks, args.nj, args.decode_jobs, args.dry_run)
+    finally:
+        if recog_daemon is not None:
+            recog_daemon.terminate()    # The daemon stops on SIGTERM and removes its socket
+            recog_daemon.wait()
+    if failed:
+        print('Failed trials: {}'.format(' '.join(failed)), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,169 @@
+"""
+Music activity index of noise tracks, to pick a segment of a track where there is
+something to hear for each utterance.
+
+The energy envelope of a track (RMS level in dB of every 100 ms frame, as int8)
+is computed once and stored next to the track in the noise cache, as
+<key>.activity.npy. A frame is active when it is within ACTIVE_RANGE_DB of the
+loud frames of the track and above ACTIVE_FLOOR_DB, and inactive gaps shorter
+than MAX_GAP_SECONDS (rests between notes) are bridged. ActivityIndex keeps the
+active runs sorted by length with cumulative sums, so drawing a uniformly random
+start of an active region of a given length is two binary searches.
+
+A noise.roi file restricts the regions of some tracks. It has a line per noise
+file, its file name followed by regions start-end in seconds:
+
+    01_Bass.wav 12.5-48 60-95.25
+    02_Vocals.wav 30-120
+
+Only the active frames inside the regions of a track are used.
+"""
+import os
+from bisect import bisect_right
+import numpy as np
+
+
+FRAME_SECONDS = 0.1
+ENVELOPE_FLOOR_DB = -127    # Level of digital silence in the int8 envelope
+ACTIVE_FLOOR_DB = -55       # Frames below this level are never active
+ACTIVE_RANGE_DB = 30        # Frames more than this below the loud frames of the track are inactive
+LOUD_PERCENTILE = 95        # The level of the loud frames of a track
+MAX_GAP_SECONDS = 0.5
+ACTIVITY_SUFFIX = '.activity.npy'
+
+
+def energy_envelope(samples, srate, frame_seconds=FRAME_SECONDS):
+    """RMS level in dB full scale of every whole frame of float samples, as int8."""
+    frame_length = int(round(frame_seconds * srate))
+    nframes = len(samples) // frame_length
+    frames = np.asarray(samples[:nframes * frame_length], dtype=np.float32)
+    if frames.ndim > 1:
+        frames = frames.mean(axis=1)
+    frames = frames.reshape(nframes, frame_length)
+    power = np.einsum('ij,ij->i', frames, frames) / frame_length
+    with np.errstate(divide='ignore'):
+        levels = 10 * np.log10(power)
+    return np.clip(np.round(levels), ENVELOPE_FLOOR_DB, 0).astype(np.int8)
+
+
+def cached_envelope(noise, srate, frame_seconds=FRAME_SECONDS):
+    """
+    The energy envelope of a track memory-mapped from the noise cache, computed on the first use and
+    stored next to the track.
+    """
+    path = '{}{}'.format(os.path.splitext(noise.filename)[0], ACTIVITY_SUFFIX)
+    if os.path.isfile(path):
+        return np.load(path)
+    envelope = energy_envelope(noise, srate, frame_seconds)
+    # Write then rename so concurrent jobs never load a partial envelope
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, envelope)
+    os.replace(tmp_path, path)
+    return envelope
+
+
+def run_bounds(mask):
+    """Start and end (exclusive) of every run of True in a boolean array."""
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def active_frames(envelope, floor=ACTIVE_FLOOR_DB, active_range=ACTIVE_RANGE_DB, max_gap=MAX_GAP_SECONDS,
+                  frame_seconds=FRAME_SECONDS):
+    """Active frames of an energy envelope, with the inactive gaps of up to max_gap seconds between them bridged."""
+    if len(envelope) == 0:
+        return np.zeros(0, dtype=bool)
+    loud = np.percentile(envelope, LOUD_PERCENTILE)
+    active = envelope >= max(floor, loud - active_range)
+    starts, ends = run_bounds(~active)
+    short = (ends - starts <= int(round(max_gap / frame_seconds))) & (starts > 0) & (ends < len(active))
+    bridge = np.zeros(len(active) + 1, dtype=np.int64)
+    np.add.at(bridge, starts[short], 1)
+    np.add.at(bridge, ends[short], -1)
+    return active | (np.cumsum(bridge)[:-1] > 0)
+
+
+def read_roi(filepath):
+    """The noise.roi file as a file name -> list of (start, end) seconds mapping."""
+    roi = {}
+    with open(filepath, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, *regions = line.split()
+            roi[name] = [tuple(float(time) for time in region.split('-')) for region in regions]
+    return roi
+
+
+def roi_mask(regions, nframes, frame_seconds=FRAME_SECONDS):
+    """Frames entirely inside any of the regions."""
+    mask = np.zeros(nframes, dtype=bool)
+    for start, end in regions:
+        mask[int(np.ceil(start / frame_seconds)):max(0, int(end / frame_seconds))] = True
+    return mask
+
+
+class ActivityIndex:
+    """
+    Active runs of frames of a track. sample(seconds, rng) draws the start of a segment of the
+    given length inside one run, uniformly over all such starts.
+    """
+
+    def __init__(self, active, frame_seconds=FRAME_SECONDS):
+        self.frame_seconds = frame_seconds
+        starts, ends = run_bounds(active)
+        order = np.argsort(starts - ends, kind='stable')     # Longest first
+        self.starts = starts[order]
+        self.lengths = (ends - starts)[order]
+        self._neg_lengths = (-self.lengths).tolist()          # Ascending, for bisect
+        self._cumulative = np.concatenate([[0], np.cumsum(self.lengths)]).tolist()
+        self.active_seconds = float(self.lengths.sum() * frame_seconds)
+
+    def __bool__(self):
+        return len(self.lengths) > 0
+
+    def positions(self, nframes):
+        """Number of runs at least nframes long and the number of segment starts in them."""
+        nruns = bisect_right(self._neg_lengths, -nframes)
+        return nruns, self._cumulative[nruns] - nruns * (nframes - 1)
+
+    def find(self, seconds, u):
+        """
+        Start in seconds of the segment of a long enough run at fraction u in [0, 1) of all the
+        segment starts, or None if no run is long enough.
+        """
+        nframes = max(1, int(np.ceil(seconds / self.frame_seconds)))
+        nruns, total = self.positions(nframes)
+        if total <= 0:
+            return None
+        position = min(int(u * total), total - 1)
+        # The starts before run j are cumulative[j] - j * (nframes - 1), increasing with j
+        lo, hi = 0, nruns
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._cumulative[mid + 1] - (mid + 1) * (nframes - 1) <= position:
+                lo = mid + 1
+            else:
+                hi = mid
+        offset = position - (self._cumulative[lo] - lo * (nframes - 1))
+        return round(float((self.starts[lo] + offset) * self.frame_seconds), 3)
+
+    def sample(self, seconds, rng):
+        """
+        Random start in seconds of an active segment, drawn with rng.random(). Without a long enough
+        run the longest run is used, and without any active frames the start of the track.
+        """
+        start = self.find(seconds, rng.random())
+        if start is not None:
+            return start
+        return round(float(self.starts[0] * self.frame_seconds), 3) if len(self.starts) else 0.0
+
+
+def activity_index(noise, srate, regions=None, frame_seconds=FRAME_SECONDS):
+    """The ActivityIndex of a track memory-mapped from the noise cache, restricted to regions if given."""
+    active = active_frames(cached_envelope(noise, srate, frame_seconds), frame_seconds=frame_seconds)
+    if regions is not None:
+        active &= roi_mask(regions, len(active), frame_seconds)
+    return ActivityIndex(active, frame_seconds)
@@ -0,0 +1,358 @@
+"""
+Kaldi compatible fbank + pitch features computed with NumPy.
+
+The fbank features follow compute-fbank-feats: 25 ms povey windowed frames every
+10 ms with DC removal and pre-emphasis, the power spectrum of a power of 2 FFT
+and the log energies of triangular mel filters. They match Kaldi up to float
+rounding when dithering is disabled.
+
+The 3 pitch dimensions follow compute-kaldi-pitch-feats | process-kaldi-pitch-feats
+(POV feature, mean normalized log pitch and delta pitch) but are an approximation:
+the NCCF is computed on the signal resampled to 4 kHz at integer lags and
+interpolated onto a log spaced lag grid, and the lag track is the Viterbi path of
+the whole utterance instead of Kaldi's online search.
+
+usage: features.py [-h] [--fbank-config path] [--pitch-config path] [--nj N]
+                   dataPath featDir
+
+Computes the features of every utterance in dataPath/wav.scp, like
+steps/make_fbank_pitch.sh, and writes featDir/raw_fbank_pitch_<name>.ark,
+dataPath/feats.scp and dataPath/utt2num_frames.
+"""
+import os
+import struct
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from scipy.signal import resample_poly
+
+from mix_engine import read_scp_audio, write_ark_entry
+from levels import read_wavscp
+from instrumentation import span
+
+
+FBANK_OPTIONS = {'sample-frequency': 16000, 'frame-length': 25.0, 'frame-shift': 10.0, 'dither': 1.0,
+                 'preemphasis-coefficient': 0.97, 'remove-dc-offset': True, 'window-type': 'povey',
+                 'round-to-power-of-two': True, 'snip-edges': True, 'num-mel-bins': 23, 'low-freq': 20.0,
+                 'high-freq': 0.0, 'use-energy': False}
+PITCH_OPTIONS = {'sample-frequency': 16000, 'frame-length': 25.0, 'frame-shift': 10.0, 'min-f0': 50.0,
+                 'max-f0': 400.0, 'resample-frequency': 4000, 'delta-pitch': 0.01, 'penalty-factor': 0.1,
+                 'nccf-ballast': 7000.0, 'pitch-scale': 2.0, 'pov-scale': 2.0, 'delta-pitch-scale': 10.0,
+                 'normalization-left-context': 75, 'normalization-right-context': 75, 'delta-window': 2}
+FLT_EPSILON = np.finfo(np.float32).eps
+WAVE_SCALE = 2 ** 15    # Kaldi reads 16 bit PCM as integer valued floats
+
+
+def read_config(path, defaults):
+    """Parse a Kaldi config file of --option=value lines over a copy of the default options."""
+    options = dict(defaults)
+    if path is None:
+        return options
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line.startswith('--'):
+                continue
+            key, _, value = line[2:].partition('=')
+            if key not in options:
+                raise ValueError('Unsupported option --{} in {}'.format(key, path))
+            default = options[key]
+            if isinstance(default, bool):
+                options[key] = value.lower() in ('true', '1', '')
+            else:
+                options[key] = type(default)(value)
+    return options
+
+
+def frame_signal(samples, frame_length, frame_shift):
+    """Frames of a 1-D signal with snip-edges semantics as a (frames, frame_length) view."""
+    nframes = 1 + (len(samples) - frame_length) // frame_shift if len(samples) >= frame_length else 0
+    return np.lib.stride_tricks.as_strided(samples, shape=(nframes, frame_length),
+                                           strides=(samples.strides[0] * frame_shift, samples.strides[0]),
+                                           writeable=False)
+
+
+def mel_scale(freq):
+    return 1127.0 * np.log(1.0 + freq / 700.0)
+
+
+def mel_banks(num_bins, fft_size, srate, low_freq, high_freq):
+    """Triangular mel filter weights of shape (fft_size // 2, num_bins), like Kaldi's MelBanks."""
+    nyquist = 0.5 * srate
+    if high_freq <= 0:
+        high_freq += nyquist
+    mel_low, mel_high = mel_scale(low_freq), mel_scale(high_freq)
+    delta = (mel_high - mel_low) / (num_bins + 1)
+    left = mel_low + np.arange(num_bins) * delta
+    center, right = left + delta, left + 2 * delta
+    mel = mel_scale(np.arange(fft_size // 2) * srate / fft_size)[:, None]
+    up = (mel - left) / (center - left)
+    down = (right - mel) / (right - center)
+    weights = np.where(mel <= center, up, down)
+    weights[(mel <= left) | (mel >= right)] = 0
+    return weights
+
+
+def window_function(window_type, frame_length):
+    n = np.arange(frame_length)
+    a = 2 * np.pi / (frame_length - 1)
+    if window_type == 'povey':
+        return (0.5 - 0.5 * np.cos(a * n)) ** 0.85
+    elif window_type == 'hanning':
+        return 0.5 - 0.5 * np.cos(a * n)
+    elif window_type == 'hamming':
+        return 0.54 - 0.46 * np.cos(a * n)
+    elif window_type == 'rectangular':
+        return np.ones(frame_length)
+    raise ValueError('Unsupported window type {}'.format(window_type))
+
+
+def fbank(samples, options=FBANK_OPTIONS, rng=None):
+    """Log mel filterbank energies of float samples in [-1, 1), shape (frames, num-mel-bins)."""
+    if not options['snip-edges'] or options['use-energy']:
+        raise ValueError('--snip-edges=false and --use-energy=true are not supported')
+    srate = options['sample-frequency']
+    frame_length = int(srate * options['frame-length'] / 1000)
+    frame_shift = int(srate * options['frame-shift'] / 1000)
+    waveform = samples.astype(np.float64) * WAVE_SCALE
+    if options['dither'] != 0:
+        rng = np.random.default_rng(0) if rng is None else rng
+        waveform = waveform + options['dither'] * rng.standard_normal(len(waveform))
+
+    frames = frame_signal(waveform, frame_length, frame_shift).copy()
+    if options['remove-dc-offset']:
+        frames -= frames.mean(axis=1, keepdims=True)
+    coef = options['preemphasis-coefficient']
+    if coef != 0:
+        frames[:, 1:] -= coef * frames[:, :-1]
+        frames[:, 0] -= coef * frames[:, 0]
+    frames *= window_function(options['window-type'], frame_length)
+
+    fft_size = 1 << int(np.ceil(np.log2(frame_length))) if options['round-to-power-of-two'] else frame_length
+    power = np.abs(np.fft.rfft(frames, n=fft_size)) ** 2
+    weights = mel_banks(options['num-mel-bins'], fft_size, srate, options['low-freq'], options['high-freq'])
+    energies = power[:, :fft_size // 2] @ weights
+    return np.log(np.maximum(energies, FLT_EPSILON)).astype(np.float32)
+
+
+def nccf_to_pov_feature(nccf):
+    return (1.0001 - np.clip(nccf, -1, 1)) ** 0.15 - 1
+
+
+def nccf_to_pov(nccf):
+    """Probability of voicing of the NCCF, the weight of a frame in the log pitch normalization."""
+    n = np.minimum(np.abs(nccf), 1)
+    y = -5.2 + 5.4 * np.exp(7.5 * (n - 1)) + 4.8 * n - 2.0 * np.exp(-10 * n) + 4.2 * np.exp(20 * (n - 1))
+    return 1 / (1 + np.exp(-y))
+
+
+def compute_deltas(x, window):
+    """First order deltas with edge replication, like Kaldi's ComputeDeltas."""
+    padded = np.concatenate([np.full(window, x[0]), x, np.full(window, x[-1])])
+    ks = np.arange(-window, window + 1)
+    shifted = np.stack([padded[window + k:window + k + len(x)] for k in ks])
+    return ks @ shifted / np.sum(ks ** 2)
+
+
+def pitch(samples, nframes, options=PITCH_OPTIONS):
+    """POV feature, normalized log pitch and delta pitch of float samples, shape (nframes, 3)."""
+    srate = options['resample-frequency']
+    if nframes == 0:
+        return np.zeros((0, 3), dtype=np.float32)
+    waveform = resample_poly(samples.astype(np.float64) * WAVE_SCALE, srate, options['sample-frequency'])
+    frame_length = int(srate * options['frame-length'] / 1000)
+    frame_shift = int(srate * options['frame-shift'] / 1000)
+    min_lag = int(np.floor(srate / options['max-f0']))
+    max_lag = int(np.ceil(srate / options['min-f0']))
+    window = frame_length + max_lag
+    needed = (nframes - 1) * frame_shift + window
+    waveform = np.concatenate([waveform, np.zeros(max(0, needed - len(waveform)))])
+    frames = frame_signal(waveform, window, frame_shift)[:nframes]
+    frames = frames - frames[:, :frame_length].mean(axis=1, keepdims=True)
+
+    # Cross correlation of the first frame_length samples with every lagged window, by FFT
+    fft_size = 1 << int(np.ceil(np.log2(2 * window)))
+    head = np.fft.rfft(frames[:, :frame_length], n=fft_size)
+    corr = np.fft.irfft(np.conj(head) * np.fft.rfft(frames, n=fft_size), n=fft_size)
+    lags = np.arange(min_lag, max_lag + 1)
+    corr = corr[:, lags]
+    squares = np.concatenate([np.zeros((nframes, 1)), np.cumsum(frames ** 2, axis=1)], axis=1)
+    e0 = squares[:, frame_length][:, None]
+    elag = squares[:, lags + frame_length] - squares[:, lags]
+    ballast = (np.mean(waveform ** 2) * frame_length) ** 2 * options['nccf-ballast']
+    nccf_pitch = corr / np.sqrt(e0 * elag + ballast)
+    nccf_pov = corr / np.sqrt(np.maximum(e0 * elag, 1e-20))
+
+    # Interpolate onto lags spaced by delta-pitch in log frequency and find the best lag track
+    grid = min_lag * (1 + options['delta-pitch']) ** np.arange(
+        int(np.log(max_lag / min_lag) / np.log(1 + options['delta-pitch'])) + 1)
+    position = np.interp(grid, lags, np.arange(len(lags)))
+    lo = np.floor(position).astype(int)
+    hi = np.minimum(lo + 1, len(lags) - 1)
+    frac = position - lo
+    nccf_pitch = nccf_pitch[:, lo] * (1 - frac) + nccf_pitch[:, hi] * frac
+    nccf_pov = nccf_pov[:, lo] * (1 - frac) + nccf_pov[:, hi] * frac
+
+    steps = np.arange(len(grid))
+    transition = options['penalty-factor'] * np.log(1 + options['delta-pitch']) ** 2 * \
+            (steps[:, None] - steps[None, :]) ** 2
+    local_cost = 1 - nccf_pitch
+    cost = local_cost[0].copy()
+    backpointers = np.zeros((nframes, len(grid)), dtype=np.int32)
+    for t in range(1, nframes):
+        total = cost[:, None] + transition
+        backpointers[t] = np.argmin(total, axis=0)
+        cost = total[backpointers[t], steps] + local_cost[t]
+    best = np.zeros(nframes, dtype=np.int32)
+    best[-1] = np.argmin(cost)
+    for t in range(nframes - 1, 0, -1):
+        best[t - 1] = backpointers[t, best[t]]
+
+    frame_idx = np.arange(nframes)
+    nccf = nccf_pov[frame_idx, best]
+    log_pitch = np.log(srate / grid[best])
+
+    # Log pitch minus its POV weighted mean over the normalization window
+    weights = nccf_to_pov(nccf)
+    cum_weights = np.concatenate([[0], np.cumsum(weights)])
+    cum_pitch = np.concatenate([[0], np.cumsum(weights * log_pitch)])
+    start = np.maximum(frame_idx - options['normalization-left-context'], 0)
+    end = np.minimum(frame_idx + options['normalization-right-context'] + 1, nframes)
+    mean = (cum_pitch[end] - cum_pitch[start]) / np.maximum(cum_weights[end] - cum_weights[start], 1e-20)
+
+    return np.stack([options['pov-scale'] * nccf_to_pov_feature(nccf),
+                     options['pitch-scale'] * (log_pitch - mean),
+                     options['delta-pitch-scale'] * compute_deltas(log_pitch, options['delta-window'])],
+                    axis=1).astype(np.float32)
+
+
+def fbank_pitch(samples, srate, fbank_options=FBANK_OPTIONS, pitch_options=PITCH_OPTIONS):
+    """The features of steps/make_fbank_pitch.sh for mono float samples, shape (frames, num-mel-bins + 3)."""
+    if samples.ndim > 1:
+        samples = samples[:, 0]     # Kaldi extracts the first channel by default
+    if srate != fbank_options['sample-frequency']:
+        raise ValueError('Sample rate {} does not match --sample-frequency={}'.format(
+            srate, fbank_options['sample-frequency']))
+    feats = fbank(samples, fbank_options)
+    return np.concatenate([feats, pitch(samples, len(feats), pitch_options)], axis=1)
+
+
+def matrix_bytes(matrix):
+    """A float matrix in the binary Kaldi format, to be written after `key ` in an archive."""
+    rows, cols = matrix.shape
+    return b'\0BFM ' + struct.pack('<bibi', 4, rows, 4, cols) + np.ascontiguousarray(matrix, '<f4').tobytes()
+
+
+def read_ark_matrices(path):
+    """Read the uncompressed float matrices of a binary Kaldi archive as a key -> array dict."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    matrices = {}
+    pos = 0
+    while pos < len(data):
+        space = data.index(b' ', pos)
+        key = data[pos:space].decode('utf-8')
+        header = data[space + 1:space + 6]
+        if header not in (b'\0BFM ', b'\0BDM '):
+            raise ValueError('Unsupported matrix type {} of {} in {}'.format(header, key, path))
+        rows, cols = struct.unpack('<xixi', data[space + 6:space + 16])
+        dtype = '<f4' if header == b'\0BFM ' else '<f8'
+        start = space + 16
+        nbytes = rows * cols * np.dtype(dtype).itemsize
+        matrices[key] = np.frombuffer(data[start:start + nbytes], dtype=dtype).reshape(rows, cols)
+        pos = start + nbytes
+    return matrices
+
+
+def open_feature_outputs(ark_path, data_dir):
+    """Open a feature archive and the feats.scp and utt2num_frames of the data directory it belongs to."""
+    ark_path = os.path.abspath(ark_path)
+    return (ark_path, open(ark_path, 'wb'), open(os.path.join(data_dir, 'feats.scp'), 'w'),
+            open(os.path.join(data_dir, 'utt2num_frames'), 'w'))
+
+
+def write_feature_entry(outputs, utt_id, matrix):
+    ark_path, ark_f, scp_f, frames_f = outputs
+    offset = write_ark_entry(ark_f, utt_id, matrix_bytes(matrix))
+    scp_f.write('{} {}:{}\n'.format(utt_id, ark_path, offset))
+    frames_f.write('{} {}\n'.format(utt_id, len(matrix)))
+
+
+def close_feature_outputs(outputs):
+    for f in outputs[1:]:
+        f.close()
+
+
+def write_features(utt_ids, feats, ark_path, data_dir):
+    """
+    Write the feature matrices of utt_ids, in order, to a Kaldi archive and the feats.scp and
+    utt2num_frames of the data directory. feats may be any iterable, i.e. the results of a Pool.
+    """
+    outputs = open_feature_outputs(ark_path, data_dir)
+    for utt_id, matrix in zip(utt_ids, feats):
+        write_feature_entry(outputs, utt_id, matrix)
+    close_feature_outputs(outputs)
+
+
+# Options of a feature extraction worker process, set once by _init_feature_worker
+_worker_options = None
+
+
+def _init_feature_worker(options):
+    global _worker_options
+    _worker_options = options
+
+
+def _feature_job(scp_cmd):
+    samples, srate = read_scp_audio(scp_cmd)
+    with span('fbank_pitch', 'utterance', audio_seconds=len(samples) / srate):
+        return fbank_pitch(samples, srate, *_worker_options)
+
+
+def compute_features(entries, ark_path, data_dir, fbank_options=FBANK_OPTIONS, pitch_options=PITCH_OPTIONS,
+                     nj=None):
+    """Compute the fbank + pitch features of (utt_id, scp_cmd) pairs in a pool of nj processes."""
+    if nj is None:
+        nj = os.cpu_count()
+    nj = max(1, min(nj, len(entries)))
+    utt_ids = [utt_id for utt_id, _ in entries]
+    scp_cmds = [scp_cmd for _, scp_cmd in entries]
+    options = (fbank_options, pitch_options)
+    if nj == 1:
+        _init_feature_worker(options)
+        write_features(utt_ids, map(_feature_job, scp_cmds), ark_path, data_dir)
+        return
+    with Pool(nj, initializer=_init_feature_worker, initargs=(options,)) as pool:
+        write_features(utt_ids, pool.imap(_feature_job, scp_cmds, chunksize=max(1, len(entries) // (4 * nj))),
+                       ark_path, data_dir)
+
+
+if __name__ == '__main__':
+
+    def dir_path(string):
+        if os.path.isdir(string):
+            return string
+        else:
+            raise NotADirectoryError(string)
+
+    parser = argparse.ArgumentParser(description='Compute 80-bin fbank + pitch features of a Kaldi data \
+            directory without Kaldi, like steps/make_fbank_pitch.sh.')
+    parser.add_argument('dataPath', type=dir_path,
+            help='Path to the dataset in the data directory (i.e. data/test_dev93) containing a wav.scp.')
+    parser.add_argument('featDir', type=str,
+            help='Directory of the feature archive, i.e. fbank.')
+    parser.add_argument('--fbank-config', type=str, metavar='path',
+            help='Kaldi fbank config, i.e. conf/fbank.conf.')
+    parser.add_argument('--pitch-config', type=str, metavar='path',
+            help='Kaldi pitch config, i.e. conf/pitch.conf.')
+    parser.add_argument('--nj', type=int, metavar='N',
+            help='Number of processes to compute the features with. Defaults to the number of cores.')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.featDir):
+        os.makedirs(args.featDir)
+    name = os.path.basename(os.path.normpath(args.dataPath))
+    compute_features(read_wavscp(os.path.join(args.dataPath, 'wav.scp')),
+                     os.path.join(args.featDir, 'raw_fbank_pitch_{}.ark'.format(name)), args.dataPath,
+                     read_config(args.fbank_config, FBANK_OPTIONS), read_config(args.pitch_config, PITCH_OPTIONS),
+                     args.nj)
@@ -0,0 +1,175 @@
+"""
+Timing trace of the augmentation -> features -> decode pipeline.
+
+When $MIX_WSJ_NOISE_TRACE names a file, every span appends one event to it in
+the Chrome trace event format, one JSON object per line:
+
+    {"name": "mix", "cat": "utterance", "ph": "X", "ts": 1700000000000000, "dur": 5120,
+     "pid": 4242, "tid": 4242, "args": {"audio_seconds": 7.1, "bytes_written": 227244}}
+
+ts and dur are in microseconds and ts is wall clock time, so the events of the
+worker processes of a run and of every stage of run_trials.py line up in one
+file. Categories are stage (a step of a run), utterance (the work of one
+utterance) and spawn (a child process). Spans may record audio_seconds,
+bytes_read and bytes_written; the summary adds them up per span and computes the
+real-time factor (busy seconds per second of audio) and the parallelism (busy
+seconds per wall second). Without $MIX_WSJ_NOISE_TRACE spans do nothing.
+
+usage: instrumentation.py [-h] [--chrome path] trace [trace ...]
+
+Writes the summary of the traces to stdout, and with --chrome a JSON file for
+chrome://tracing or Perfetto.
+"""
+import os
+import json
+import time
+import cProfile
+import argparse
+import subprocess
+
+
+TRACE_ENV = 'MIX_WSJ_NOISE_TRACE'
+SUMMED_ARGS = ('audio_seconds', 'bytes_read', 'bytes_written')
+
+_trace_fd = None
+_trace_pid = None
+
+
+def trace_path():
+    return os.environ.get(TRACE_ENV)
+
+
+def write_event(event):
+    """Append an event to the trace. Each event is a single write to a file opened for appending."""
+    global _trace_fd, _trace_pid
+    if _trace_pid != os.getpid():      # Forked workers open their own descriptor
+        _trace_fd = os.open(trace_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        _trace_pid = os.getpid()
+    os.write(_trace_fd, (json.dumps(event) + '\n').encode('utf-8'))
+
+
+class span:
+    """
+    Context manager timing a block as a complete (ph X) event. Arguments given when it is created
+    or added with add() while it runs are recorded with the event; numeric ones add up.
+    """
+
+    def __init__(self, name, cat='stage', **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def add(self, **args):
+        for key, value in args.items():
+            self.args[key] = self.args.get(key, 0) + value
+
+    def __enter__(self):
+        self.ts = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if trace_path() is None:
+            return
+        write_event({'name': self.name, 'cat': self.cat, 'ph': 'X', 'ts': int(self.ts * 1e6),
+                     'dur': int((time.perf_counter() - self.start) * 1e6), 'pid': os.getpid(), 'tid': os.getpid(),
+                     'args': self.args})
+
+
+def traced_run(command, **kwargs):
+    """subprocess.run in a spawn span named after the program, recording the size of a captured stdout."""
+    with span(os.path.basename(command.split()[0]), 'spawn', command=command) as s:
+        res = subprocess.run(command, **kwargs)
+        if isinstance(res.stdout, bytes):
+            s.add(bytes_read=len(res.stdout))
+    return res
+
+
+class profile:
+    """Context manager running a block under cProfile and saving the stats to path, if path is not None."""
+
+    def __init__(self, path):
+        self.path = path
+        self.profiler = cProfile.Profile() if path is not None else None
+
+    def __enter__(self):
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path)
+
+
+def read_trace(filepath):
+    events = []
+    with open(filepath, 'r') as f:
+        for line in f:
+            if line.strip():
+                events.append(json.loads(line))
+    return events
+
+
+def wall_seconds(events):
+    """Seconds during which at least one of the events was running."""
+    total = 0
+    end = None
+    for event in sorted(events, key=lambda event: event['ts']):
+        event_end = event['ts'] + event['dur']
+        if end is None or event['ts'] > end:
+            total += event['dur']
+            end = event_end
+        elif event_end > end:
+            total += event_end - end
+            end = event_end
+    return total / 1e6
+
+
+def summarize(events):
+    """Per (category, name) totals of the complete events of a trace, in order of busy seconds."""
+    groups = {}
+    for event in events:
+        if event.get('ph') == 'X':
+            groups.setdefault((event['cat'], event['name']), []).append(event)
+    summary = []
+    for (cat, name), group in groups.items():
+        row = {'cat': cat, 'name': name, 'count': len(group), 'busy': sum(event['dur'] for event in group) / 1e6,
+               'wall': wall_seconds(group)}
+        for key in SUMMED_ARGS:
+            row[key] = sum(event['args'].get(key, 0) for event in group)
+        summary.append(row)
+    return sorted(summary, key=lambda row: row['busy'], reverse=True)
+
+
+def str_summary(summary):
+    res = '{:<10} {:<24} {:>8} {:>10} {:>10} {:>6} {:>10} {:>8} {:>10} {:>10}\n'.format(
+            'cat', 'name', 'count', 'busy s', 'wall s', 'par', 'audio s', 'RTF', 'read MB', 'write MB')
+    for row in summary:
+        parallelism = row['busy'] / row['wall'] if row['wall'] else 0
+        rtf = '{:8.4f}'.format(row['busy'] / row['audio_seconds']) if row['audio_seconds'] else '{:>8}'.format('-')
+        res += '{:<10} {:<24} {:>8} {:>10.2f} {:>10.2f} {:>6.1f} {:>10.1f} {} {:>10.1f} {:>10.1f}\n'.format(
+                row['cat'], row['name'][:24], row['count'], row['busy'], row['wall'], parallelism,
+                row['audio_seconds'], rtf, row['bytes_read'] / 2 ** 20, row['bytes_written'] / 2 ** 20)
+    spawns = sum(row['count'] for row in summary if row['cat'] == 'spawn')
+    res += 'Processes spawned: {}\n'.format(spawns)
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the traces written with {} set: time, audio, bytes \
+            and real-time factor per stage, per-utterance step and spawned program.'.format(TRACE_ENV))
+    parser.add_argument('trace', type=str, nargs='+',
+            help='Trace files (JSON lines of trace events).')
+    parser.add_argument('--chrome', type=str, metavar='path',
+            help='Also write the events as a Chrome trace JSON file.')
+    args = parser.parse_args()
+
+    events = []
+    for filepath in args.trace:
+        events.extend(read_trace(filepath))
+    print(str_summary(summarize(events)), end='')
+    if args.chrome is not None:
+        with open(args.chrome, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,113 @@
+"""
+Persistent cache of the per-utterance measurements made by levels.py.
+
+Measurements are stored in SQLite keyed by utterance ID and the path of the
+audio source, along with the mtime and size of the source when it was
+measured. An entry is only used while the source file is unchanged, so the WSJ
+test sets are measured once and reused by every trial that only changes the
+noise.
+
+usage: level_cache.py [-h] [--cache path] [--nj N]
+                      [--sph2pipe path/to/sph2pipe] dataPath [dataPath ...]
+
+Warms up the cache with every utterance in dataPath/wav.scp.
+"""
+import os
+import argparse
+import sqlite3
+
+from mix_engine import ARK_OFFSET_RE
+from levels import LEVEL_FIELDS, analyze_entries, read_wavscp
+
+
+CACHE_DIR = os.environ.get('MIX_WSJ_NOISE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'mix_wsj_noise'))
+LEVEL_CACHE_PATH = os.path.join(CACHE_DIR, 'levels.sqlite')
+
+
+def scp_source(scp_cmd):
+    """
+    The audio file read by a wav.scp entry, the last argument that is a file or the archive of an
+    `ark:offset` entry. None for other commands.
+    """
+    for token in reversed(scp_cmd.split(' ')):
+        if os.path.isfile(token):
+            return os.path.abspath(token)
+        match = ARK_OFFSET_RE.match(token)
+        if match is not None and os.path.isfile(match.group(1)):
+            return os.path.abspath(match.group(1))
+    return None
+
+
+def fingerprint(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def open_cache(cache_path=LEVEL_CACHE_PATH):
+    if os.path.dirname(cache_path) and not os.path.isdir(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+    conn = sqlite3.connect(cache_path)
+    conn.execute('CREATE TABLE IF NOT EXISTS levels (utt_id TEXT, path TEXT, mtime_ns INTEGER, size INTEGER, {}, '
+                 'PRIMARY KEY (utt_id, path))'.format(', '.join('{} REAL'.format(field) for field in LEVEL_FIELDS)))
+    return conn
+
+
+def cached_levels(entries, cache_path=LEVEL_CACHE_PATH, nj=None):
+    """
+    Same as levels.analyze_entries, but only the utterances without a valid cache entry are
+    analyzed. Entries whose source can't be determined are always analyzed and never stored.
+    """
+    conn = open_cache(cache_path)
+    table = {}
+    misses = []
+    keys = {}
+    query = 'SELECT mtime_ns, size, {} FROM levels WHERE utt_id = ? AND path = ?'.format(', '.join(LEVEL_FIELDS))
+    for utt_id, scp_cmd in entries:
+        source = scp_source(scp_cmd)
+        if source is None:
+            misses.append((utt_id, scp_cmd))
+            continue
+        key = (source,) + fingerprint(source)
+        row = conn.execute(query, (utt_id, source)).fetchone()
+        if row is not None and tuple(row[:2]) == key[1:]:
+            table[utt_id] = dict(zip(LEVEL_FIELDS, row[2:]))
+        else:
+            misses.append((utt_id, scp_cmd))
+            keys[utt_id] = key
+
+    if misses:
+        measured = analyze_entries(misses, nj)
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO levels VALUES (?, ?, ?, ?, {})'.format(
+                                 ', '.join('?' * len(LEVEL_FIELDS))),
+                             [(utt_id,) + keys[utt_id] + tuple(levels[field] for field in LEVEL_FIELDS)
+                              for utt_id, levels in measured.items() if utt_id in keys])
+        table.update(measured)
+    conn.close()
+    return table
+
+
+if __name__ == '__main__':
+
+    def dir_path(string):
+        if os.path.isdir(string):
+            return string
+        else:
+            raise NotADirectoryError(string)
+
+    parser = argparse.ArgumentParser(description='Measure the levels of every utterance in the given Kaldi data \
+            directories and store them in the level cache used by mix_wsj_noise.py.')
+    parser.add_argument('dataPath', type=dir_path, nargs='+',
+            help='Path to the dataset in the data directory (i.e. data/test_dev93) containing a wav.scp.')
+    parser.add_argument('--cache', type=str, metavar='path', default=LEVEL_CACHE_PATH,
+            help='Path to the cache database. Default is {}'.format(LEVEL_CACHE_PATH))
+    parser.add_argument('--nj', type=int, metavar='N',
+            help='Number of processes to measure with. Defaults to the number of cores.')
+    parser.add_argument('--sph2pipe', type=str, metavar='path/to/sph2pipe',
+            help='Path to sph2pipe if it is not on the path.')
+    args = parser.parse_args()
+
+    for data_path in args.dataPath:
+        entries = read_wavscp(os.path.join(data_path, 'wav.scp'), args.sph2pipe)
+        cached_levels(entries, args.cache, args.nj)
+        print('{}: {} utterances'.format(data_path, len(entries)))
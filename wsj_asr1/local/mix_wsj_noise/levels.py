@@ -0,0 +1,112 @@
+"""
+Single pass level analysis of the utterances in a wav.scp.
+
+Every utterance is decoded once and its peak, RMS and active speech level are
+computed on the samples with NumPy. The active speech level follows ITU-T P.56
+method B: the envelope is the rectified signal smoothed by two cascaded one pole
+filters, a sample is active while the envelope was above a threshold within the
+hangover time, and the active level is the level of the active samples at the
+threshold which sits 15.9 dB below it.
+
+Levels are in dB relative to full scale, like sox stats. Utterances are analyzed
+in a process pool so throughput scales with the number of cores.
+"""
+import os
+from multiprocessing import Pool
+import numpy as np
+from scipy.signal import lfilter
+
+from mix_engine import read_scp_audio, scp_command
+from instrumentation import span
+
+
+LEVEL_FIELDS = ('peak', 'rms', 'active', 'activity', 'duration')
+P56_TIME_CONSTANT = 0.03    # Envelope smoothing in seconds
+P56_HANGOVER = 0.2          # Seconds
+P56_MARGIN = 15.9           # dB between the active level and the activity threshold
+
+
+def power_db(power):
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(power)
+
+
+def active_speech_level(samples, srate):
+    """Return the P.56 active speech level (dB) and the fraction of samples that are active."""
+    samples = samples.astype(np.float64)
+    n = len(samples)
+    if n == 0 or not np.any(samples):
+        return -np.inf, 0.0
+    g = np.exp(-1 / (srate * P56_TIME_CONSTANT))
+    envelope = lfilter([(1 - g) ** 2], [1, -2 * g, g ** 2], np.abs(samples))
+    energy = np.sum(samples ** 2)
+
+    # Thresholds at every power of 2 of full scale. A sample is active if the envelope
+    # crossed the threshold within the last `hangover` samples.
+    thresholds = 2.0 ** np.arange(-16, 1)
+    hangover = int(round(P56_HANGOVER * srate))
+    above = envelope[None, :] >= thresholds[:, None]
+    counts = np.cumsum(above, axis=1, dtype=np.int32)
+    lagged = np.zeros_like(counts)
+    if n > hangover + 1:
+        lagged[:, hangover + 1:] = counts[:, :n - hangover - 1]
+    nactive = np.count_nonzero(counts - lagged, axis=1)
+
+    with np.errstate(divide='ignore'):
+        active_levels = power_db(energy / np.maximum(nactive, 1))
+        differences = active_levels - 20 * np.log10(thresholds)
+    differences[nactive == 0] = -np.inf
+
+    # First threshold where the active level is less than the margin above it, interpolate
+    # between it and the previous threshold like the reference implementation.
+    below = np.flatnonzero(differences <= P56_MARGIN)
+    if len(below) == 0 or below[0] == 0:
+        j = below[0] if len(below) else len(thresholds) - 1
+        return active_levels[j], nactive[j] / n
+    j = below[0]
+    lo, hi = differences[j - 1], differences[j]
+    frac = (lo - P56_MARGIN) / (lo - hi) if lo != hi else 0
+    level = active_levels[j - 1] + frac * (active_levels[j] - active_levels[j - 1])
+    activity = (nactive[j - 1] + frac * (nactive[j] - nactive[j - 1])) / n
+    return float(level), float(activity)
+
+
+def analyze_samples(samples, srate):
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    peak = np.max(np.abs(samples)) if samples.size else 0
+    rms = np.sqrt(np.mean(samples.astype(np.float64) ** 2)) if samples.size else 0
+    active, activity = active_speech_level(samples, srate)
+    return {'peak': float(power_db(peak ** 2)),
+            'rms': float(power_db(rms ** 2)),
+            'active': float(active),
+            'activity': float(activity),
+            'duration': len(samples) / srate}
+
+
+def _analyze_entry(entry):
+    utt_id, scp_cmd = entry
+    samples, srate = read_scp_audio(scp_cmd)
+    with span('levels', 'utterance', audio_seconds=len(samples) / srate):
+        return utt_id, analyze_samples(samples, srate)
+
+
+def read_wavscp(wavscp_path, sph2pipe=None):
+    entries = []
+    with open(wavscp_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append((line.split(' ')[0], scp_command(line, sph2pipe)))
+    return entries
+
+
+def analyze_entries(entries, nj=None):
+    """Analyze a list of (utt_id, scp_cmd) pairs, returning a utt_id -> levels table."""
+    if nj is None:
+        nj = os.cpu_count()
+    nj = max(1, min(nj, len(entries)))
+    if nj == 1:
+        return dict(map(_analyze_entry, entries))
+    with Pool(nj) as pool:
+        return dict(pool.imap(_analyze_entry, entries, chunksize=max(1, len(entries) // (4 * nj))))
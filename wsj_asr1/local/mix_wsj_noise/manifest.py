@@ -0,0 +1,129 @@
+"""
+Versioned manifest of every mixing decision of mix_wsj_noise.py.
+
+A manifest is written for each augmented data directory, next to its wav.scp,
+as JSON lines. The first line is the header:
+
+    {"format": "mix_wsj_noise-manifest", "version": 1, "backend": "numpy", "seed": 1234,
+     "condition": {"snr": 15.0, "mix_level": 0.0, "start": 15.0},
+     "strings": ["noise/001/a.wav", ...], "noise_peaks": [0.71, ...], "fields": ["utt_id", ...]}
+
+It holds the string table of noise source paths, which records refer to by
+index, the measured peak of every noise source (numpy backend) and the
+parameters shared by all utterances. Every other line is the record of one
+utterance, a JSON array in the order of the header fields:
+
+    ["011c0201", 0, 15.0, 7.1, "sph2pipe -f wav 011c0201.wv1", 0, false, -15.0, false, 0.0, null, null]
+
+Levels are in dB, with the relative flag of the gain effects of
+mix_wsj_noise.py. The noise gain applies to the noise path of the string
+table: for the sox backend that is the preprocessed track, already at its
+level. ManifestReader records the byte offset of every record when opened, so
+looking up an utterance parses only its line.
+"""
+import os
+import json
+
+
+MANIFEST_FORMAT = 'mix_wsj_noise-manifest'
+MANIFEST_VERSION = 1
+MANIFEST_FIELDS = ('utt_id', 'noise', 'noise_start', 'duration', 'speech', 'speech_level', 'speech_relative',
+                   'noise_level', 'noise_relative', 'mix_level', 'speech_peak', 'speech_active')
+
+
+def manifest_name(job_num=None):
+    return 'mix_manifest' if job_num is None else 'mix_manifest.{:02d}'.format(job_num)
+
+
+def write_manifest_header(f, noise_paths, backend, seed, condition, noise_peaks=None):
+    header = {'format': MANIFEST_FORMAT,
+              'version': MANIFEST_VERSION,
+              'backend': backend,
+              'seed': seed,
+              'condition': condition,
+              'strings': [str(path) for path in noise_paths],
+              'noise_peaks': None if noise_peaks is None else [float(peak) for peak in noise_peaks],
+              'fields': list(MANIFEST_FIELDS)}
+    f.write(json.dumps(header) + '\n')
+
+
+def write_manifest_record(f, record):
+    """Write the record of one utterance, a dict with every field of MANIFEST_FIELDS."""
+    f.write(json.dumps([record[field] for field in MANIFEST_FIELDS]) + '\n')
+
+
+def is_manifest(filepath):
+    """Whether a file is a manifest, as opposed to the text noise_utt_map that preceded it."""
+    with open(filepath, 'r') as f:
+        return f.read(1) == '{'
+
+
+class ManifestReader:
+    """
+    Indexed reader of a manifest. Records are dicts of the header fields with the noise path
+    resolved, looked up by utterance id or iterated in file order.
+    """
+
+    def __init__(self, filepath):
+        self.path = filepath
+        self._f = open(filepath, 'rb')
+        self.header = json.loads(self._f.readline())
+        if self.header.get('format') != MANIFEST_FORMAT:
+            raise ValueError('{} is not a mix manifest'.format(filepath))
+        if self.header['version'] > MANIFEST_VERSION:
+            raise ValueError('{} is a version {} manifest, this reader supports up to version {}'.format(
+                    filepath, self.header['version'], MANIFEST_VERSION))
+        self.fields = self.header['fields']
+        self.strings = self.header['strings']
+        # The id is the first element of every record, a string without escapes: ["uttId", ...
+        self._offsets = {}
+        offset = self._f.tell()
+        for line in self._f:
+            if line.strip():
+                self._offsets[line[2:line.index(b'"', 2)].decode('utf-8')] = offset
+            offset += len(line)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, utt_id):
+        return utt_id in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __getitem__(self, utt_id):
+        self._f.seek(self._offsets[utt_id])
+        return self._record(self._f.readline())
+
+    def _record(self, line):
+        record = dict(zip(self.fields, json.loads(line)))
+        record['noise_path'] = self.strings[record['noise']]
+        return record
+
+    def records(self):
+        """Every record in file order."""
+        self._f.seek(0)
+        self._f.readline()
+        for line in self._f:
+            if line.strip():
+                yield self._record(line)
+
+    def noise_index(self):
+        """utt_id -> index of its noise source in the string table, for every utterance."""
+        return {record['utt_id']: record['noise'] for record in self.records()}
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def find_manifest(data_dir, prefix=''):
+    """The manifest of a data directory or results directory (where files carry a test set prefix), or None."""
+    path = os.path.join(data_dir, prefix + manifest_name())
+    return path if os.path.isfile(path) else None
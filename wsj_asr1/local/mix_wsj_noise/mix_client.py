@@ -0,0 +1,54 @@
+"""
+Client of the mixing daemon of mix_wsj_noise.py --serve (see mix_daemon.py).
+
+usage: mix_client.py socket uttId [condition]
+       mix_client.py socket --stats
+       mix_client.py socket --shutdown
+
+Writes the mix of an utterance (condition 0 by default) to stdout as a wave
+file, the counters of the daemon as JSON with --stats, or stops the daemon with
+--shutdown. It runs once per read of an utterance, so it only imports socket
+and sys and is meant to be run with `python3 -S`.
+"""
+import sys
+import socket
+
+
+def request(socket_path, line, out):
+    """Send a request line and copy the payload of the answer to out. Returns an error message or None."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    try:
+        client.sendall(line.encode('utf-8') + b'\n')
+        f = client.makefile('rb')
+        status = f.readline().decode('utf-8').split(' ', 1)
+        if status[0] != 'ok':
+            return status[-1].strip() or 'no answer'
+        remaining = int(status[1])
+        while remaining > 0:
+            chunk = f.read(min(remaining, 2 ** 20))
+            if not chunk:
+                return 'connection closed with {} bytes left'.format(remaining)
+            out.write(chunk)
+            remaining -= len(chunk)
+        return None
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        sys.exit(__doc__.strip().split('\n\n')[1])
+    socket_path, argument = sys.argv[1:3]
+    if argument == '--stats':
+        line = 'stats'
+    elif argument == '--shutdown':
+        line = 'shutdown'
+    else:
+        line = 'mix {} {}'.format(argument, sys.argv[3] if len(sys.argv) == 4 else 0)
+    error = request(socket_path, line, sys.stdout.buffer)
+    sys.stdout.buffer.flush()
+    if error is not None:
+        sys.exit('mix_client.py: {}'.format(error))
+    if argument == '--stats':
+        print()
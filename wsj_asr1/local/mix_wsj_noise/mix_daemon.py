@@ -0,0 +1,204 @@
+"""
+Mixing daemon of mix_wsj_noise.py --serve.
+
+Instead of rendering the mixes of the numpy backend up front, mix_wsj_noise.py
+can write a wav.scp whose entries run mix_client.py, and then keep serving the
+mixes on a Unix socket:
+
+    011c0201 /usr/bin/python3 -S .../mix_client.py /tmp/mix.sock 011c0201 0 |
+
+The daemon keeps what every read would otherwise load again: the noise tracks
+stay mapped from the noise cache, the speech levels are measured once, the mixing
+processes are started once, and the mixes already rendered are kept in a
+bounded LRU cache. Connections are handled by a pool of --nj threads and the
+mixing by a pool of --nj processes, so the --nj feature extraction jobs of
+run.sh are served concurrently.
+
+A request is one line, answered with a line and a payload:
+
+    mix <utt_id> <condition>    ok <nbytes>\n<wave file bytes>
+    stats                       ok <nbytes>\n<JSON of the counters>
+    shutdown                    ok 0\n
+
+or `error <message>\n`. The counters (requests, mix cache hits and misses,
+bytes served and request seconds) are written to stderr when the daemon stops,
+on a shutdown request, SIGTERM or SIGINT.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import threading
+import socketserver
+from collections import OrderedDict
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import span
+
+
+MIX_CACHE_SIZE = 2 ** 30    # Bytes of rendered mixes kept
+CLIENT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'mix_client.py')
+
+
+def client_command(socket_path, utt_id, condition=0):
+    """The wav.scp command reading the mix of one utterance and condition from the daemon."""
+    return '{} -S {} {} {} {} |'.format(sys.executable, CLIENT_PATH, os.path.abspath(socket_path), utt_id,
+                                        condition)
+
+
+class MixCache:
+    """LRU cache of the rendered mixes of utterances, bounded in bytes."""
+
+    def __init__(self, max_bytes=MIX_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, utt_id):
+        with self.lock:
+            mixes = self.entries.get(utt_id)
+            if mixes is not None:
+                self.entries.move_to_end(utt_id)
+            return mixes
+
+    def put(self, utt_id, mixes):
+        size = sum(len(mix) for mix in mixes)
+        with self.lock:
+            if utt_id in self.entries or size > self.max_bytes:
+                return
+            self.entries[utt_id] = mixes
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= sum(len(mix) for mix in evicted)
+
+
+class MixServer(socketserver.UnixStreamServer):
+    """
+    Serves the mixes of jobs, a utt_id -> job mapping of mix_wsj_noise._mix_job jobs, rendered by a
+    process pool running mix_job.
+    """
+
+    def __init__(self, socket_path, jobs, pool, mix_job, nj, cache_size=MIX_CACHE_SIZE):
+        self.jobs = jobs
+        self.pool = pool
+        self.mix_job = mix_job
+        self.cache = MixCache(cache_size)
+        self.executor = ThreadPoolExecutor(nj)
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'hits': 0, 'misses': 0, 'bytes_served': 0, 'request_seconds': 0.0}
+        super().__init__(socket_path, None)
+
+    def process_request(self, request, client_address):
+        # Requests are queued for a bounded pool instead of a thread each
+        self.executor.submit(self.handle_request_thread, request)
+
+    def handle_request_thread(self, request):
+        try:
+            self.respond(request)
+        except Exception as e:
+            self.count(errors=1)
+            print('Request failed: {}'.format(e), file=sys.stderr)
+        finally:
+            self.shutdown_request(request)
+
+    def count(self, **counts):
+        with self.stats_lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def mixes(self, utt_id):
+        """The wave file bytes of every condition of an utterance."""
+        mixes = self.cache.get(utt_id)
+        if mixes is not None:
+            self.count(hits=1)
+            return mixes
+        self.count(misses=1)
+        mixes, _ = self.pool.apply(self.mix_job, (self.jobs[utt_id],))
+        self.cache.put(utt_id, mixes)
+        return mixes
+
+    def respond(self, request):
+        start = time.perf_counter()
+        f = request.makefile('rb')
+        words = f.readline().decode('utf-8').split()
+        f.close()
+        if not words:
+            return
+        if words[0] == 'mix' and len(words) == 3:
+            with span('serve', 'utterance', utt_id=words[1]) as s:
+                if words[1] not in self.jobs:
+                    request.sendall('error unknown utterance {}\n'.format(words[1]).encode('utf-8'))
+                    self.count(errors=1)
+                    return
+                payload = self.mixes(words[1])[int(words[2])]
+                s.add(bytes_written=len(payload))
+        elif words[0] == 'stats':
+            payload = json.dumps(self.stats).encode('utf-8')
+        elif words[0] == 'shutdown':
+            payload = b''
+            # shutdown() waits for serve_forever to return, so it is called from another thread
+            threading.Thread(target=self.shutdown).start()
+        else:
+            request.sendall('error bad request {}\n'.format(' '.join(words)).encode('utf-8'))
+            self.count(errors=1)
+            return
+        request.sendall('ok {}\n'.format(len(payload)).encode('utf-8') + payload)
+        self.count(requests=1, bytes_served=len(payload), request_seconds=time.perf_counter() - start)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def str_stats(stats):
+    lookups = stats['hits'] + stats['misses']
+    res = 'Requests: {}\t\tErrors: {}\t\tServed: {:.1f} MB\n'.format(stats['requests'], stats['errors'],
+                                                                    stats['bytes_served'] / 2 ** 20)
+    res += 'Mix cache hits: {} / {} ({:.1%})\t\tMean request: {:.2f} ms\n'.format(
+            stats['hits'], lookups, stats['hits'] / lookups if lookups else 0,
+            1000 * stats['request_seconds'] / stats['requests'] if stats['requests'] else 0)
+    return res
+
+
+def remove_stale_socket(socket_path):
+    """Remove the socket file of a daemon that is gone. Raises if a daemon still listens on it."""
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(socket_path)
+        return
+    finally:
+        probe.close()
+    raise FileExistsError('A mixing daemon is already serving on {}'.format(socket_path))
+
+
+def serve(socket_path, jobs, noise_tracks, mix_job, init_worker, nj=None, feature_options=None,
+          cache_size=MIX_CACHE_SIZE):
+    """
+    Serve the mixes of jobs on socket_path until a shutdown request, SIGTERM or SIGINT. The mixing
+    processes are started with init_worker(noise_tracks, feature_options) and run mix_job.
+    """
+    if nj is None:
+        nj = os.cpu_count()
+    remove_stale_socket(socket_path)
+    with Pool(nj, initializer=init_worker, initargs=(noise_tracks, feature_options)) as pool:
+        server = MixServer(socket_path, jobs, pool, mix_job, nj, cache_size)
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        print('Serving {} utterances on {}'.format(len(jobs), socket_path), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+            print(str_stats(server.stats), end='', file=sys.stderr)
+    return server.stats
@@ -0,0 +1,301 @@
+"""
+In-process speech and noise mixing with NumPy.
+
+The sox backend of mix_wsj_noise.py writes a pipe chain of sox commands into
+wav.scp which is re-run every time Kaldi reads the utterance. These functions
+do the same gain, trim, SNR scaling and sum on arrays so each mix is rendered
+once and written to disk.
+
+Levels follow sox conventions: dB relative to full scale, where an absolute
+level normalizes the peak (`gain -n db`) and a relative level is a plain gain
+(`gain db`).
+"""
+import io
+import os
+import re
+import wave
+import subprocess
+import numpy as np
+
+from sphere import SPHERE_MAGIC, read_header, read_sphere
+from instrumentation import span, traced_run
+
+
+BITDEPTH=16
+CHUNK_SIZE=2 ** 16     # Samples per chunk of the streaming mixer
+# rxfilename of an object at a byte offset of a Kaldi archive, i.e. data/test_dev93/augmented_wav.ark:1234
+ARK_OFFSET_RE = re.compile(r'^(.+):(\d+)$')
+
+
+def db_to_gain(db):
+    return 10 ** (db / 20)
+
+
+def gain_factor(level, relative, peak):
+    """Linear gain of a sox gain effect on a signal with the given peak amplitude."""
+    if relative:
+        return db_to_gain(level)
+    if peak == 0:   # Silence can't be normalized, sox leaves it alone as well
+        return 1
+    return db_to_gain(level) / peak
+
+
+def apply_gain(samples, level, relative):
+    peak = np.max(np.abs(samples)) if samples.size and not relative else 0
+    return samples * np.float32(gain_factor(level, relative, peak))
+
+
+def read_wav(f):
+    """Read a PCM wave file (path or file object) as float32 samples in [-1, 1) and its sample rate."""
+    with wave.open(f, 'rb') as w:
+        nchannels = w.getnchannels()
+        sampwidth = w.getsampwidth()
+        srate = w.getframerate()
+        data = w.readframes(w.getnframes())
+    if sampwidth == 1:      # 8 bit wave is unsigned
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sampwidth in (2, 4):
+        dtype = '<i{}'.format(sampwidth)
+        samples = np.frombuffer(data, dtype=dtype).astype(np.float32) / 2 ** (8 * sampwidth - 1)
+    else:
+        raise ValueError('Unsupported sample width of {} bytes'.format(sampwidth))
+    if nchannels > 1:
+        samples = samples.reshape(-1, nchannels)
+    return samples, srate
+
+
+def wav_data_offset(f):
+    """Byte offset of the samples in the data chunk of an open wave file."""
+    f.seek(12)     # RIFF size WAVE
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError('No data chunk in {}'.format(getattr(f, 'name', f)))
+        chunk_id, size = header[:4], int.from_bytes(header[4:], 'little')
+        if chunk_id == b'data':
+            return f.tell()
+        f.seek(size + (size & 1), 1)
+
+
+def map_wav(path):
+    """
+    Memory-map the samples of a PCM wave file as integers, shape (samples,) or (samples, channels),
+    and return them with the sample rate. Slicing the map only reads the sliced part of the file.
+    """
+    with open(path, 'rb') as f:
+        with wave.open(f, 'rb') as w:
+            nchannels = w.getnchannels()
+            sampwidth = w.getsampwidth()
+            srate = w.getframerate()
+            nframes = w.getnframes()
+        offset = wav_data_offset(f)
+    if sampwidth not in (2, 4):
+        raise ValueError('Unsupported sample width of {} bytes'.format(sampwidth))
+    samples = np.memmap(path, dtype='<i{}'.format(sampwidth), mode='r', offset=offset, shape=(nframes * nchannels,))
+    if nchannels > 1:
+        samples = samples.reshape(-1, nchannels)
+    return samples, srate
+
+
+def as_float(samples):
+    """Integer PCM samples as float32 in [-1, 1), float samples unchanged."""
+    if np.issubdtype(samples.dtype, np.integer):
+        return samples.astype(np.float32) / 2 ** (8 * samples.dtype.itemsize - 1)
+    return np.asarray(samples, dtype=np.float32)
+
+
+def scp_command(wavscp_line, sph2pipe=None):
+    """The rxfilename of a wav.scp line without the utterance id and trailing pipe symbol."""
+    scp_cmd = wavscp_line.strip().split(' ', 1)[1].rstrip('|').strip()
+    if sph2pipe is not None:
+        scp_cmd = os.path.join(os.path.dirname(sph2pipe), scp_cmd)
+    return scp_cmd
+
+
+def read_audio(path):
+    """Read a wave or SPHERE file as float32 samples and its sample rate."""
+    with open(path, 'rb') as f:
+        magic = f.read(len(SPHERE_MAGIC))
+    if magic == SPHERE_MAGIC:
+        return read_sphere(path)
+    return read_wav(path)
+
+
+def read_ark_wav(path, offset):
+    """Read the wave file at a byte offset of a Kaldi wav archive."""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return read_wav(f)
+
+
+def read_sph2pipe(args):
+    """
+    Read the file of a `sph2pipe [-f fmt] [-p] [-c n] file` command natively. None for other options
+    and for shorten compressed files, which sph2pipe decodes faster.
+    """
+    channel = None
+    i = 1
+    while i < len(args) - 1:
+        if args[i] == '-f':
+            i += 2
+        elif args[i] == '-p':
+            i += 1
+        elif args[i] == '-c':
+            channel = int(args[i + 1]) - 1
+            i += 2
+        else:
+            return None
+    if i != len(args) - 1 or not os.path.isfile(args[-1]):
+        return None
+    with open(args[-1], 'rb') as f:
+        if 'shorten' in read_header(f)[0].get('sample_coding', 'pcm'):
+            return None     # The shorten decoder of sphere.py is slower than running sph2pipe
+    samples, srate = read_sphere(args[-1])
+    if channel is not None and samples.ndim > 1:
+        samples = samples[:, channel]
+    return samples, srate
+
+
+def _read_scp_audio(scp_cmd):
+    args = scp_cmd.split()
+    if len(args) == 1:
+        match = ARK_OFFSET_RE.match(args[0])
+        if match is not None and not os.path.isfile(args[0]):
+            return read_ark_wav(match.group(1), int(match.group(2)))
+        return read_audio(args[0])
+    if os.path.basename(args[0]) == 'sph2pipe':
+        audio = read_sph2pipe(args)
+        if audio is not None:
+            return audio
+    res = traced_run(scp_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        raise Exception('code {} raised by: {}\n{}'.format(res.returncode, scp_cmd, res.stderr.decode('utf-8')))
+    return read_wav(io.BytesIO(res.stdout))
+
+
+def read_scp_audio(scp_cmd):
+    """
+    Read the audio of a wav.scp entry, either a pipe command (without the trailing |) or a file
+    path. sph2pipe commands of PCM files are read with the native SPHERE reader, other commands are run.
+    Traced as a read_audio span with the duration and the 16 bit PCM size of the audio.
+    """
+    with span('read_audio', 'utterance') as s:
+        samples, srate = _read_scp_audio(scp_cmd)
+        s.add(audio_seconds=len(samples) / srate, bytes_read=samples.size * BITDEPTH // 8)
+    return samples, srate
+
+
+def quantize(samples, bitdepth=BITDEPTH):
+    """Float samples to signed integer PCM."""
+    full_scale = 2 ** (bitdepth - 1)
+    return np.clip(np.round(samples * full_scale), -full_scale, full_scale - 1).astype('<i{}'.format(bitdepth // 8))
+
+
+def write_wav(f, samples, srate, bitdepth=BITDEPTH):
+    """Quantize float samples to signed integer PCM and write them as a wave file (path or file object)."""
+    pcm = quantize(samples, bitdepth)
+    with wave.open(f, 'wb') as w:
+        w.setnchannels(1 if pcm.ndim == 1 else pcm.shape[1])
+        w.setsampwidth(bitdepth // 8)
+        w.setframerate(srate)
+        w.writeframes(pcm.tobytes())
+
+
+def write_wav_stream(f, chunks, srate, nframes, nchannels=1, bitdepth=BITDEPTH):
+    """
+    Write an iterable of float sample chunks as a wave file (path or file object). The header is
+    written for nframes up front so the output may be a pipe.
+    """
+    with wave.open(f, 'wb') as w:
+        w.setnchannels(nchannels)
+        w.setsampwidth(bitdepth // 8)
+        w.setframerate(srate)
+        w.setnframes(nframes)
+        for chunk in chunks:
+            w.writeframesraw(quantize(chunk, bitdepth).tobytes())
+
+
+def wav_bytes(samples, srate, bitdepth=BITDEPTH):
+    f = io.BytesIO()
+    write_wav(f, samples, srate, bitdepth)
+    return f.getvalue()
+
+
+def write_ark_entry(f, utt_id, data):
+    """
+    Append an entry to a Kaldi archive opened in binary mode. Returns the offset of data, which
+    Kaldi reads with the `path:offset` rxfilename.
+    """
+    f.write('{} '.format(utt_id).encode('utf-8'))
+    offset = f.tell()
+    f.write(data)
+    return offset
+
+
+def trim(samples, start, nsamples):
+    """Same as `sox trim start duration` in samples, short sources give a short segment."""
+    return samples[start:start + nsamples]
+
+
+def _peak(chunks):
+    return max((np.max(np.abs(chunk)) for chunk in chunks if chunk.size), default=np.float32(0))
+
+
+def iter_mix_chunks(speech, noise, noise_start, speech_level, speech_relative, mix_level, noise_gain=1,
+                    chunk_size=CHUNK_SIZE):
+    """
+    Mix one utterance like mix_utterance, yielding the mix in chunks of chunk_size samples. speech
+    and noise may be integer or float memory maps: the noise is sliced at noise_start directly so
+    seeking costs the same at any offset, and memory use does not depend on the length of either.
+    The speech peak and the mix peak are found in first passes over the chunks.
+    """
+    def speech_chunks():
+        for start in range(0, len(speech), chunk_size):
+            yield as_float(speech[start:start + chunk_size])
+
+    speech_peak = _peak(speech_chunks()) if not speech_relative else 0
+    speech_gain = np.float32(gain_factor(speech_level, speech_relative, speech_peak))
+    noise_gain = np.float32(noise_gain)
+
+    def mix_chunks():
+        for start, chunk in zip(range(0, len(speech), chunk_size), speech_chunks()):
+            chunk = chunk * speech_gain
+            segment = as_float(trim(noise, noise_start + start, len(chunk)))
+            chunk[:len(segment)] += segment * noise_gain
+            yield chunk
+
+    mix_gain = np.float32(gain_factor(mix_level, False, _peak(mix_chunks())))
+    for chunk in mix_chunks():
+        yield chunk * mix_gain
+
+
+def mix_utterance(speech, noise, noise_start, speech_level, speech_relative, mix_level, noise_gain=1):
+    """
+    Mix one utterance the way the sox backend does: apply the speech gain, trim the
+    noise to the utterance and scale it by noise_gain, sum both and normalize the
+    peak of the result to mix_level dB.
+    """
+    chunks = list(iter_mix_chunks(speech, noise, noise_start, speech_level, speech_relative, mix_level, noise_gain))
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+
+
+def mix_conditions(speech, noise, noise_starts, speech_level, speech_relative, noise_gains, mix_levels):
+    """
+    Mix one utterance under every combination of noise start (in samples), linear noise gain
+    and mix level at once. The gains are an outer product over the conditions so the speech
+    and each noise segment are only read once. Returns an array of shape
+    (len(noise_starts), len(noise_gains), len(mix_levels), len(speech)). speech and noise may be
+    integer or float arrays, as in iter_mix_chunks.
+    """
+    speech = apply_gain(as_float(speech), speech_level, speech_relative)
+    segments = np.zeros((len(noise_starts), len(speech)), dtype=np.float32)
+    for i, noise_start in enumerate(noise_starts):
+        segment = trim(noise, noise_start, len(speech))
+        segments[i, :len(segment)] = as_float(segment)
+    noise_gains = np.asarray(noise_gains, dtype=np.float32)
+    mixes = speech[None, None, :] + noise_gains[None, :, None] * segments[:, None, :]
+    peaks = np.max(np.abs(mixes), axis=-1) if len(speech) else np.zeros(mixes.shape[:2], dtype=np.float32)
+    levels = db_to_gain(np.asarray(mix_levels, dtype=np.float64))
+    # Silence can't be normalized, sox leaves it alone as well
+    scales = np.where(peaks[:, :, None] == 0, 1, levels[None, None, :] / np.where(peaks == 0, 1, peaks)[:, :, None])
+    return mixes[:, :, None, :] * scales[:, :, :, None].astype(np.float32)
@@ -1,26 +1,56 @@
 """
 Mix speech following the Kaldi file structures with noise at various levels.
 
-usage: mix_wsj_noise.py [-h] [--mix-snr snr] [--speech-level db]
-                        [--noise-level db] [--mix-level db]
-                        [--noise-timestamp time] [--noiseROI filepath]
-                        [--sph2pipe path/to/sph2pipe] [--job]
-                        [--dry-run] [--noise-ext]dataPath noiseFile
+usage: mix_wsj_noise.py [-h] [--mix-snr snr [snr ...]] [--speech-level db]
+                        [--noise-level db] [--mix-level db [db ...]]
+                        [--noise-timestamp time [time ...]] [--noiseROI filepath]
+                        [--active-noise]
+                        [--sph2pipe path/to/sph2pipe] [--job] [--nj N] [--seed N]
+                        [--level-cache path] [--noise-cache path]
+                        [--noise-cache-size GB]
+                        [--backend {sox,numpy}] [--materialize]
+                        [--features featDir] [--fbank-config path]
+                        [--pitch-config path] [--serve socket] [--profile path]
+                        [--dry-run]
+                        [--noise-ext]dataPath noiseFile
+
+Set $MIX_WSJ_NOISE_TRACE to a file to trace the stages, utterances and spawned
+processes of a run (see instrumentation.py).
 
 Note mp3 codec is normally not installed by default:
 $ sudo apt-get install libsox-fmt-mp3
 """
+import io
 import os
 import sys
+import time
+import shutil
 import argparse
 from math import log10
-import subprocess
-from random import randint
+from random import Random
+from multiprocessing import Pool
+import numpy as np
+
+from mix_engine import read_scp_audio, scp_command, write_wav, write_wav_stream, wav_bytes, write_ark_entry, \
+        gain_factor, mix_conditions, iter_mix_chunks, quantize
+from levels import read_wavscp
+from level_cache import LEVEL_CACHE_PATH, cached_levels
+from noise_cache import NOISE_CACHE_DIR, NOISE_CACHE_SIZE, NOISE_SRATE, decode_noise, load_noises
+from resample import file_properties, speech_properties
+from activity import read_roi, activity_index
+from noise_catalog import PREPROCESS_NOISE_DIR, search_tracks, probe, long_enough
+from manifest import manifest_name, write_manifest_header, write_manifest_record
+from instrumentation import span, profile
+from mix_daemon import client_command, serve
+from features import FBANK_OPTIONS, PITCH_OPTIONS, read_config, fbank_pitch, open_feature_outputs, \
+        write_feature_entry, close_feature_outputs
 
 
 BITDEPTH=16
 ENCODING='signed-integer'
-PREPROCESS_NOISE_DIR='preprocessed_noise_tracks'
+MIX_DIR='augmented_wav'
+# Kaldi data directory files copied for each condition of a sweep
+KALDI_DATA_FILES=('text', 'utt2spk', 'spk2utt', 'spk2gender', 'utt2dur', 'utt2uniq', 'segments', 'reco2file_and_channel')
 
 
 def build_parser():
@@ -50,18 +80,21 @@ def build_parser():
                     distribution. When using a directory, to search for noise sources, the \
                     `--noise-ext` argument MUST be provided. A file will be generated mapping \
                     the utterance ID to the noise source. The search will descend 1 directory \
-                    deep and gather all files with the matching extension. If `--noise-timestamp` \
+                    deep and gather all files with the matching extension, from the noise catalog \
+                    of the directory (see noise_catalog.py). Files that end before the largest \
+                    `--noise-timestamp` are not mixed. If `--noise-timestamp` \
                     is not given, or there is no ROI mapping file, or the specified file is not \
                     in the ROI map, then start mixing from beginning.')
     parser.add_argument('--noise-ext', type=str, metavar='ext',
             help='Used only when noiseFile is a directory. This is used to search for noise files \
                     of a specified extension in the noiseFile directory in case there are other \
                     files in that folder.')
-    parser.add_argument('--mix-snr', type=str, metavar='snr',
+    parser.add_argument('--mix-snr', type=str, metavar='snr', nargs='+',
             help='Mix speech and noise at the specified SNR. snr can be given as db \
                     or a ratio. i.e. "2:1" would mix the speech signal at 2x the \
                     power of the noise. Default to mix at 1:1 (0dB). This overrides \
-                    all other level modifications.')
+                    all other level modifications. Several values run a sweep, see \
+                    --backend.')
     parser.add_argument('--speech-level', type=str, metavar='db',
             help='Adjust the speech mixing level. db can be a numeric value to \
                     specify absolute level to adjust the speech to or ~ can be \
@@ -72,38 +105,107 @@ def build_parser():
                     is mixed at. The noise level will be normalized to 0dB by \
                     default to accomadate the default 1:1 mix snr. This is also \
                     superceded by --mix-snr.')
-    parser.add_argument('--mix-level', type=float, metavar='db',
+    parser.add_argument('--mix-level', type=float, metavar='db', nargs='+',
             help='The level of the mix. Output level will match speech signal\
-                    by default. This option does not support relative levels.')
-    parser.add_argument('--noise-timestamp', type=float, metavar='time',
+                    by default. This option does not support relative levels. \
+                    Several values run a sweep, see --backend.')
+    parser.add_argument('--noise-timestamp', type=float, metavar='time', nargs='+',
             help='The start timestamp to trim the noise source from to match \
                     the utterance length. This will override --noiseROI. The \
-                    timestamp is in seconds from the start of the noise file.')
+                    timestamp is in seconds from the start of the noise file. \
+                    Several values run a sweep, see --backend.')
     parser.add_argument('--noiseROI', type=file_path, metavar='filepath',
             help='Path to the noise.roi file. This file contains the mapping from \
                     noise filename (unique) to a list of regions of interest (start\
                     /end times). This is superceded by --noise-timestamp. \
-                    (ROI is region of interest)')
+                    (ROI is region of interest) The noise of every utterance starts \
+                    at a random position of an active part of the regions of its \
+                    noise file, see activity.py for the format.')
+    parser.add_argument('--active-noise', action='store_true',
+            help='Start the noise of every utterance at a random position of an active \
+                    part of its noise file, so quiet intros and silent stems are not \
+                    mixed. With --noiseROI this applies to the files without regions. \
+                    This is superceded by --noise-timestamp.')
     parser.add_argument('--sph2pipe', type=file_path, metavar='path/to/sph2pipe',
-            help='Path to sph2pipe if it is not on the path. This is needed to \
-                    get the mix level of the final mix if --mix-level is not \
-                    specified.')
+            help='Path to sph2pipe if it is not on the path. PCM SPHERE files are read \
+                    natively, shorten compressed files (most of WSJ) and sph2pipe options \
+                    that can not be read natively are left to it, as is every read of the \
+                    wav.scp of the sox backend.')
     parser.add_argument('--job', type=int, metavar='xx',
-            help='When --mix-level is not specified, output mix will be set at \
-                    level of speech; this may take a while since `sox stats` must \
-                    be called on every file in the dataset to get its level. \
-                    This option will read a split wav.scp file following the \
+            help='This option will read a split wav.scp file following the \
                     GNU numeric split format:\n\
                     `$ split --numeric-suffixes -n l/njobs wav.scp wav.scp.`\n\
                     which outputs split files like: wav.scp.xx where xx is the \
                     split number. The suffix length is 2. Output will written \
-                    to the matching augmented_wav.scp.xx')
+                    to the matching augmented_wav.scp.xx. Prefer --nj.')
+    parser.add_argument('--nj', type=int, metavar='N',
+            help='Number of processes to mix with. The utterances are split between them \
+                    and the outputs are written in the order of wav.scp, the same for any N. \
+                    When --mix-level is not specified, output mix will be set at the peak \
+                    level of the speech, which is also measured by N processes. Defaults \
+                    to the number of cores. This replaces splitting the data for --job.')
+    parser.add_argument('--seed', type=int, metavar='N',
+            help='Seed of the random choice of noise source when noiseFile is a directory.')
+    parser.add_argument('--level-cache', type=str, metavar='path', default=LEVEL_CACHE_PATH,
+            help='Where the measured speech levels are cached between runs. Entries are \
+                    invalidated when the source audio changes. Default is {}'.format(LEVEL_CACHE_PATH))
+    parser.add_argument('--noise-cache', type=str, metavar='path', default=NOISE_CACHE_DIR,
+            help='Directory where the numpy backend caches decoded noise tracks. Tracks are \
+                    decoded once and every noise level or SNR is applied while mixing. \
+                    Default is {}'.format(NOISE_CACHE_DIR))
+    parser.add_argument('--noise-cache-size', type=float, metavar='GB', default=NOISE_CACHE_SIZE / 2 ** 30,
+            help='Size limit of the noise cache. The least recently used tracks are evicted \
+                    beyond it. Default is %(default)s')
+    parser.add_argument('--backend', type=str, choices=['sox', 'numpy'], default='sox',
+            help='How the mixes are produced. "sox" writes a sox pipe chain into the augmented \
+                    wav.scp which is executed on every read of the utterance. "numpy" mixes \
+                    every utterance once in this process, writes the mixes to dataPath/{0} \
+                    and points the augmented wav.scp to those files. When several values \
+                    of --mix-snr, --mix-level or --noise-timestamp are given, the numpy \
+                    backend mixes every combination of them from one read of each \
+                    utterance, and writes each combination to a copy of the data \
+                    directory named like dataPath_mix-snrXX-lvXX-startXX with its own \
+                    wav.scp, mix_manifest and {0} directory.'.format(MIX_DIR))
+    parser.add_argument('--materialize', action='store_true',
+            help='With the numpy backend, pack the mixes into one Kaldi wav archive, \
+                    dataPath/{0}.ark, instead of one wave file per utterance. The \
+                    augmented wav.scp points at the offset of each mix in the archive \
+                    (uttId path/{0}.ark:offset) so feature extraction reads a single \
+                    file sequentially.'.format(MIX_DIR))
+    parser.add_argument('--features', type=str, metavar='featDir',
+            help='With the numpy backend, also compute the fbank + pitch features of \
+                    stage 1 from the mixes in memory, like steps/make_fbank_pitch.sh \
+                    without reading the audio back. The features are written to \
+                    featDir/raw_fbank_pitch_<dataName>.ark and the feats.scp and \
+                    utt2num_frames of each output data directory. The pitch only \
+                    approximates Kaldi pitch, check test/feature_parity_test.sh against \
+                    Kaldi before decoding with these features.')
+    parser.add_argument('--fbank-config', type=str, metavar='path',
+            help='Kaldi fbank config of --features, i.e. conf/fbank.conf.')
+    parser.add_argument('--pitch-config', type=str, metavar='path',
+            help='Kaldi pitch config of --features, i.e. conf/pitch.conf.')
+    parser.add_argument('--serve', type=str, metavar='socket',
+            help='With the numpy backend, do not render the mixes but point the augmented \
+                    wav.scp at mix_client.py and serve the mixes on this Unix socket until \
+                    `mix_client.py socket --shutdown`, SIGTERM or SIGINT. The noise tracks, \
+                    speech levels and mixing processes stay loaded between reads, see \
+                    mix_daemon.py.')
+    parser.add_argument('--profile', type=str, metavar='path',
+            help='Run under cProfile and save the stats to this file (pstats format). Only the main process is \
+                    profiled, use --nj 1 to include the mixing.')
     parser.add_argument('--dry-run', action='store_true',
             help='Perform a dry run. Write augmented wav.scp file to stdout rather\
                     than dataPath/augmented_wav.scp')
     return parser
 
 
+def gain_effect(level, relative):
+    if relative:
+        return 'gain {}'.format(level)
+    else:
+        return 'gain -n {}'.format(level)   # Normalizes peak to level dB FSD (Full Scale Deflection)
+
+
 def parse_level_str(s):
     if s[0] == '~':
         relative = True
@@ -114,195 +216,438 @@ def parse_level_str(s):
     return level, relative
 
 
-# TODO: Make nchannels and srate dependent on the actual speech properties
 def match_noise_properties_to_speech(noiseFile_path, noise_level_str=None, target_nchannels=1, target_srate=16000,
-        target_bitdepth=BITDEPTH, target_encoding=ENCODING):
+        target_bitdepth=BITDEPTH):
 
     output_path = os.path.join(os.path.dirname(noiseFile_path), PREPROCESS_NOISE_DIR)
     if not os.path.isdir(output_path):
-        os.mkdir(output_path)
+        os.makedirs(output_path, exist_ok=True)
 
     if noise_level_str is not None:
         noise_level, relative = parse_level_str(noise_level_str)
         matched_filename = 'lv{}-{}.wav'.format(noise_level_str, os.path.splitext(os.path.basename(noiseFile_path))[0])
         matched_path = os.path.join(output_path, matched_filename)
-
-        if relative:
-            gain_effect = 'gain {}'.format(noise_level)
-        else:
-            gain_effect = 'gain -n {}'.format(noise_level)     # Normalizes peak to noise_level dB FSD (Full Scale Deflection)
     else:
         matched_filename = '{}.wav'.format(os.path.splitext(os.path.basename(noiseFile_path))[0])
         matched_path = os.path.join(output_path, matched_filename)
-        gain_effect = 'gain -n'     # Normalize to 0db for 1:1 mixing.
-
-    command = 'sox -V2 {infile} --type wav --channels={nchannels} --rate={srate} --bits {bits} --encoding {encoding} {outfile} {effect}'.format(
-        infile=noiseFile_path, nchannels=target_nchannels, srate=target_srate, bits=target_bitdepth, encoding=target_encoding,
-        outfile=matched_path, effect=gain_effect)
-    return_code = subprocess.call(command, shell=True)
-    if return_code != 0:
-        raise Exception('code {} raised by: {}'.format(return_code, command))
+        noise_level, relative = 0, False     # Normalize to 0db for 1:1 mixing.
+
+    # Already converted by a previous run or job, for speech with the same properties
+    if os.path.isfile(matched_path) and os.path.getmtime(matched_path) >= os.path.getmtime(noiseFile_path) and \
+            file_properties(matched_path) == (target_srate, target_nchannels):
+        return matched_path
+
+    # Same as `sox infile --channels --rate --bits outfile gain`, resampled and mixed down in-process
+    samples = decode_noise(noiseFile_path, target_srate, target_nchannels)
+    peak = float(np.max(np.abs(samples))) if samples.size else 0.0
+    samples = samples * np.float32(gain_factor(noise_level, relative, peak))
+    # Convert to a temporary file first so concurrent jobs never read a partial file
+    tmp_path = '{}.{}.tmp.wav'.format(os.path.splitext(matched_path)[0], os.getpid())
+    write_wav(tmp_path, samples, target_srate, target_bitdepth)
+    os.replace(tmp_path, matched_path)
 
     return matched_path
 
 
-def get_peak_level(scp_cmd):
-    # For some reason, sox outputs stats on stderr
-    cmd = 'sox "|{}" --null stats'.format(scp_cmd)
-    res = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE)
-    output = res.stderr.decode('utf-8')
-    if res.returncode == 2 and 'sph2pipe' in output and 'not found' in output.lower():
-        raise FileNotFoundError('sph2pipe not found. It is needed to get the desired mix leve since it was not ' \
-                'provided. It is highly possible sph2pipe is not on the PATH. You can manually point to it by giving '\
-                'the following flag:\n' \
-                '\t\t--sph2pipe /path/possibly/kaldi/tools/sph2pipe\n\n' \
-                'Original Error:\n{}'.format(output))
-    elif res.returncode != 0:
-        raise Exception('Error getting peak level from utterance since desired mix level was not specified.\n' \
-                '\ncmd:\n{}\n\nerror:\n{}'.format(cmd, output))
-    utterance_stats = output.strip().split('\n')
-    for stat in utterance_stats:
-        if 'Pk lev dB' in stat:
-            return float(stat.replace('Pk lev dB', '').strip())
-    raise KeyError('Did not get Pk lev dB from sox stats on utterance\n{}'.format(res))
-
-
-def prepare_sources(noiseFile_path, mix_snr, speech_level_str, noise_level_str):
+def parse_snr(mix_snr):
+    try:
+        return float(mix_snr)
+    except ValueError:
+        signal_power, noise_power = mix_snr.split(':')
+        return 10 * log10(float(signal_power) / float(noise_power))
+
+
+def mix_gains(mix_snr, speech_level_str, noise_level_str):
+    """The speech and noise gains as (level, relative) pairs, and the resulting noise level string."""
     if mix_snr is not None:
         speech_level_str = None
-        noise_level_str = None
-        try:
-            mix_snr = float(mix_snr)
-        except ValueError:
-            signal_power, noise_power = mix_snr.split(':')
-            mix_snr = 10 * log10(signal_power / noise_power)
         # Speech is normalize in this branch so attenuate "normalized" noise to get the desired SNR
-        noiseWAV_path = match_noise_properties_to_speech(noiseFile_path, str(-1 * mix_snr))
+        noise_level_str = str(-1 * parse_snr(mix_snr))
+
+    if speech_level_str is not None:
+        speech_gain = parse_level_str(speech_level_str)
     else:
-        noiseWAV_path = match_noise_properties_to_speech(noiseFile_path, noise_level_str)
+        speech_gain = (0, False)    # Normalize to 0db for 1:1 mixing
+    if noise_level_str is not None:
+        noise_gain = parse_level_str(noise_level_str)
+    else:
+        noise_gain = (0, False)
+    return speech_gain, noise_gain, noise_level_str
 
-    """ This hasn't been tested yet
-    command = 'soxi -D {}'.format(=noiseWAV_path)
-    return_code = subprocess.run(command, shell=True)
-    output = res.stdout.decode('utf-8')
-    try:
-        noise_length = float(output.strip())
-    except Exception:
-        raise ValueError('Could not get length of noise-source')
+
+def prepare_sources(noise_paths, mix_snr, speech_level_str, noise_level_str, backend='sox', srate=NOISE_SRATE,
+        nchannels=1, nj=None):
+    """
+    The noise tracks to mix and the speech and noise gains. The sox backend mixes tracks preprocessed
+    to the rate and channels of the speech, which are converted by a pool of nj processes.
     """
-    noise_length = None
+    speech_gain, noise_gain, noise_level_str = mix_gains(mix_snr, speech_level_str, noise_level_str)
+    if backend != 'sox':
+        # Decoded by the noise cache, the level is applied while mixing
+        return list(noise_paths), speech_gain, noise_gain
+    jobs = [(path, noise_level_str, nchannels, srate) for path in noise_paths]
+    if nj is None:
+        nj = os.cpu_count()
+    nj = max(1, min(nj, len(jobs)))
+    if nj == 1:
+        return [match_noise_properties_to_speech(*job) for job in jobs], speech_gain, noise_gain
+    with Pool(nj) as pool:
+        return pool.starmap(match_noise_properties_to_speech, jobs, chunksize=1), speech_gain, noise_gain
 
-    if speech_level_str is not None:
-        speech_level, relative = parse_level_str(speech_level_str)
-        if relative:
-            speech_gain_effect = 'gain {}'.format(speech_level)
-        else:
-            speech_gain_effect = 'gain -n {}'.format(speech_level)
-    else:
-        speech_gain_effect = 'gain -n'
 
-    return noiseWAV_path, speech_gain_effect, noise_length
+# Noise tracks and feature options of a mixing worker process, set once by _init_mix_worker
+_worker_noise = None
+_worker_features = None
 
 
-def search_audio(start_path, ext):
-    file_paths = []
-    for lv1 in sorted(os.listdir(start_path)):
-        lv1_path = os.path.join(start_path, lv1)
-        if lv1 == PREPROCESS_NOISE_DIR:    # Don't search the output folder for audio
-            continue
-        elif os.path.isfile(lv1_path) and lv1.endswith(ext):
-            file_paths.append(lv1_path)
-        elif os.path.isdir(lv1_path):
-            for filename in sorted(os.listdir(lv1_path)):
-                lv2_path = os.path.join(lv1_path, filename)
-                if filename == PREPROCESS_NOISE_DIR:
-                    continue
-                elif os.path.isfile(lv2_path) and filename.endswith(ext):
-                    file_paths.append(lv2_path)
-    if len(file_paths) == 0:
-        raise FileNotFoundError('No files with the {} extension were found at {}'.format(ext, start_path))
-    return file_paths
+def _init_mix_worker(noise_tracks, feature_options=None):
+    global _worker_noise, _worker_features
+    _worker_noise = list(noise_tracks)
+    _worker_features = feature_options
+
+
+def _mix_job(job):
+    """
+    Mix one utterance under every condition. Returns the mix paths, or the mixes as wave file bytes
+    without mix_paths, and the features of the mixes when the worker computes them. Raises ValueError
+    if the utterance is not mono at the sample rate the noise tracks were converted to.
+    """
+    scp_cmd, speech_srate, noise_idx, noise_timestamps, speech_gain, noise_levels, mix_levels, mix_paths = job
+    speech, srate = read_scp_audio(scp_cmd)
+    if srate != speech_srate or speech.ndim != 1:
+        raise ValueError('{} is {} Hz with {} channels, the speech of the first utterance is {} Hz mono'.format(
+            scp_cmd, srate, 1 if speech.ndim == 1 else speech.shape[1], speech_srate))
+    with span('mix', 'utterance', audio_seconds=len(speech) / srate) as s:
+        mixes, feats = _mix_speech(speech, srate, noise_idx, noise_timestamps, speech_gain, noise_levels, mix_levels,
+                                   mix_paths)
+        s.add(bytes_written=sum(len(mix) if mix_paths is None else os.path.getsize(mix) for mix in mixes))
+    return mixes, feats
+
+
+def _mix_speech(speech, srate, noise_idx, noise_timestamps, speech_gain, noise_levels, mix_levels, mix_paths):
+    noise, peak = _worker_noise[noise_idx]
+    noise_gains = [gain_factor(level, relative, peak) for level, relative in noise_levels]
+    noise_starts = [int(round(timestamp * srate)) for timestamp in noise_timestamps]
+    if len(noise_starts) * len(noise_gains) * len(mix_levels) == 1 and _worker_features is None:
+        # A single condition is streamed to its output in chunks
+        chunks = iter_mix_chunks(speech, noise, noise_starts[0], *speech_gain, mix_levels[0], noise_gains[0])
+        if mix_paths is None:
+            f = io.BytesIO()
+            write_wav_stream(f, chunks, srate, len(speech))
+            return [f.getvalue()], None
+        write_wav_stream(mix_paths[0], chunks, srate, len(speech))
+        return mix_paths, None
+    mixes = mix_conditions(speech, noise, noise_starts, *speech_gain, noise_gains, mix_levels)
+    mixes = mixes.reshape(-1, mixes.shape[-1])
+    feats = None
+    if _worker_features is not None:
+        # From the 16 bit samples that are written, so they match features extracted from the audio
+        with span('fbank_pitch', 'utterance', audio_seconds=len(mixes) * len(speech) / srate):
+            feats = [fbank_pitch(quantize(mix) / np.float32(2 ** (BITDEPTH - 1)), srate, *_worker_features)
+                     for mix in mixes]
+    if mix_paths is None:
+        return [wav_bytes(mix, srate) for mix in mixes], feats
+    for mix, mix_path in zip(mixes, mix_paths):
+        write_wav(mix_path, mix, srate)
+    return mix_paths, feats
+
+
+def iter_mix_jobs(jobs, noise_tracks, nj=None, feature_options=None):
+    """Render the mixes of the numpy backend in a pool of nj processes, yielding the results in order."""
+    if nj is None:
+        nj = os.cpu_count()
+    nj = max(1, min(nj, len(jobs)))
+    if nj == 1:
+        _init_mix_worker(noise_tracks, feature_options)
+        yield from map(_mix_job, jobs)
+        return
+    with Pool(nj, initializer=_init_mix_worker, initargs=(noise_tracks, feature_options)) as pool:
+        yield from pool.imap(_mix_job, jobs, chunksize=max(1, len(jobs) // (4 * nj)))
+
+
+def render_mixes(jobs, utt_ids, noise_tracks, nj=None, ark_paths=None, wavscp_fs=None, feat_paths=None,
+                 data_dirs=None, feature_options=None):
+    """
+    Render the mixes of the numpy backend. With ark_paths the mixes of each condition are packed
+    into a Kaldi wav archive and the `uttId path:offset` entries are written to wavscp_fs. With
+    feat_paths the features of each condition are written to an archive and the feats.scp and
+    utt2num_frames of its data directory. Outputs are written sequentially in the order of utt_ids.
+    """
+    if ark_paths is not None:
+        tmp_paths = ['{}.{}.tmp'.format(ark_path, os.getpid()) for ark_path in ark_paths]
+        ark_fs = [open(tmp_path, 'wb') for tmp_path in tmp_paths]
+    if feat_paths is not None:
+        feat_outputs = [open_feature_outputs(feat_path, data_dir) for feat_path, data_dir in zip(feat_paths, data_dirs)]
+
+    for utt_id, (mixes, feats) in zip(utt_ids, iter_mix_jobs(jobs, noise_tracks, nj, feature_options)):
+        if ark_paths is not None:
+            for ark_f, ark_path, wavscp_f, mix in zip(ark_fs, ark_paths, wavscp_fs, mixes):
+                offset = write_ark_entry(ark_f, utt_id, mix)
+                wavscp_f.write('{} {}:{}\n'.format(utt_id, ark_path, offset))
+        if feat_paths is not None:
+            for outputs, matrix in zip(feat_outputs, feats):
+                write_feature_entry(outputs, utt_id, matrix)
+
+    if ark_paths is not None:
+        for ark_f, tmp_path, ark_path in zip(ark_fs, tmp_paths, ark_paths):
+            ark_f.close()
+            os.replace(tmp_path, ark_path)
+    if feat_paths is not None:
+        for outputs in feat_outputs:
+            close_feature_outputs(outputs)
+
+
+def as_list(value):
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def condition_name(mix_snr, mix_level, noise_timestamp):
+    """Name of one condition of a sweep following the results-mix-snrXX-lvXX-startXX convention of decode_music.sh"""
+    parts = ['mix']
+    if mix_snr is not None:
+        parts.append('snr{:g}'.format(parse_snr(mix_snr)))
+    if mix_level is not None:
+        parts.append('lv{:g}'.format(mix_level))
+    parts.append('start{:g}'.format(noise_timestamp) if noise_timestamp is not None else 'startactive')
+    return '-'.join(parts)
+
+
+def make_condition_dir(data_path, name):
+    """Copy the Kaldi data directory for one condition of a sweep, without its audio and feature files."""
+    condition_dir = '{}_{}'.format(os.path.normpath(data_path), name)
+    if not os.path.isdir(condition_dir):
+        os.mkdir(condition_dir)
+    for filename in KALDI_DATA_FILES:
+        path = os.path.join(data_path, filename)
+        if os.path.isfile(path):
+            shutil.copy(path, condition_dir)
+    return condition_dir
 
 
 def main(wavscp_path, utt2dur_path, noiseFile_path, noise_ext=None, mix_snr=None, speech_level_str=None, noise_level_str=None,
-        mix_level=None, noise_timestamp=None, noiseROI_path=None, dry_run=False, sph2pipe=None, job_num=None):
-
-    noiseWAV_path = []
-    if noise_ext is not None:   # Directory mode
-        noise_mode = 'directory'
-        paths = search_audio(noiseFile_path, noise_ext)
-        for path in paths:
-            _noiseWAV_path, speech_gain_effect, noise_length = prepare_sources(path, mix_snr, speech_level_str, noise_level_str)
-            noiseWAV_path.append(_noiseWAV_path)
+        mix_level=None, noise_timestamp=None, noiseROI_path=None, dry_run=False, sph2pipe=None, job_num=None,
+        backend='sox', nj=None, level_cache=LEVEL_CACHE_PATH, noise_cache=NOISE_CACHE_DIR,
+        noise_cache_size=NOISE_CACHE_SIZE, seed=None, materialize=False, feat_dir=None, fbank_config=None,
+        pitch_config=None, active_noise=False, serve_path=None):
+
+    # Noise cache entries used since the start of the run are never evicted, even by concurrent jobs
+    run_start = time.time()
+    # mix_snr, mix_level and noise_timestamp may be lists of values to sweep
+    mix_snrs = as_list(mix_snr)
+    mix_levels = as_list(mix_level)
+    # Without --noise-timestamp, --noiseROI and --active-noise pick the start of every utterance from the noise activity
+    choose_starts = as_list(noise_timestamp) == [None] and (noiseROI_path is not None or active_noise)
+    noise_timestamps = [0 if timestamp is None and not choose_starts else timestamp
+                        for timestamp in as_list(noise_timestamp)]
+    conditions = [(snr, level, timestamp) for timestamp in noise_timestamps for snr in mix_snrs for level in mix_levels]
+    if len(conditions) > 1 and backend != 'numpy':
+        raise ValueError('Sweeping several --mix-snr, --mix-level or --noise-timestamp values requires --backend numpy')
+    if materialize and backend != 'numpy':
+        raise ValueError('--materialize requires --backend numpy')
+    if feat_dir is not None and backend != 'numpy':
+        raise ValueError('--features requires --backend numpy')
+    if serve_path is not None and (backend != 'numpy' or materialize or feat_dir is not None):
+        raise ValueError('--serve requires --backend numpy, without --materialize or --features')
+
+    # Tracks that end before the noise timestamp are left out before any of them is decoded
+    min_duration = max(noise_timestamps) if not choose_starts else None
+    # The noise is converted to the sample rate and channels of the speech, probed from its first utterance
+    with span('speech_properties'):
+        speech_srate, speech_nchannels = speech_properties(read_wavscp(wavscp_path, sph2pipe))
+    if backend == 'numpy' and speech_nchannels != 1:
+        raise ValueError('The numpy backend mixes mono speech, {} has {} channels'.format(wavscp_path,
+                                                                                          speech_nchannels))
+
+    with span('prepare_noise'):
+        if noise_ext is not None:   # Directory mode
+            noise_mode = 'directory'
+            tracks, too_short = search_tracks(noiseFile_path, noise_ext, min_duration)
+        else:
+            noise_mode = 'file'
+            track = dict(probe(noiseFile_path), path=noiseFile_path)
+            tracks, too_short = ([track], []) if long_enough(track, min_duration) else ([], [track])
+        for track in too_short:
+            print('{} is {} seconds long, it is not mixed from {} seconds'.format(track['path'], track['duration'],
+                                                                                 min_duration), file=sys.stderr)
+        if not tracks:
+            raise ValueError('None of the noise files are longer than the noise timestamp {}'.format(min_duration))
+        noise_sources = [track['path'] for track in tracks]
+        noiseWAV_path, speech_gain, noise_gain = prepare_sources(noise_sources, mix_snrs[0], speech_level_str,
+                noise_level_str, backend, speech_srate, speech_nchannels, nj)
+
+    noise_indexes = None
+    if choose_starts:
+        # Activity index of every track, None for the tracks mixed from their start
+        roi = read_roi(noiseROI_path) if noiseROI_path is not None else {}
+        with span('noise_activity'):
+            indexed = [active_noise or os.path.basename(source) in roi for source in noise_sources]
+            noises = load_noises([path for path, index in zip(noiseWAV_path, indexed) if index], speech_srate,
+                                 cache_dir=noise_cache, max_bytes=noise_cache_size, nj=nj, since=run_start)
+            noises = iter(noises)
+            noise_indexes = [activity_index(next(noises)[0], speech_srate, roi.get(os.path.basename(source)))
+                             if index else None for source, index in zip(noise_sources, indexed)]
+        active_tracks = [i for i, index in enumerate(noise_indexes) if index is None or index]
+        for source, index in zip(noise_sources, noise_indexes):
+            if index is not None and not index:
+                print('No active region in {}, it is not mixed'.format(source), file=sys.stderr)
+        if not active_tracks:
+            raise ValueError('None of the noise files have an active region')
+
+    speech_levels = {}
+    if None in mix_levels:
+        # Match the mix to the peak level of each utterance
+        with span('speech_levels'):
+            speech_levels = cached_levels(read_wavscp(wavscp_path, sph2pipe), level_cache, nj)
+
+    data_dir = os.path.dirname(wavscp_path)
+    if len(conditions) == 1:
+        outputs = [(os.path.join(data_dir, 'augmented_{}'.format(os.path.basename(wavscp_path))),
+                    os.path.join(data_dir, manifest_name(job_num)),
+                    os.path.join(os.path.abspath(data_dir), MIX_DIR))]
     else:
-        noise_mode = 'file'
-        _noiseWAV_path, speech_gain_effect, noise_length = prepare_sources(noiseFile_path, mix_snr, speech_level_str, noise_level_str)
-        noiseWAV_path.append(_noiseWAV_path)
-
-    if noiseROI_path is not None:
-        raise NotImplementedError('noise.roi file has not been implemented yet!')   # TODO
-    if noise_timestamp is None:
-        noise_timestamp = 0
+        outputs = []
+        for condition in conditions:
+            condition_dir = make_condition_dir(data_dir, condition_name(*condition))
+            outputs.append((os.path.join(condition_dir, os.path.basename(wavscp_path)),
+                            os.path.join(condition_dir, manifest_name(job_num)),
+                            os.path.join(os.path.abspath(condition_dir), MIX_DIR)))
+
+    if backend == 'numpy':
+        # Noise tracks are mapped from the noise cache at unity gain and scaled to each mixing level
+        with span('load_noise'):
+            noise_tracks = load_noises(noiseWAV_path, speech_srate, cache_dir=noise_cache, max_bytes=noise_cache_size,
+                                       nj=nj, since=run_start)
+        # The mapped tracks, not their paths, are handed to the mixing workers: forked workers inherit the
+        # mappings, which stay valid even if another job evicts the cache files afterwards
+        noise_levels = [mix_gains(snr, speech_level_str, noise_level_str)[1] for snr in mix_snrs]
+        mix_jobs = []
+        mix_utt_ids = []
+        ark_paths = None
+        feat_paths = None
+        feature_options = None
+        if feat_dir is not None:
+            if not dry_run and not os.path.isdir(feat_dir):
+                os.makedirs(feat_dir)
+            feature_options = (read_config(fbank_config, FBANK_OPTIONS), read_config(pitch_config, PITCH_OPTIONS))
+            feat_names = [os.path.basename(os.path.dirname(os.path.abspath(path))) for path, _, _ in outputs]
+            feat_paths = [os.path.join(feat_dir, 'raw_fbank_pitch_{}.ark'.format(name) if job_num is None else
+                                       'raw_fbank_pitch_{}.{:02d}.ark'.format(name, job_num)) for name in feat_names]
+        if materialize:
+            ark_paths = ['{}.ark'.format(mix_dir) if job_num is None else '{}.{:02d}.ark'.format(mix_dir, job_num)
+                         for _, _, mix_dir in outputs]
+        elif serve_path is None:
+            for _, _, mix_dir in outputs:
+                if not dry_run and not os.path.isdir(mix_dir):
+                    os.mkdir(mix_dir)
+
+    with open(utt2dur_path, 'r') as utt2dur_f:
+        utt2dur = dict(line.split()[:2] for line in utt2dur_f if line.strip())
+    if seed is None:
+        seed = Random().randrange(2 ** 32)      # Recorded in the manifest so the noise choices can be repeated
+    rng = Random(seed)
 
     wavscp_f = open(wavscp_path, 'r')
-    utt2dur_f = open(utt2dur_path, 'r')
-    if noise_mode == 'directory':
-        if job_num is None:
-            noise_utt_map_path = os.path.join(os.path.dirname(wavscp_path), 'noise_utt_map')
-        else:
-            noise_utt_map_path = os.path.join(os.path.dirname(wavscp_path), 'noise_utt_map.{:02d}'.format(job_num))
-        noise_utt_map_f = open(noise_utt_map_path, 'w')
-        noise_utt_map_f.write(str(noiseWAV_path) + '\n')
+    # The noise gain of the sox backend is applied when the noise track is preprocessed
+    manifest_noise_gains = [mix_gains(snr, speech_level_str, noise_level_str)[1] if backend == 'numpy' else (0, True)
+                            for snr, _, _ in conditions]
+    manifest_fs = [open(manifest_path, 'w') if not dry_run else None for _, manifest_path, _ in outputs]
+    for manifest_f, (snr, level, timestamp) in zip(manifest_fs, conditions):
+        if manifest_f is not None:
+            write_manifest_header(manifest_f, noiseWAV_path, backend, seed,
+                                  {'snr': None if snr is None else parse_snr(snr), 'mix_level': level,
+                                   'start': timestamp},
+                                  [peak for _, peak in noise_tracks] if backend == 'numpy' else None)
 
     if not dry_run:
-        new_wavscp_path = os.path.join(os.path.dirname(wavscp_path), 'augmented_{}'.format(
-            os.path.basename(wavscp_path)))
-        new_wavscp_f = open(new_wavscp_path, 'w')
+        new_wavscp_fs = [open(new_wavscp_path, 'w') for new_wavscp_path, _, _ in outputs]
     else:
-        new_wavscp_f = sys.stdout
-
-    for i, wavscp_line in enumerate(wavscp_f):
-        utt2dur_line = next(utt2dur_f).strip()
-        utt2dur_utt_id, duration = utt2dur_line.split()
+        new_wavscp_fs = [sys.stdout] * len(outputs)
 
+    for wavscp_line in wavscp_f:
         wavscp_line = wavscp_line.strip()
+        if not wavscp_line:
+            continue
         utt_id = wavscp_line.split(' ')[0]
-        if utt2dur_utt_id != utt_id:
-            raise Exception('It seems the utterance IDs betwen utt2dur and wav.scp do not match: {} {}\
-                    \nPossibly you are trying to run a batch job, but didn\'t split both the wav.scp and utt2dur files?'.format(
-                        utt2dur_utt_id, utt_id))
+        if utt_id not in utt2dur:
+            raise KeyError('Utterance {} of {} is not in {}'.format(utt_id, wavscp_path, utt2dur_path))
+        duration = utt2dur[utt_id]
 
-        scp_cmd = ' '.join(wavscp_line.split(' ')[1:-1])    # Remove utterance id and ending pipe symbol
-        if sph2pipe is not None:
-            scp_cmd = os.path.join(os.path.dirname(sph2pipe), scp_cmd)
-
-        if mix_level is None:
-            this_mix_level = get_peak_level(scp_cmd)
-        else:
-            this_mix_level = mix_level
+        scp_cmd = scp_command(wavscp_line, sph2pipe)
+        this_mix_levels = [speech_levels[utt_id]['peak'] if level is None else level for level in mix_levels]
 
         if noise_mode == 'file':
             noise_idx = 0
+        elif noise_indexes is not None:
+            noise_idx = active_tracks[rng.randint(0, len(active_tracks) - 1)]
         elif noise_mode == 'directory':
-            noise_idx = randint(0, len(noiseWAV_path) - 1)
-            noise_utt_map_f.write('{uttID}\t{noiseIdx}\n'.format(uttID=utt_id, noiseIdx=noise_idx))
+            noise_idx = rng.randint(0, len(noiseWAV_path) - 1)
+        utt_timestamps = noise_timestamps
+        if noise_indexes is not None:
+            index = noise_indexes[noise_idx]
+            utt_timestamps = [index.sample(float(duration), rng) if index is not None else 0]
+        measured = speech_levels.get(utt_id, {})
+        for manifest_f, (_, level, timestamp), noise_gain in zip(manifest_fs, conditions, manifest_noise_gains):
+            if manifest_f is not None:
+                write_manifest_record(manifest_f, {
+                        'utt_id': utt_id, 'noise': noise_idx, 'noise_start': utt_timestamps[0] if timestamp is None
+                        else timestamp, 'duration': float(duration),
+                        'speech': scp_cmd, 'speech_level': speech_gain[0], 'speech_relative': speech_gain[1],
+                        'noise_level': noise_gain[0], 'noise_relative': noise_gain[1],
+                        'mix_level': measured['peak'] if level is None else level,
+                        'speech_peak': measured.get('peak'), 'speech_active': measured.get('active')})
+
+        if backend == 'numpy' and serve_path is not None:
+            # The mixes are rendered by the daemon when they are read
+            mix_jobs.append((scp_cmd, speech_srate, noise_idx, utt_timestamps, speech_gain, noise_levels, this_mix_levels, None))
+            mix_utt_ids.append(utt_id)
+            for condition, new_wavscp_f in enumerate(new_wavscp_fs):
+                new_wavscp_f.write('{} {}\n'.format(utt_id, client_command(serve_path, utt_id, condition)))
+            continue
+        elif backend == 'numpy' and materialize:
+            # The wav.scp entries are written with the archive offsets once the mixes are rendered
+            mix_jobs.append((scp_cmd, speech_srate, noise_idx, utt_timestamps, speech_gain, noise_levels, this_mix_levels, None))
+            mix_utt_ids.append(utt_id)
+            if dry_run:
+                for new_wavscp_f, ark_path in zip(new_wavscp_fs, ark_paths):
+                    new_wavscp_f.write('{} {}\n'.format(utt_id, ark_path))
+            continue
+        elif backend == 'numpy':
+            # Every condition of a sweep is mixed from the same read of the utterance
+            mix_paths = [os.path.join(mix_dir, '{}.wav'.format(utt_id)) for _, _, mix_dir in outputs]
+            mix_jobs.append((scp_cmd, speech_srate, noise_idx, utt_timestamps, speech_gain, noise_levels, this_mix_levels,
+                             mix_paths))
+            mix_utt_ids.append(utt_id)
+            for new_wavscp_f, mix_path in zip(new_wavscp_fs, mix_paths):
+                new_wavscp_f.write('{} {}\n'.format(utt_id, mix_path))
+            continue
 
         # Mix both inputs at 1/n balance factor
         # -p is --sox-pipe, for some reason it won't take that version of the argument
         augmented_command = 'sox -t wav - -p {speechEffect} | ' \
                             'sox --combine mix -p "|sox {noisePath} -p trim {start} {duration}" ' \
                             '-t wav -b {bit} -e {enc} - gain -n {mixLevel} |'.format(
-                speechEffect=speech_gain_effect, noisePath=noiseWAV_path[noise_idx], start=noise_timestamp,
-                duration=duration, bit=BITDEPTH, enc=ENCODING, mixLevel=this_mix_level)
+                speechEffect=gain_effect(*speech_gain), noisePath=noiseWAV_path[noise_idx], start=utt_timestamps[0],
+                duration=duration, bit=BITDEPTH, enc=ENCODING, mixLevel=this_mix_levels[0])
 
         augmented_wavscp_line = '{} {}\n'.format(wavscp_line, augmented_command)
-        new_wavscp_f.write(augmented_wavscp_line)
-        
-    new_wavscp_f.close()
+        new_wavscp_fs[0].write(augmented_wavscp_line)
+
+    if backend == 'numpy' and not dry_run and serve_path is None:
+        data_dirs = [os.path.dirname(path) for path, _, _ in outputs]
+        with span('render_mixes', utterances=len(mix_jobs)) as s:
+            render_mixes(mix_jobs, mix_utt_ids, noise_tracks, nj, ark_paths, new_wavscp_fs, feat_paths, data_dirs,
+                         feature_options)
+            s.add(bytes_written=sum(os.path.getsize(path) for path in (ark_paths or []) + (feat_paths or [])))
+
+    for new_wavscp_f in new_wavscp_fs:
+        new_wavscp_f.close()
     wavscp_f.close()
-    utt2dur_f.close()
-    if noise_mode == 'directory':
-        noise_utt_map_f.close()
+    for manifest_f in manifest_fs:
+        if manifest_f is not None:
+            manifest_f.close()
+
+    if serve_path is not None and not dry_run:
+        serve(serve_path, dict(zip(mix_utt_ids, mix_jobs)), noise_tracks, _mix_job, _init_mix_worker, nj)
 
 
 if __name__ == '__main__':
@@ -329,8 +674,13 @@ if __name__ == '__main__':
     else:
         raise TypeError('Given noisePath was not a file nor a directory: {}'.format(args.noiseFile))
 
-    main(wavscp_path, utt2dur_path, args.noiseFile, noise_ext=noise_ext, mix_snr=args.mix_snr,
-            speech_level_str=args.speech_level, noise_level_str=args.noise_level,
-            mix_level=args.mix_level, noise_timestamp=args.noise_timestamp,
-            noiseROI_path=args.noiseROI, dry_run=args.dry_run, sph2pipe=args.sph2pipe, job_num=args.job)
+    with profile(args.profile), span('mix_wsj_noise', data=args.dataPath, backend=args.backend):
+        main(wavscp_path, utt2dur_path, args.noiseFile, noise_ext=noise_ext, mix_snr=args.mix_snr,
+                speech_level_str=args.speech_level, noise_level_str=args.noise_level,
+                mix_level=args.mix_level, noise_timestamp=args.noise_timestamp,
+                noiseROI_path=args.noiseROI, dry_run=args.dry_run, sph2pipe=args.sph2pipe, job_num=args.job,
+                backend=args.backend, nj=args.nj, level_cache=args.level_cache, noise_cache=args.noise_cache,
+                noise_cache_size=int(args.noise_cache_size * 2 ** 30), seed=args.seed, materialize=args.materialize,
+                feat_dir=args.features, fbank_config=args.fbank_config, pitch_config=args.pitch_config,
+                active_noise=args.active_noise, serve_path=args.serve)
 
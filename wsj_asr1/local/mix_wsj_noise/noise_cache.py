@@ -0,0 +1,180 @@
+"""
+Cache of decoded and resampled noise tracks shared by every run of mix_wsj_noise.py.
+
+Tracks are decoded once per target sample rate and channel count, at unity gain,
+and stored as float32 .npy files which are memory-mapped when loaded. Entries are
+addressed by the SHA-1 of the source contents so renamed or copied sources hit the
+same entry and edited sources miss it. The peak of every track is stored with it
+so the `gain -n` normalization of any noise level or SNR is applied while mixing
+and one decoded copy serves all of them.
+
+Wave and SPHERE tracks are read in-process and other formats are decoded by sox
+at their own rate and channel count; the conversion to the rate and channels of
+the speech is done by resample.py. load_noises decodes the missing tracks of a
+run in a process pool.
+
+The index is an SQLite database next to the arrays. When the arrays exceed the size
+limit the least recently used are evicted, with the activity envelopes that
+activity.py stores next to them. Tracks requested by a run or used since it started
+are never evicted, so concurrent jobs sharing the cache do not remove each other's
+tracks while they are being mapped.
+"""
+import os
+import glob
+import wave
+import time
+import hashlib
+import sqlite3
+import subprocess
+from multiprocessing import Pool
+import numpy as np
+
+from level_cache import CACHE_DIR, fingerprint
+from instrumentation import traced_run
+from mix_engine import read_audio, as_float
+from noise_catalog import probe
+from resample import convert
+
+
+NOISE_CACHE_DIR = os.path.join(CACHE_DIR, 'noise')
+NOISE_CACHE_SIZE = 10 * 2 ** 30     # Bytes
+NOISE_SRATE = 16000
+
+
+def open_index(cache_dir=NOISE_CACHE_DIR):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    conn = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), timeout=60)
+    conn.execute('CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, '
+                 'digest TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS tracks (key TEXT PRIMARY KEY, source TEXT, nbytes INTEGER, '
+                 'peak REAL, last_used REAL)')
+    return conn
+
+
+def file_digest(path, conn):
+    """SHA-1 of the file contents, only rehashed when the mtime or size of the file changes."""
+    path = os.path.abspath(path)
+    mtime_ns, size = fingerprint(path)
+    row = conn.execute('SELECT mtime_ns, size, digest FROM sources WHERE path = ?', (path,)).fetchone()
+    if row is not None and tuple(row[:2]) == (mtime_ns, size):
+        return row[2]
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)', (path, mtime_ns, size, digest))
+    return digest
+
+
+def sox_decode(path, srate=None, nchannels=None):
+    """Decode any format sox can read to float32 samples, at the given rate and channel count if not None."""
+    command = 'sox -V2 "{infile}" --type raw --encoding floating-point --bits 32 --endian little{channels}{rate} -'.format(
+            infile=path, channels='' if nchannels is None else ' --channels {}'.format(nchannels),
+            rate='' if srate is None else ' --rate {}'.format(srate))
+    res = traced_run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        raise Exception('code {} raised by: {}\n{}'.format(res.returncode, command, res.stderr.decode('utf-8')))
+    samples = np.frombuffer(res.stdout, dtype='<f4')
+    if nchannels is not None and nchannels > 1:
+        samples = samples.reshape(-1, nchannels)
+    return samples
+
+
+def decode_noise(path, srate, nchannels):
+    """Decode a noise track to float32 samples at the given rate and channel count."""
+    try:
+        samples, source_srate = read_audio(path)
+        return convert(as_float(samples), source_srate, srate, nchannels)
+    except (ValueError, EOFError, wave.Error):
+        pass    # Not a wave or SPHERE file read natively, decoded by sox
+    properties = probe(path)
+    if properties['srate'] is None or properties['channels'] is None:
+        return sox_decode(path, srate, nchannels)
+    samples = sox_decode(path, nchannels=properties['channels'])
+    return convert(samples, properties['srate'], srate, nchannels)
+
+
+def evict(conn, cache_dir, max_bytes, keep=(), since=None):
+    """
+    Remove the least recently used tracks until the cache fits in max_bytes, except the keys of keep and
+    the tracks used since the time since, which a running job may still be loading.
+    """
+    total = conn.execute('SELECT COALESCE(SUM(nbytes), 0) FROM tracks').fetchone()[0]
+    rows = conn.execute('SELECT key, nbytes FROM tracks WHERE last_used < ? ORDER BY last_used',
+                        (time.time() if since is None else since,)).fetchall()
+    for key, nbytes in rows:
+        if total <= max_bytes:
+            break
+        if key in keep:
+            continue
+        for path in glob.glob(os.path.join(cache_dir, '{}.*npy'.format(key))):   # The track and its activity envelope
+            os.remove(path)
+        with conn:
+            conn.execute('DELETE FROM tracks WHERE key = ?', (key,))
+        total -= nbytes
+
+
+def track_key(path, srate, nchannels, conn):
+    return '{}-{}hz-{}ch'.format(file_digest(path, conn), srate, nchannels)
+
+
+def load_noise(path, srate=NOISE_SRATE, nchannels=1, cache_dir=NOISE_CACHE_DIR, max_bytes=NOISE_CACHE_SIZE,
+               decode=decode_noise, keep=(), since=None):
+    """
+    Return the noise track at path as a read-only memory-mapped float32 array at the given rate
+    and channel count, and its peak amplitude. The track is decoded with `decode` on a miss, and
+    evicting to make room for it spares the keys of keep and the tracks used since the time since.
+    """
+    conn = open_index(cache_dir)
+    key = track_key(path, srate, nchannels, conn)
+    npy_path = os.path.join(cache_dir, '{}.npy'.format(key))
+    row = conn.execute('SELECT peak FROM tracks WHERE key = ?', (key,)).fetchone()
+    if row is not None and os.path.isfile(npy_path):
+        peak = row[0]
+        with conn:
+            conn.execute('UPDATE tracks SET last_used = ? WHERE key = ?', (time.time(), key))
+    else:
+        samples = decode(path, srate, nchannels)
+        peak = float(np.max(np.abs(samples))) if samples.size else 0.0
+        # Write then rename so concurrent jobs never map a partial array
+        tmp_path = '{}.{}.tmp'.format(npy_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(samples, dtype=np.float32))
+        os.replace(tmp_path, npy_path)
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)',
+                         (key, os.path.abspath(path), os.path.getsize(npy_path), peak, time.time()))
+        evict(conn, cache_dir, max_bytes, set(keep) | {key}, since)
+    conn.close()
+    return np.load(npy_path, mmap_mode='r'), peak
+
+
+def _load_noise_job(args):
+    path, srate, nchannels, cache_dir, max_bytes, keep, since = args
+    load_noise(path, srate, nchannels, cache_dir, max_bytes, keep=keep, since=since)
+
+
+def load_noises(paths, srate=NOISE_SRATE, nchannels=1, cache_dir=NOISE_CACHE_DIR, max_bytes=NOISE_CACHE_SIZE, nj=None,
+                since=None):
+    """
+    load_noise of every path, with the tracks that are not cached yet decoded by a pool of nj processes.
+    The tracks of paths and those used since the time since (the start of the run, now by default)
+    are never evicted to make room for each other.
+    """
+    if since is None:
+        since = time.time()
+    unique_paths = list(dict.fromkeys(paths))
+    conn = open_index(cache_dir)
+    keep = frozenset(track_key(path, srate, nchannels, conn) for path in unique_paths)
+    conn.close()
+    if nj is None:
+        nj = os.cpu_count()
+    nj = max(1, min(nj, len(unique_paths)))
+    if nj > 1:
+        with Pool(nj) as pool:
+            pool.map(_load_noise_job, [(path, srate, nchannels, cache_dir, max_bytes, keep, since)
+                                       for path in unique_paths], chunksize=1)
+    return [load_noise(path, srate, nchannels, cache_dir, max_bytes, keep=keep, since=since) for path in paths]
@@ -0,0 +1,480 @@
+"""
+Catalog of the noise tracks of a music library, so runs neither walk the library
+nor decode a track to learn its length.
+
+The catalog of a dataset root is a JSON file of the cache directory of
+mix_wsj_noise.py ($MIX_WSJ_NOISE_CACHE/catalogs), named after the SHA-1 of the
+absolute path of the root, so read-only or shared datasets are never written to:
+
+    {"format": "noise-catalog", "version": 1, "root": "/data/SIGSEP", "next_id": 3,
+     "dirs": {"": {"mtime_ns": 1608480000000000000, "subdirs": ["001", "002"], "tracks": [], "info": null},
+              "001": {"mtime_ns": ..., "subdirs": [], "tracks": ["bass.wav"],
+                      "info": {"artist": "Artist Name", "song": "Song Title"}}, ...},
+     "tracks": {"001/bass.wav": {"id": 0, "mtime_ns": ..., "size": 44, "format": "wav", "srate": 44100,
+                                 "channels": 2, "duration": 212.4}, ...},
+     "extensions": ["caf"]}
+
+Every directory under the root is listed with its audio files and the artist
+and song of the info file written by remove_spaces_from_dataset_paths.sh. Only
+the headers of the tracks are read (WAV, FLAC, MP3 and SPHERE; other formats
+have no duration), by a pool of threads, and directories are listed in parallel
+one level at a time. An update only lists the directories whose mtime changed
+and only probes the tracks whose mtime or size changed, so adding tracks to a
+large library costs about one stat per directory. Tracks keep their id for as
+long as their path exists and ids are never reused.
+
+The files with the AUDIO_EXTENSIONS are indexed, and the extensions that were
+searched for although they are not in that list (optional "extensions"). Searching
+for a new extension lists every directory again, and a search that finds no track
+raises FileNotFoundError.
+
+A directory is served by the catalog of the nearest directory at or above it that
+has one. Tracks are searched
+down to two levels below the directory, as mix_wsj_noise.py always did, skipping
+the preprocessed_noise_tracks directories it writes.
+
+usage: noise_catalog.py [-h] [--ext ext] [--min-duration seconds] [--trials]
+                        [--rescan] [--nj N] [--cache path] root
+
+Updates the catalog of root and writes its tracks to stdout (id, duration,
+sample rate, channels and path, tab separated), or with --trials the entries
+directly under root holding a track, one trial each of decode_music.sh.
+"""
+import os
+import json
+import struct
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from sphere import read_header
+from level_cache import CACHE_DIR
+
+
+CATALOG_DIR = os.path.join(CACHE_DIR, 'catalogs')
+CATALOG_FORMAT = 'noise-catalog'
+CATALOG_VERSION = 1
+PREPROCESS_NOISE_DIR = 'preprocessed_noise_tracks'
+INFO_FILE = 'info'
+SEARCH_DEPTH = 2
+AUDIO_EXTENSIONS = ('wav', 'flac', 'mp3', 'sph', 'wv1', 'wv2', 'aif', 'aiff', 'ogg', 'opus', 'm4a', 'aac', 'wma',
+                    'au')
+HEADER_BYTES = 2 ** 16
+
+# Bitrates in kbps of MPEG audio by (MPEG-1, layer) and the sample rates of MPEG-1, halved for MPEG-2 and
+# quartered for MPEG-2.5
+MP3_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SRATES = (44100, 48000, 32000)
+
+
+def id3_size(head):
+    """Size of the ID3v2 tag at the start of a file, 0 if there is none."""
+    if head[:3] != b'ID3' or len(head) < 10:
+        return 0
+    size = (head[6] & 0x7f) << 21 | (head[7] & 0x7f) << 14 | (head[8] & 0x7f) << 7 | head[9] & 0x7f
+    return 10 + size + (10 if head[5] & 0x10 else 0)
+
+
+def mp3_frame(head, offset):
+    """
+    MPEG-1 flag, sample rate, channels, samples per frame, bitrate in bps and length in bytes of the
+    MPEG audio frame whose header is at offset, or None if there is no valid header there.
+    """
+    if offset + 4 > len(head) or head[offset] != 0xff or head[offset + 1] & 0xe0 != 0xe0:
+        return None
+    version = (head[offset + 1] >> 3) & 3      # 3 MPEG-1, 2 MPEG-2, 0 MPEG-2.5
+    layer = 4 - ((head[offset + 1] >> 1) & 3)
+    bitrate_index = head[offset + 2] >> 4
+    srate_index = (head[offset + 2] >> 2) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or srate_index == 3:
+        return None
+    mpeg1 = version == 3
+    srate = MP3_SRATES[srate_index] // {3: 1, 2: 2, 0: 4}[version]
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    padding = (head[offset + 2] >> 1) & 1
+    channels = 1 if head[offset + 3] >> 6 == 3 else 2
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // srate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or mpeg1 else 576
+        length = samples // 8 * bitrate // srate + padding
+    return mpeg1, srate, channels, samples, bitrate, length
+
+
+def probe_mp3(f, size):
+    head = f.read(HEADER_BYTES)
+    start = id3_size(head)
+    if start:
+        f.seek(start)      # Tags may be larger than the header read, with cover art
+        head = f.read(HEADER_BYTES)
+    # The first frame header followed by another one, so stray sync bits in leftover tag data are skipped
+    offset = 0
+    while offset + 4 <= len(head):
+        frame = mp3_frame(head, offset)
+        if frame is not None and (offset + frame[5] + 4 > len(head) or mp3_frame(head, offset + frame[5]) is not None):
+            break
+        offset += 1
+    else:
+        return None
+    mpeg1, srate, channels, samples, bitrate, length = frame
+    # A Xing/Info (after the side information) or VBRI tag in the first frame holds the number of frames
+    xing = offset + 4 + ((32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9))
+    if head[xing:xing + 4] in (b'Xing', b'Info') and len(head) >= xing + 12 and head[xing + 7] & 1:
+        nframes = struct.unpack('>I', head[xing + 8:xing + 12])[0]
+        return srate, channels, nframes * samples / srate
+    vbri = offset + 36
+    if head[vbri:vbri + 4] == b'VBRI' and len(head) >= vbri + 18:
+        nframes = struct.unpack('>I', head[vbri + 14:vbri + 18])[0]
+        return srate, channels, nframes * samples / srate
+    # Constant bitrate
+    return srate, channels, (size - start - offset) * 8 / bitrate
+
+
+def probe_wav(f, size):
+    head = f.read(12)
+    if head[:4] != b'RIFF' or head[8:12] != b'WAVE':
+        return None
+    fmt = None
+    offset = 12
+    while offset + 8 <= size:
+        f.seek(offset)
+        chunk_id, chunk_size = struct.unpack('<4sI', f.read(8))
+        if chunk_id == b'fmt ':
+            channels, srate, _, block_align = struct.unpack('<HIIH', f.read(14)[2:])
+            fmt = srate, channels, block_align
+        elif chunk_id == b'data' and fmt is not None:
+            srate, channels, block_align = fmt
+            data_size = min(chunk_size, size - offset - 8)     # Streamed files may not have the size filled in
+            return srate, channels, data_size // block_align / srate if block_align and srate else None
+        offset += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+def probe_flac(head):
+    offset = id3_size(head)
+    if head[offset:offset + 4] != b'fLaC' or len(head) < offset + 26:
+        return None
+    streaminfo = int.from_bytes(head[offset + 18:offset + 26], 'big')
+    srate = streaminfo >> 44
+    channels = ((streaminfo >> 41) & 7) + 1
+    nsamples = streaminfo & (2 ** 36 - 1)
+    return srate, channels, nsamples / srate if nsamples and srate else None
+
+
+def probe(path):
+    """
+    Format, sample rate, channels and duration in seconds of an audio file, read from its header. The
+    values that can't be read are None.
+    """
+    fmt = os.path.splitext(path)[1][1:].lower()
+    properties = None
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if fmt == 'wav':
+                properties = probe_wav(f, size)
+            elif fmt in ('sph', 'wv1', 'wv2'):
+                header, _ = read_header(f)
+                srate = header.get('sample_rate')
+                properties = srate, header.get('channel_count'), \
+                    header['sample_count'] / srate if srate and 'sample_count' in header else None
+            elif fmt == 'flac':
+                properties = probe_flac(f.read(HEADER_BYTES))
+            elif fmt == 'mp3':
+                properties = probe_mp3(f, size)
+    except (OSError, ValueError, struct.error):
+        properties = None
+    srate, channels, duration = properties if properties is not None else (None, None, None)
+    return {'format': fmt, 'srate': srate, 'channels': channels,
+            'duration': None if duration is None else round(duration, 3)}
+
+
+def read_info(path):
+    """The key: value lines of an info file as a dict."""
+    info = {}
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            key, sep, value = line.partition(':')
+            if sep:
+                info[key.strip()] = value.strip()
+    return info
+
+
+def relative_join(rel_dir, name):
+    return '{}/{}'.format(rel_dir, name) if rel_dir else name
+
+
+def path_key(rel_path):
+    """Sort key of relative paths giving the order of a sorted listing of each directory."""
+    return rel_path.split('/')
+
+
+def catalog_path(root, cache_dir=CATALOG_DIR):
+    """Path of the catalog of the dataset root in cache_dir."""
+    return os.path.join(cache_dir, '{}.json'.format(hashlib.sha1(os.path.abspath(root).encode('utf-8')).hexdigest()))
+
+
+def normalize_extension(ext):
+    return ext.lstrip('.').lower()
+
+
+def long_enough(track, seconds):
+    """Whether a track is longer than seconds. Tracks of unknown duration are assumed to be."""
+    return seconds is None or track['duration'] is None or track['duration'] > seconds
+
+
+class Catalog:
+    """The catalog of the tracks under root, loaded from its index file in cache_dir if there is one."""
+
+    def __init__(self, root, cache_dir=CATALOG_DIR):
+        self.root = os.path.abspath(root)
+        self.path = catalog_path(self.root, cache_dir)
+        self.next_id = 0
+        self.dirs = {}
+        self.tracks = {}
+        self.extensions = set(AUDIO_EXTENSIONS)
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                index = json.load(f)
+            if index.get('format') != CATALOG_FORMAT:
+                raise ValueError('{} is not a noise catalog'.format(self.path))
+            if index['version'] > CATALOG_VERSION:
+                raise ValueError('{} is a version {} catalog, this reader supports up to version {}'.format(
+                        self.path, index['version'], CATALOG_VERSION))
+            self.next_id = index['next_id']
+            self.dirs = index['dirs']
+            self.tracks = index['tracks']
+            self.extensions.update(index.get('extensions', []))
+
+    def relative(self, path):
+        rel_path = os.path.relpath(os.path.abspath(path), self.root)
+        return '' if rel_path == '.' else rel_path.replace(os.sep, '/')
+
+    def _scan_dir(self, rel_dir, rescan):
+        """The entry of a directory and the (mtime_ns, size) of its tracks, None if it was not listed again."""
+        path = os.path.join(self.root, rel_dir)
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = self.dirs.get(rel_dir)
+        if not rescan and cached is not None and cached['mtime_ns'] == mtime_ns:
+            return cached, None
+        entry = {'mtime_ns': mtime_ns, 'subdirs': [], 'tracks': [], 'info': None}
+        stats = {}
+        with os.scandir(path) as it:
+            for item in it:
+                if item.name.startswith('.') or item.name == PREPROCESS_NOISE_DIR:
+                    continue
+                if item.is_dir():
+                    entry['subdirs'].append(item.name)
+                elif item.name == INFO_FILE and item.is_file():
+                    entry['info'] = read_info(item.path)
+                elif normalize_extension(os.path.splitext(item.name)[1]) in self.extensions and item.is_file():
+                    entry['tracks'].append(item.name)
+                    stat = item.stat()
+                    stats[relative_join(rel_dir, item.name)] = (stat.st_mtime_ns, stat.st_size)
+        entry['subdirs'].sort()
+        entry['tracks'].sort()
+        return entry, stats
+
+    def update(self, directory=None, nj=None, rescan=False, ext=None):
+        """
+        Bring the catalog of directory (the whole root by default) up to date and save it if anything
+        changed. Returns whether it did. The files with the extension ext are indexed from now on.
+        """
+        top = self.relative(directory if directory is not None else self.root)
+        changed = False
+        stale = {}
+        # Directories listed before ext was indexed are listed again, without probing their known tracks
+        relist = rescan
+        if ext is not None and normalize_extension(ext) not in self.extensions:
+            self.extensions.add(normalize_extension(ext))
+            relist = changed = True
+        with ThreadPoolExecutor(nj) as executor:
+            level = [top]
+            seen = set()
+            while level:
+                next_level = []
+                for rel_dir, (entry, stats) in zip(level, executor.map(lambda d: self._scan_dir(d, relist), level)):
+                    seen.add(rel_dir)
+                    if stats is not None:
+                        # Saving the catalog changes the mtime of the root, only a different listing is a change
+                        cached = dict(self.dirs.get(rel_dir) or {}, mtime_ns=entry['mtime_ns'])
+                        changed = changed or entry != cached
+                        self.dirs[rel_dir] = entry
+                        for rel_path, (mtime_ns, size) in stats.items():
+                            track = self.tracks.get(rel_path)
+                            if rescan or track is None or (track['mtime_ns'], track['size']) != (mtime_ns, size):
+                                stale[rel_path] = (mtime_ns, size)
+                    next_level.extend(relative_join(rel_dir, name) for name in entry['subdirs'])
+                level = next_level
+            # Directories and tracks under top that are gone
+            prefix = '{}/'.format(top) if top else ''
+            for rel_dir in [d for d in self.dirs if (d == top or d.startswith(prefix)) and d not in seen]:
+                del self.dirs[rel_dir]
+                changed = True
+            listed = {relative_join(rel_dir, name) for rel_dir in seen for name in self.dirs[rel_dir]['tracks']}
+            for rel_path in [p for p in self.tracks if p.startswith(prefix) and p not in listed]:
+                del self.tracks[rel_path]
+                changed = True
+            # Only the headers of new and modified tracks are read
+            stale_paths = sorted(stale, key=path_key)
+            for rel_path, properties in zip(stale_paths, executor.map(
+                    lambda p: probe(os.path.join(self.root, p)), stale_paths)):
+                track = self.tracks.get(rel_path)
+                if track is None:
+                    track = {'id': self.next_id}
+                    self.next_id += 1
+                track.update({'mtime_ns': stale[rel_path][0], 'size': stale[rel_path][1]}, **properties)
+                self.tracks[rel_path] = track
+                changed = True
+        if changed:
+            self.save()
+        return changed
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Write then rename so concurrent jobs never read a partial catalog
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'format': CATALOG_FORMAT, 'version': CATALOG_VERSION, 'root': self.root, 'next_id': self.next_id,
+                       'dirs': self.dirs, 'tracks': self.tracks,
+                       'extensions': sorted(self.extensions.difference(AUDIO_EXTENSIONS))}, f)
+        os.replace(tmp_path, self.path)
+
+    def track(self, rel_path):
+        """A track with its path and the info of its directory added, or None if it is not in the catalog."""
+        if rel_path not in self.tracks:
+            return None
+        rel_dir = rel_path.rpartition('/')[0]
+        dir_entry = self.dirs.get(rel_dir) or {}
+        return dict(self.tracks[rel_path], path=os.path.join(self.root, rel_path),
+                    info=dir_entry.get('info') or {})
+
+    def search(self, directory=None, ext=None, depth=SEARCH_DEPTH):
+        """
+        The tracks with the extension ext down to depth levels below directory (any depth if None), in
+        sorted order.
+        """
+        top = self.relative(directory if directory is not None else self.root)
+        prefix = '{}/'.format(top) if top else ''
+        found = []
+        for rel_path in self.tracks:
+            if not rel_path.startswith(prefix) or (ext is not None and not rel_path.endswith(ext)):
+                continue
+            if depth is None or rel_path[len(prefix):].count('/') < depth:
+                found.append(rel_path)
+        return [self.track(rel_path) for rel_path in sorted(found, key=path_key)]
+
+    def find(self, path):
+        """
+        The track of path, which may also be a track preprocessed by mix_wsj_noise.py at any level,
+        or None if it is not in the catalog.
+        """
+        rel_path = self.relative(path)
+        rel_dir, _, filename = rel_path.rpartition('/')
+        if os.path.basename(rel_dir) != PREPROCESS_NOISE_DIR:
+            return self.track(rel_path)
+        # preprocessed_noise_tracks/[lv<level>-]<name>.wav of a track of the parent directory
+        source_dir = rel_dir.rpartition('/')[0]
+        stem = os.path.splitext(filename)[0]
+        for name in (self.dirs.get(source_dir) or {}).get('tracks', []):
+            source_stem = os.path.splitext(name)[0]
+            if stem == source_stem or (stem.startswith('lv') and stem.endswith('-{}'.format(source_stem))):
+                return self.track(relative_join(source_dir, name))
+        return None
+
+
+def find_catalog(path, cache_dir=CATALOG_DIR):
+    """Root of the nearest directory at or above path with a catalog in cache_dir, None if there is none."""
+    directory = os.path.abspath(path if os.path.isdir(path) else os.path.dirname(path))
+    while True:
+        if os.path.isfile(catalog_path(directory, cache_dir)):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def open_catalog(directory, nj=None, rescan=False, ext=None, cache_dir=CATALOG_DIR):
+    """
+    The nearest catalog serving directory, created for directory if there is none, updated under directory
+    with the files with the extension ext indexed.
+    """
+    root = find_catalog(directory, cache_dir)
+    catalog = Catalog(root if root is not None else directory, cache_dir)
+    catalog.update(directory, nj, rescan, ext)
+    return catalog
+
+
+def search_tracks(directory, ext, min_duration=None, nj=None):
+    """
+    Tracks with the extension ext down to two levels below directory, and those of them that are not
+    longer than min_duration seconds.
+    """
+    tracks = open_catalog(directory, nj, ext=ext).search(directory, ext)
+    if len(tracks) == 0:
+        raise FileNotFoundError('No files with the {} extension were found at {}'.format(ext, directory))
+    return [track for track in tracks if long_enough(track, min_duration)], \
+           [track for track in tracks if not long_enough(track, min_duration)]
+
+
+def trials(catalog, ext=None, min_duration=None):
+    """
+    The entries directly under the catalog root holding a track long enough to be mixed. Raises
+    FileNotFoundError if there are none.
+    """
+    entries = set()
+    for track in catalog.search(ext=ext, depth=SEARCH_DEPTH + 1):
+        if long_enough(track, min_duration):
+            entries.add(catalog.relative(track['path']).split('/')[0])
+    if not entries:
+        raise FileNotFoundError('No {}tracks{} were found at {}'.format(
+                '' if ext is None else '{} '.format(ext),
+                '' if min_duration is None else ' longer than {} seconds'.format(min_duration), catalog.root))
+    return [os.path.join(catalog.root, entry) for entry in sorted(entries)]
+
+
+def str_duration(duration):
+    return '-' if duration is None else '{:.3f}'.format(duration)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the catalog of the noise tracks under a dataset root and \
+            list them.')
+    parser.add_argument('root', type=str,
+            help='The dataset root, its catalog is written to the --cache directory.')
+    parser.add_argument('--ext', type=str, metavar='ext',
+            help='Only list the tracks with this extension.')
+    parser.add_argument('--min-duration', type=float, metavar='seconds',
+            help='Only list the tracks longer than this, i.e. the noise timestamp the tracks will be mixed from.')
+    parser.add_argument('--trials', action='store_true',
+            help='List the files and directories directly under root holding a listed track instead.')
+    parser.add_argument('--rescan', action='store_true',
+            help='List every directory and read the header of every track again, for tracks edited in place.')
+    parser.add_argument('--nj', type=int, metavar='N',
+            help='Number of threads listing directories and reading headers.')
+    parser.add_argument('--cache', type=str, metavar='path', default=CATALOG_DIR,
+            help='Directory of the catalogs. Default is {}'.format(CATALOG_DIR))
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        raise NotADirectoryError(args.root)
+    catalog = Catalog(args.root, args.cache)
+    catalog.update(nj=args.nj, rescan=args.rescan, ext=args.ext)
+    if args.trials:
+        for entry in trials(catalog, args.ext, args.min_duration):
+            print(entry)
+    else:
+        for track in catalog.search(ext=args.ext, depth=None):
+            if long_enough(track, args.min_duration):
+                print('{}\t{}\t{}\t{}\t{}'.format(track['id'], str_duration(track['duration']), track['srate'] or '-',
+                                                  track['channels'] or '-', track['path']))
@@ -0,0 +1,405 @@
+"""
+CPU decoding of the test sets of a sweep with one loaded model and language model.
+
+Stage 5 of run.sh splits each test set in 32 parts and runs asr_recog.py on
+each, so every trial loads the transformer and the word RNNLM 64 times before
+decoding a single utterance. Here they are loaded once, and a pool of processes
+forked afterwards shares them:
+
+    recog_sweep.py --config conf/decode.yaml --model exp/.../model.acc.best \\
+        --word-rnnlm exp/.../rnnlm.model.best \\
+        dump/test_dev93/deltafalse/data.json exp/.../decode_test_dev93_decode_lm_word65000 \\
+        dump/test_eval92/deltafalse/data.json exp/.../decode_test_eval92_decode_lm_word65000
+
+The options of asr_recog.py (--config, --model, --rnnlm, --word-rnnlm, ...)
+are read by its own parser. Each recog json is decoded to data.1.json in its
+decode directory, the file score_sclite.sh reads.
+
+The transformer of this recipe has no batched beam search in espnet (with a
+word LM neither the v1 nor the v2 api decode several utterances at once), so
+utterances are batched by length for scheduling instead: batches of utterances
+of similar length, up to --batch-frames input frames, are handed to the
+processes longest first, so they all finish at about the same time. The cores
+are split into --nj processes of --threads torch threads; by default every
+core gets a process of one thread, as beam search over small matrices scales
+better over processes than threads, and the threads of the processes left
+idle by a small test set go to the others.
+
+With --serve the model stays loaded between trials: the daemon decodes the
+requests of `recog_sweep.py --connect socket recogJson decodeDir ...` (see
+run.sh --recog_socket) until `recog_sweep.py --connect socket --shutdown`.
+
+The loading and decoding follow espnet's asr.recog, and test/recog_sweep_parity_test.sh
+checks that the hypotheses and WER of a test set match those of asr_recog.py;
+run it before decoding a sweep with this script.
+
+Every decode directory gets a decode_stats.json: the utterances, audio seconds
+and summed decoding seconds of its test set, and the wall seconds, utterances
+per second and real-time factor (wall seconds per second of audio) of the trial
+that decoded it.
+
+usage: recog_sweep.py [--nj N] [--threads N] [--batch-frames N] [asr_recog.py options]
+                      recogJson decodeDir [recogJson decodeDir ...]
+       recog_sweep.py [--nj N] [--threads N] [--batch-frames N] [asr_recog.py options] --serve socket
+       recog_sweep.py --connect socket recogJson decodeDir [recogJson decodeDir ...]
+       recog_sweep.py --connect socket --shutdown
+"""
+import io
+import os
+import sys
+import glob
+import json
+import time
+import signal
+import argparse
+import threading
+import socketserver
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import span
+from mix_client import request
+from mix_daemon import remove_stale_socket
+
+
+BATCH_FRAMES = 2000         # Input frames of a batch, 20 s of audio
+FRAME_SHIFT = 0.01          # Seconds per input frame, the 10 ms shift of conf/fbank.conf
+RESULT_NAME = 'data.1.json'     # Joined with the other data.*.json of the directory by score_sclite.sh
+STATS_NAME = 'decode_stats.json'
+
+
+def load_recognizer(args):
+    """
+    The model, language model and feature loader of asr_recog.py args, loaded like espnet's
+    asr.recog does for CPU decoding.
+    """
+    import torch
+    from espnet.asr.asr_utils import get_model_conf, torch_load
+    from espnet.asr.pytorch_backend.asr_init import load_trained_model
+    import espnet.lm.pytorch_backend.extlm as extlm_pytorch
+    import espnet.nets.pytorch_backend.lm.default as lm_pytorch
+    from espnet.utils.deterministic_utils import set_deterministic_pytorch
+    from espnet.utils.io_utils import LoadInputsAndTargets
+
+    set_deterministic_pytorch(args)
+    model, train_args = load_trained_model(args.model)
+    model.eval()
+    model.recog_args = args
+
+    rnnlm = None
+    if args.rnnlm:
+        rnnlm_args = get_model_conf(args.rnnlm, args.rnnlm_conf)
+        rnnlm = lm_pytorch.ClassifierWithState(lm_pytorch.RNNLM(len(train_args.char_list), rnnlm_args.layer,
+                                                                rnnlm_args.unit,
+                                                                getattr(rnnlm_args, 'embed_unit', None)))
+        torch_load(args.rnnlm, rnnlm)
+        rnnlm.eval()
+    if args.word_rnnlm:
+        rnnlm_args = get_model_conf(args.word_rnnlm, args.word_rnnlm_conf)
+        word_dict = rnnlm_args.char_list_dict
+        char_dict = {x: i for i, x in enumerate(train_args.char_list)}
+        word_rnnlm = lm_pytorch.ClassifierWithState(lm_pytorch.RNNLM(len(word_dict), rnnlm_args.layer,
+                                                                     rnnlm_args.unit,
+                                                                     getattr(rnnlm_args, 'embed_unit', None)))
+        torch_load(args.word_rnnlm, word_rnnlm)
+        word_rnnlm.eval()
+        if rnnlm is not None:
+            rnnlm = lm_pytorch.ClassifierWithState(extlm_pytorch.MultiLevelLM(word_rnnlm.predictor, rnnlm.predictor,
+                                                                              word_dict, char_dict))
+        else:
+            rnnlm = lm_pytorch.ClassifierWithState(extlm_pytorch.LookAheadWordLM(word_rnnlm.predictor, word_dict,
+                                                                                 char_dict))
+
+    loader = LoadInputsAndTargets(mode='asr', load_output=False, sort_in_input_length=False,
+                                  preprocess_conf=train_args.preprocess_conf if args.preprocess_conf is None
+                                  else args.preprocess_conf,
+                                  preprocess_args={'train': False})
+    torch.set_num_threads(1)    # Nothing is computed before the workers are forked
+    return model, rnnlm, train_args.char_list, loader
+
+
+# Recognizer of the decoding processes, loaded once before they are forked
+_recognizer = None
+_recog_args = None
+
+
+def _init_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+
+
+def decode_batch(batch):
+    """Decode a batch of (utt_id, recog json entry). Returns (utt_id, result entry, seconds) of each."""
+    import torch
+    from espnet.asr.asr_utils import add_results_to_json
+    model, rnnlm, char_list, loader = _recognizer
+    results = []
+    with torch.no_grad():
+        for utt_id, entry in batch:
+            start = time.perf_counter()
+            with span('decode', 'utterance', utt_id=utt_id, audio_seconds=utt_seconds(entry)):
+                feat = loader([(utt_id, entry)])[0][0]
+                nbest_hyps = model.recognize(feat, _recog_args, char_list, rnnlm)
+            results.append((utt_id, add_results_to_json(entry, nbest_hyps, char_list),
+                            time.perf_counter() - start))
+    return results
+
+
+def utt_seconds(entry):
+    return entry['input'][0]['shape'][0] * FRAME_SHIFT
+
+
+def length_batches(utts, batch_frames=BATCH_FRAMES):
+    """
+    Batches of the (utt_id, entry) of utts, longest utterances first, each of consecutive lengths
+    up to batch_frames input frames (or a single longer utterance).
+    """
+    batches = []
+    batch = []
+    frames = 0
+    for utt_id, entry in sorted(utts, key=lambda utt: -utt[1]['input'][0]['shape'][0]):
+        length = entry['input'][0]['shape'][0]
+        if batch and frames + length > batch_frames:
+            batches.append(batch)
+            batch = []
+            frames = 0
+        batch.append((utt_id, entry))
+        frames += length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def split_cores(nbatches=None, nj=None, threads=None, cores=None):
+    """
+    The number of decoding processes and torch threads of each. Every core gets a process of one
+    thread, unless there are fewer batches than cores.
+    """
+    if cores is None:
+        cores = os.cpu_count()
+    if nj is None and threads is None:
+        nj = cores if nbatches is None else max(1, min(cores, nbatches))
+    if nj is None:
+        nj = max(1, cores // threads)
+    if threads is None:
+        threads = max(1, cores // nj)
+    return nj, threads
+
+
+def read_recog_json(path):
+    with open(path, 'rb') as f:
+        return json.load(f)['utts']
+
+
+def write_json(path, obj):
+    """Write obj to a temporary file first so score_sclite.sh never reads a partial file."""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps(obj, indent=4, ensure_ascii=False, sort_keys=True).encode('utf_8'))
+    os.replace(tmp_path, path)
+
+
+def read_sets(pairs, batch_frames=BATCH_FRAMES):
+    """
+    The utterances of the recog json of every (recog json, decode dir) of pairs, and the length
+    batches of all of them as (set index, batch), longest first.
+    """
+    sets = []
+    for recog_json, _ in pairs:
+        if not os.path.isfile(recog_json):
+            raise FileNotFoundError(recog_json)
+        sets.append(read_recog_json(recog_json))
+    batches = [(set_idx, batch) for set_idx, utts in enumerate(sets)
+               for batch in length_batches(list(utts.items()), batch_frames)]
+    batches.sort(key=lambda batch: -batch[1][0][1]['input'][0]['shape'][0])
+    return sets, batches
+
+
+def decode_sets(pool, pairs, sets, batches, trial_info=None):
+    """
+    Decode the batches of read_sets(pairs) on pool, in one queue for all the sets. Writes the
+    results and decode stats of each decode dir and returns the stats of the trial.
+    """
+    start = time.perf_counter()
+    results = [{} for _ in pairs]
+    seconds = [0.0 for _ in pairs]
+    batch_results = pool.imap(decode_batch, [batch for _, batch in batches])
+    for (set_idx, _), decoded in zip(batches, batch_results):
+        for utt_id, entry, utt_decode_seconds in decoded:
+            results[set_idx][utt_id] = entry
+            seconds[set_idx] += utt_decode_seconds
+    wall_seconds = time.perf_counter() - start
+
+    audio_seconds = [sum(utt_seconds(entry) for entry in utts.values()) for utts in sets]
+    utterances = sum(len(utts) for utts in sets)
+    trial = dict(trial_info or {})
+    trial.update({'utterances': utterances, 'audio_seconds': sum(audio_seconds), 'wall_seconds': wall_seconds,
+                  'utterances_per_second': utterances / wall_seconds if wall_seconds else 0,
+                  'real_time_factor': wall_seconds / sum(audio_seconds) if sum(audio_seconds) else 0})
+    for (recog_json, decode_dir), utts, result, set_seconds, set_audio in zip(pairs, sets, results, seconds,
+                                                                                audio_seconds):
+        if not os.path.isdir(decode_dir):
+            os.makedirs(decode_dir)
+        for stale in glob.glob(os.path.join(decode_dir, 'data.*.json')):    # Parts of an earlier asr_recog.py decode
+            os.remove(stale)
+        write_json(os.path.join(decode_dir, RESULT_NAME), {'utts': result})
+        write_json(os.path.join(decode_dir, STATS_NAME),
+                   {'recog_json': os.path.abspath(recog_json), 'utterances': len(utts), 'audio_seconds': set_audio,
+                    'decode_seconds': set_seconds, 'trial': trial})
+    return trial
+
+
+def str_trial(trial):
+    return '{} utterances, {:.0f} s of audio decoded in {:.0f} s: {:.2f} utt/s, real-time factor {:.3f} ' \
+           '({} processes x {} threads)'.format(trial['utterances'], trial['audio_seconds'], trial['wall_seconds'],
+                                                trial['utterances_per_second'], trial['real_time_factor'],
+                                                trial['processes'], trial['threads'])
+
+
+class RecogServer(socketserver.UnixStreamServer):
+    """Decodes the requests of clients on a process pool of the loaded recognizer, like mix_daemon.MixServer."""
+
+    def __init__(self, socket_path, pool, nj, batch_frames=BATCH_FRAMES, trial_info=None):
+        self.pool = pool
+        self.batch_frames = batch_frames
+        self.trial_info = trial_info or {}
+        self.executor = ThreadPoolExecutor(nj)
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'utterances': 0, 'audio_seconds': 0.0, 'wall_seconds': 0.0}
+        super().__init__(socket_path, None)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.handle_request_thread, request)
+
+    def handle_request_thread(self, request):
+        try:
+            self.respond(request)
+        except Exception as e:
+            self.count(errors=1)
+            print('Request failed: {}'.format(e), file=sys.stderr)
+            try:
+                request.sendall('error {}\n'.format(str(e).replace('\n', ' ')).encode('utf-8'))
+            except OSError:
+                pass
+        finally:
+            self.shutdown_request(request)
+
+    def count(self, **counts):
+        with self.stats_lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def respond(self, request):
+        f = request.makefile('rb')
+        words = f.readline().decode('utf-8').rstrip('\n').split(' ', 1)
+        f.close()
+        if words[0] == 'decode' and len(words) == 2:
+            pairs = json.loads(words[1])
+            with span('decode_request', 'stage') as s:
+                sets, batches = read_sets(pairs, self.batch_frames)
+                trial = decode_sets(self.pool, pairs, sets, batches, self.trial_info)
+                s.add(audio_seconds=trial['audio_seconds'])
+            print(str_trial(trial), file=sys.stderr)
+            self.count(utterances=trial['utterances'], audio_seconds=trial['audio_seconds'],
+                       wall_seconds=trial['wall_seconds'])
+            payload = json.dumps(trial).encode('utf-8')
+        elif words[0] == 'stats':
+            payload = json.dumps(self.stats).encode('utf-8')
+        elif words[0] == 'shutdown':
+            payload = b''
+            threading.Thread(target=self.shutdown).start()
+        else:
+            raise ValueError('bad request {}'.format(' '.join(words)))
+        request.sendall('ok {}\n'.format(len(payload)).encode('utf-8') + payload)
+        self.count(requests=1)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def serve(socket_path, nj, threads, batch_frames=BATCH_FRAMES, trial_info=None):
+    """Decode the requests of clients on socket_path until a shutdown request, SIGTERM or SIGINT."""
+    remove_stale_socket(socket_path)
+    with Pool(nj, initializer=_init_worker, initargs=(threads,)) as pool:
+        server = RecogServer(socket_path, pool, nj, batch_frames, trial_info)
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        print('Decoding on {} with {} processes x {} threads'.format(socket_path, nj, threads), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+            print('Requests: {}\t\tErrors: {}\t\tUtterances: {}\t\tAudio: {:.0f} s\t\tDecoding: {:.0f} s'.format(
+                    server.stats['requests'], server.stats['errors'], server.stats['utterances'],
+                    server.stats['audio_seconds'], server.stats['wall_seconds']), file=sys.stderr)
+    return server.stats
+
+
+def read_pairs(words):
+    if not words or len(words) % 2:
+        raise ValueError('Expected recogJson decodeDir pairs, got: {}'.format(' '.join(words)))
+    return [(os.path.abspath(recog_json), os.path.abspath(decode_dir))
+            for recog_json, decode_dir in zip(words[::2], words[1::2])]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Decode test sets on CPU with one load of the model and language \
+            model, over a pool of processes. The other options are those of asr_recog.py.',
+            usage=__doc__.strip().split('\n\n')[-1][len('usage: '):])
+    parser.add_argument('--nj', type=int, metavar='N',
+            help='Number of decoding processes. By default one per core, or per batch if there are fewer.')
+    parser.add_argument('--threads', type=int, metavar='N',
+            help='Torch threads of each decoding process. By default the cores are split between the processes.')
+    parser.add_argument('--batch-frames', type=int, metavar='N', default=BATCH_FRAMES,
+            help='Input frames of the batches of utterances of similar length handed to the processes. '
+                 'Default is {}.'.format(BATCH_FRAMES))
+    parser.add_argument('--serve', type=str, metavar='socket',
+            help='Keep the model loaded and decode the requests of --connect clients on this Unix socket.')
+    parser.add_argument('--connect', type=str, metavar='socket',
+            help='Decode with the daemon serving this socket instead of loading the model.')
+    parser.add_argument('--shutdown', action='store_true',
+            help='With --connect, stop the daemon.')
+    args, rest = parser.parse_known_args()
+
+    if args.connect is not None:
+        if args.shutdown:
+            line = 'shutdown'
+        else:
+            line = 'decode {}'.format(json.dumps(read_pairs(rest)))
+        out = io.BytesIO()
+        error = request(args.connect, line, out)
+        if error is not None:
+            sys.exit('recog_sweep.py: {}'.format(error))
+        if not args.shutdown:
+            print(str_trial(json.loads(out.getvalue().decode('utf-8'))), file=sys.stderr)
+        sys.exit(0)
+
+    from espnet.bin.asr_recog import get_parser
+    # The recog json and result label of asr_recog.py are replaced by the pairs
+    _recog_args, rest = get_parser().parse_known_args(rest + ['--result-label', os.devnull])
+    if _recog_args.ngpu > 0:
+        raise ValueError('recog_sweep.py decodes on CPU, use asr_recog.py to decode on GPU')
+    pairs = read_pairs(rest) if args.serve is None else []
+
+    with span('load_model'):
+        start = time.perf_counter()
+        _recognizer = load_recognizer(_recog_args)
+        load_seconds = time.perf_counter() - start
+
+    if args.serve is not None:
+        nj, threads = split_cores(None, args.nj, args.threads)
+        serve(args.serve, nj, threads, args.batch_frames,
+              {'processes': nj, 'threads': threads, 'model_load_seconds': load_seconds, 'served': True})
+    else:
+        sets, batches = read_sets(pairs, args.batch_frames)
+        nj, threads = split_cores(len(batches), args.nj, args.threads)
+        with Pool(nj, initializer=_init_worker, initargs=(threads,)) as pool:
+            with span('decode_sets') as s:
+                trial = decode_sets(pool, pairs, sets, batches, {'processes': nj, 'threads': threads,
+                                                                 'model_load_seconds': load_seconds, 'served': False})
+                s.add(audio_seconds=trial['audio_seconds'])
+        print(str_trial(trial), file=sys.stderr)
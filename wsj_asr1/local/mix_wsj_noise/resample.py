@@ -0,0 +1,133 @@
+"""
+Sample rate conversion and channel mixdown of noise tracks, and the properties
+of the speech they are converted to.
+
+Tracks are resampled by a polyphase FIR filter (scipy.signal.upfirdn) over all
+of their channels at once, with the Kaiser windowed sinc design of
+scipy.signal.resample_poly, so the output matches resample_poly. The filter of
+every reduced rate ratio (160/441 for 44.1 kHz to 16 kHz) is designed once per
+process. Channels are mixed down before resampling, so stereo music costs the
+same as mono.
+
+The speech properties are read from the header of the first wav.scp source
+(a wave file, SPHERE file, sph2pipe command or wav archive offset); only a pipe
+command the headers can't be read for is run.
+"""
+import os
+import wave
+from math import gcd
+from functools import lru_cache
+import numpy as np
+from scipy.signal import firwin, upfirdn
+
+from mix_engine import ARK_OFFSET_RE, read_scp_audio
+from sphere import SPHERE_MAGIC, read_header
+
+
+KAISER_BETA = 5.0
+HALF_LENGTH_ZEROS = 10      # Zero crossings of the sinc on each side, per unit of the larger of up and down
+
+
+def reduced_ratio(srate, target_srate):
+    """The up and down factors converting srate to target_srate."""
+    divisor = gcd(int(srate), int(target_srate))
+    return int(target_srate) // divisor, int(srate) // divisor
+
+
+@lru_cache(maxsize=None)
+def design_filter(up, down):
+    """
+    Low-pass filter of the up/down conversion, zero-padded in front so its center lands on an
+    output sample, and the number of leading outputs to drop.
+    """
+    max_rate = max(up, down)
+    half_len = HALF_LENGTH_ZEROS * max_rate
+    h = firwin(2 * half_len + 1, 1.0 / max_rate, window=('kaiser', KAISER_BETA)) * up
+    n_pre_pad = down - half_len % down
+    h = np.concatenate([np.zeros(n_pre_pad), h]).astype(np.float32)
+    h.flags.writeable = False
+    return h, (half_len + n_pre_pad) // down
+
+
+def resample(samples, srate, target_srate):
+    """Resample float samples of shape (samples,) or (samples, channels) along the first axis."""
+    if srate == target_srate:
+        return samples
+    up, down = reduced_ratio(srate, target_srate)
+    h, n_pre_remove = design_filter(up, down)
+    nsamples = len(samples)
+    n_out = -(-nsamples * up // down)
+    # Zeros after the filter so the outputs cover the whole input
+    n_post_pad = max(0, (n_out + n_pre_remove - 1) * down - (nsamples - 1) * up - len(h) + 1)
+    if n_post_pad:
+        h = np.concatenate([h, np.zeros(n_post_pad, dtype=np.float32)])
+    y = upfirdn(h, np.asarray(samples, dtype=np.float32), up, down, axis=0)
+    return y[n_pre_remove:n_pre_remove + n_out]
+
+
+def mixdown(samples, nchannels):
+    """Samples with nchannels channels: the mean of the channels for mono, the mono channel repeated."""
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    if channels == nchannels:
+        return samples
+    if nchannels == 1:
+        return samples.mean(axis=1, dtype=np.float32)
+    if channels == 1:
+        return np.repeat(samples.reshape(-1, 1), nchannels, axis=1)
+    raise ValueError('Can not convert {} channels to {}'.format(channels, nchannels))
+
+
+def convert(samples, srate, target_srate, target_nchannels):
+    """Float samples at target_srate with target_nchannels channels, mixed down before resampling."""
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    if target_nchannels < channels:
+        samples = mixdown(samples, target_nchannels)
+    samples = resample(samples, srate, target_srate)
+    return mixdown(samples, target_nchannels)
+
+
+def wav_properties(f):
+    with wave.open(f, 'rb') as w:
+        return w.getframerate(), w.getnchannels()
+
+
+def sphere_properties(path):
+    with open(path, 'rb') as f:
+        header, _ = read_header(f)
+    return header['sample_rate'], header.get('channel_count', 1)
+
+
+def file_properties(path):
+    with open(path, 'rb') as f:
+        if f.read(len(SPHERE_MAGIC)) == SPHERE_MAGIC:
+            return sphere_properties(path)
+        f.seek(0)
+        return wav_properties(f)
+
+
+def scp_properties(scp_cmd):
+    """Sample rate and number of channels of a wav.scp entry, from the header of its source when possible."""
+    args = scp_cmd.split()
+    if len(args) == 1:
+        match = ARK_OFFSET_RE.match(args[0])
+        if match is not None and not os.path.isfile(args[0]):
+            with open(match.group(1), 'rb') as f:
+                f.seek(int(match.group(2)))
+                return wav_properties(f)
+        return file_properties(args[0])
+    if os.path.basename(args[0]) == 'sph2pipe' and os.path.isfile(args[-1]):
+        srate, nchannels = sphere_properties(args[-1])
+        return srate, 1 if '-c' in args else nchannels
+    samples, srate = read_scp_audio(scp_cmd)
+    return srate, 1 if samples.ndim == 1 else samples.shape[1]
+
+
+def speech_properties(entries):
+    """
+    Sample rate and number of channels of the speech of (utt_id, scp_cmd) entries, probed from the
+    first entry only: the utterances of a recipe share them, and the mixing workers check every
+    utterance as they read it. Raises ValueError if there are no entries.
+    """
+    for utt_id, scp_cmd in entries:
+        return scp_properties(scp_cmd)
+    raise ValueError('No utterances to probe the speech sample rate and channels from')
@@ -0,0 +1,257 @@
+"""
+NIST SPHERE reader, so WSJ utterances can be read without forking sph2pipe.
+
+PCM payloads are memory-mapped and returned as a zero-copy NumPy view of the
+file. Payloads compressed with shorten (sample_coding pcm,embedded-shorten-vX,
+which is how the WSJ .wv1/.wv2 files are distributed) are decoded in Python,
+one sample at a time, so it is slower than sph2pipe: mix_engine.read_sph2pipe
+leaves them to the sph2pipe command of the wav.scp, and this decoder only reads
+the shorten files given by path.
+"""
+import os
+import numpy as np
+
+
+SPHERE_MAGIC = b'NIST_1A'
+
+SHORTEN_MAGIC = b'ajkg'
+FN_DIFF0, FN_DIFF1, FN_DIFF2, FN_DIFF3, FN_QUIT, FN_BLOCKSIZE, FN_BITSHIFT, FN_QLPC, FN_ZERO, FN_VERBATIM = range(10)
+TYPE_S8, TYPE_U8, TYPE_S16HL, TYPE_U16HL, TYPE_S16LH, TYPE_U16LH = range(1, 7)
+ULONGSIZE = 2
+NSKIPSIZE = 1
+LPCQSIZE = 2
+LPCQUANT = 5
+TYPESIZE = 4
+CHANSIZE = 0
+ENERGYSIZE = 3
+BITSHIFTSIZE = 2
+FNSIZE = 2
+VERBATIM_CKSIZE_SIZE = 5
+VERBATIM_BYTE_SIZE = 8
+NWRAP = 3
+DEFAULT_BLOCKSIZE = 256
+DEFAULT_V2NMEAN = 4
+
+
+def read_header(f):
+    """Parse the SPHERE header of an open binary file. Returns the header fields and the header size."""
+    magic = f.readline().strip()
+    if magic != SPHERE_MAGIC:
+        raise ValueError('Not a NIST SPHERE file: {}'.format(getattr(f, 'name', f)))
+    header_size = int(f.readline().strip())
+    header = {}
+    for line in f.read(header_size - f.tell()).split(b'\n'):
+        line = line.strip()
+        if line == b'end_head':
+            break
+        if not line or line.startswith(b';'):
+            continue
+        key, typ, value = (line.split(b' ', 2) + [b''])[:3]
+        key = key.decode('ascii')
+        if typ == b'-i':
+            header[key] = int(value)
+        elif typ == b'-r':
+            header[key] = float(value)
+        else:   # -sN is a string of length N
+            header[key] = value[:int(typ[2:])].decode('ascii', 'replace')
+    return header, header_size
+
+
+def read_sphere_samples(path):
+    """
+    Read the samples of a SPHERE file as an integer array of shape (samples,) or (samples,
+    channels) and the header. Uncompressed PCM is a read-only view of a memory map.
+    """
+    with open(path, 'rb') as f:
+        header, header_size = read_header(f)
+        coding = header.get('sample_coding', 'pcm')
+        nchannels = header.get('channel_count', 1)
+        nbytes = header.get('sample_n_bytes', 2)
+        if 'shorten' in coding:
+            samples = decode_shorten(f.read())
+        elif coding.startswith('ulaw') or coding.startswith('mu-law'):
+            samples = ulaw_to_linear(np.frombuffer(f.read(), dtype=np.uint8))
+        elif coding.startswith('pcm'):
+            samples = None
+        else:
+            raise ValueError('Unsupported SPHERE sample_coding {} in {}'.format(coding, path))
+
+    if samples is None:
+        byte_order = '>' if header.get('sample_byte_format', '01') == '10' else '<'
+        dtype = np.dtype('{}i{}'.format(byte_order, nbytes)) if nbytes > 1 else np.dtype(np.int8)
+        count = header.get('sample_count', (os.path.getsize(path) - header_size) // nbytes // nchannels) * nchannels
+        samples = np.memmap(path, dtype=dtype, mode='r', offset=header_size, shape=(count,))
+    else:
+        count = header.get('sample_count', len(samples) // nchannels) * nchannels
+        samples = samples[:count]
+    if nchannels > 1:
+        samples = samples.reshape(-1, nchannels)
+    return samples, header
+
+
+def read_sphere(path):
+    """Read a SPHERE file as float32 samples in [-1, 1) and its sample rate, like mix_engine.read_wav."""
+    samples, header = read_sphere_samples(path)
+    return samples.astype(np.float32) / 2 ** (8 * samples.dtype.itemsize - 1), header['sample_rate']
+
+
+def ulaw_to_linear(codes):
+    codes = ~codes.astype(np.int16) & 0xff
+    sign = codes & 0x80
+    exponent = (codes >> 4) & 0x07
+    mantissa = codes & 0x0f
+    magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    return np.where(sign, -magnitude, magnitude).astype(np.int16)
+
+
+class _BitReader:
+    """MSB first reader of the Rice codes used by shorten."""
+
+    def __init__(self, data):
+        self.bits = bin(int.from_bytes(b'\x01' + data, 'big'))[3:]
+        self.pos = 0
+
+    def read(self, n):
+        value = int(self.bits[self.pos:self.pos + n], 2) if n else 0
+        self.pos += n
+        return value
+
+    def uvar(self, n):
+        stop = self.bits.find('1', self.pos)
+        if stop < 0:
+            raise EOFError('Shorten stream ended unexpectedly')
+        high = stop - self.pos
+        self.pos = stop + 1
+        return (high << n) | self.read(n)
+
+    def var(self, n):
+        value = self.uvar(n + 1)
+        return (value >> 1) ^ -(value & 1)
+
+    def residuals(self, n, count):
+        """count signed Rice codes with n low bits, the inner loop of the decoder."""
+        bits, pos, find = self.bits, self.pos, self.bits.find
+        k = n + 1
+        out = [0] * count
+        for i in range(count):
+            stop = find('1', pos)
+            if stop < 0:
+                raise EOFError('Shorten stream ended unexpectedly')
+            value = ((stop - pos) << k) | int(bits[stop + 1:stop + 1 + k], 2)
+            pos = stop + 1 + k
+            out[i] = (value >> 1) ^ -(value & 1)
+        self.pos = pos
+        return out
+
+
+def _trunc_div(a, b):
+    """C integer division, which truncates toward zero."""
+    q = abs(a) // abs(b)
+    return q if (a >= 0) == (b >= 0) else -q
+
+
+def decode_shorten(data):
+    """Decode a shorten stream to an integer array with interleaved channels."""
+    if data[:4] != SHORTEN_MAGIC:
+        raise ValueError('Not a shorten stream')
+    version = data[4]
+    reader = _BitReader(data[5:])
+
+    def uint(n):
+        if version > 0:
+            n = reader.uvar(ULONGSIZE)
+        return reader.uvar(n)
+
+    ftype = uint(TYPESIZE)
+    nchannels = uint(CHANSIZE)
+    blocksize = DEFAULT_BLOCKSIZE
+    maxnlpc = 0
+    nmean = DEFAULT_V2NMEAN if version >= 2 else 0
+    if version > 0:
+        blocksize = uint(int(np.log2(DEFAULT_BLOCKSIZE)))
+        maxnlpc = uint(LPCQSIZE)
+        nmean = uint(0)
+        for _ in range(uint(NSKIPSIZE)):
+            reader.read(8)
+    nwrap = max(NWRAP, maxnlpc)
+
+    if ftype in (TYPE_S8, TYPE_S16HL, TYPE_S16LH):
+        mean = 0
+    elif ftype == TYPE_U8:
+        mean = 0x80
+    elif ftype in (TYPE_U16HL, TYPE_U16LH):
+        mean = 0x8000
+    else:
+        raise ValueError('Unsupported shorten file type {}'.format(ftype))
+
+    history = [np.zeros(nwrap, dtype=np.int64) for _ in range(nchannels)]
+    offsets = [[mean] * max(1, nmean) for _ in range(nchannels)]
+    blocks = [[] for _ in range(nchannels)]
+    bitshift = 0
+    channel = 0
+    while True:
+        command = reader.uvar(FNSIZE)
+        if command == FN_QUIT:
+            break
+        elif command == FN_BLOCKSIZE:
+            blocksize = uint(int(np.log2(blocksize)))
+        elif command == FN_BITSHIFT:
+            bitshift = reader.uvar(BITSHIFTSIZE)
+        elif command == FN_VERBATIM:
+            for _ in range(reader.uvar(VERBATIM_CKSIZE_SIZE)):
+                reader.uvar(VERBATIM_BYTE_SIZE)
+        elif command in (FN_DIFF0, FN_DIFF1, FN_DIFF2, FN_DIFF3, FN_QLPC, FN_ZERO):
+            if command != FN_ZERO:
+                energy = reader.uvar(ENERGYSIZE)
+                if version == 0:
+                    energy -= 1
+
+            # Offset from the means of the previous blocks
+            if nmean == 0:
+                coffset = offsets[channel][0]
+            else:
+                coffset = _trunc_div(sum(offsets[channel]) + (nmean // 2 if version >= 2 else 0), nmean)
+                if version >= 2:
+                    coffset >>= bitshift
+
+            hist = history[channel]
+            if command == FN_ZERO:
+                block = np.zeros(blocksize, dtype=np.int64)
+            elif command == FN_QLPC:
+                order = reader.uvar(LPCQSIZE)
+                coefs = [reader.var(LPCQUANT) for _ in range(order)]
+                residual = reader.residuals(energy, blocksize)
+                lpcqoffset = (1 << LPCQUANT) >> 1 if version >= 2 else 0
+                signal = [int(h) - coffset for h in hist[nwrap - order:]]
+                for e in residual:
+                    prediction = lpcqoffset
+                    for j in range(order):
+                        prediction += coefs[j] * signal[-j - 1]
+                    signal.append(e + (prediction >> LPCQUANT))
+                block = np.array(signal[order:], dtype=np.int64) + coffset
+            else:
+                residual = np.array(reader.residuals(energy, blocksize), dtype=np.int64)
+                h1, h2, h3 = int(hist[-1]), int(hist[-2]), int(hist[-3])
+                if command == FN_DIFF0:
+                    block = residual + coffset
+                elif command == FN_DIFF1:
+                    block = h1 + np.cumsum(residual)
+                elif command == FN_DIFF2:
+                    block = h1 + np.cumsum((h1 - h2) + np.cumsum(residual))
+                else:
+                    first = h1 - h2
+                    block = h1 + np.cumsum(first + np.cumsum((first - (h2 - h3)) + np.cumsum(residual)))
+
+            if nmean > 0:
+                block_mean = _trunc_div(int(block.sum()) + (blocksize // 2 if version >= 2 else 0), blocksize)
+                offsets[channel] = offsets[channel][1:] + [block_mean << bitshift if version >= 2 else block_mean]
+
+            history[channel] = np.concatenate([hist, block])[-nwrap:]
+            blocks[channel].append(block << bitshift)
+            channel = (channel + 1) % nchannels
+        else:
+            raise ValueError('Unknown shorten command {}'.format(command))
+
+    samples = np.stack([np.concatenate(b) if b else np.zeros(0, dtype=np.int64) for b in blocks], axis=1) - mean
+    dtype = np.int8 if ftype in (TYPE_S8, TYPE_U8) else np.int16
+    return samples.reshape(-1).astype(dtype)
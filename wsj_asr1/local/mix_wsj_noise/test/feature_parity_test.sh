@@ -0,0 +1,42 @@
+NJOB=4
+# Reference utterance, the first of data/wav.scp. Kaldi binaries (compute-fbank-feats,
+# compute-kaldi-pitch-feats, process-kaldi-pitch-feats, paste-feats) must be on the path,
+# i.e. source path.sh of the espnet wsj recipe first.
+UTT=$(head -n 1 data/wav.scp | cut -d ' ' -f 1)
+CONF=../../../conf
+OUT=feature_parity
+
+set -e
+mkdir -p $OUT/data
+head -n 1 data/wav.scp > $OUT/data/wav.scp
+
+python3 ../features.py --help
+
+# Kaldi reference, as steps/make_fbank_pitch.sh without dithering
+compute-fbank-feats --verbose=2 --config=$CONF/fbank.conf --dither=0 scp:$OUT/data/wav.scp ark:$OUT/fbank.ark
+compute-kaldi-pitch-feats --verbose=2 --config=$CONF/pitch.conf scp:$OUT/data/wav.scp ark:- | \
+    process-kaldi-pitch-feats --delta-pitch-noise-stddev=0 ark:- ark:$OUT/pitch.ark
+paste-feats --length-tolerance=2 ark:$OUT/fbank.ark ark:$OUT/pitch.ark ark:$OUT/kaldi.ark
+
+echo "--dither=0" > $OUT/fbank.conf
+cat $CONF/fbank.conf >> $OUT/fbank.conf
+python3 ../features.py $OUT/data $OUT --fbank-config $OUT/fbank.conf --pitch-config $CONF/pitch.conf --nj $NJOB
+
+# fbank must match up to float rounding. Pitch is an approximation, so the POV and
+# normalized log pitch are only required to be strongly correlated.
+python3 - $OUT/kaldi.ark $OUT/raw_fbank_pitch_data.ark $UTT <<EOF
+import sys
+sys.path.insert(0, '..')
+import numpy as np
+from features import read_ark_matrices
+
+kaldi = read_ark_matrices(sys.argv[1])[sys.argv[3]]
+ours = read_ark_matrices(sys.argv[2])[sys.argv[3]]
+nframes = min(len(kaldi), len(ours))
+assert abs(len(kaldi) - len(ours)) <= 2, (kaldi.shape, ours.shape)
+fbank_error = np.abs(kaldi[:nframes, :-3] - ours[:nframes, :-3]).max()
+pitch_corr = [np.corrcoef(kaldi[:nframes, i], ours[:nframes, i])[0, 1] for i in (-3, -2)]
+print('fbank max abs error: {:.5f}, pov and log pitch correlation: {:.3f} {:.3f}'.format(fbank_error, *pitch_corr))
+assert fbank_error < 1e-3
+assert min(pitch_corr) > 0.8
+EOF
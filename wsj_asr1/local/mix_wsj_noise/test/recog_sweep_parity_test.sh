@@ -0,0 +1,49 @@
+NUTT=${NUTT:-100}      # Utterances of the test set decoded by both, 0 for all of them
+RTASK=${RTASK:-test_dev93}
+# Decodes the first NUTT utterances of RTASK with asr_recog.py (stage 5 of run.sh) and with
+# recog_sweep.py, and checks that the hypotheses of every utterance and the WER match. Needs the
+# dumped features and data.json of stage 2 and the pretrained model in the espnet wsj recipe.
+PROJECT_ROOT=$(realpath $(dirname $0)/../../../..)
+RECIPE=$PROJECT_ROOT/espnet/egs/wsj/asr1
+OUT=$(realpath .)/recog_sweep_parity
+MODEL=exp/train_si284_pytorch_train_no_preprocess/results/model.acc.best
+LM=exp/train_rnnlm_pytorch_lm_word65000/rnnlm.model.best
+DICT=data/lang_1char/train_si284_units.txt
+NLSYMS=data/lang_1char/non_lang_syms.txt
+
+set -e
+rm -rf $OUT
+mkdir -p $OUT/asr_recog $OUT/recog_sweep
+cd $RECIPE
+. ./path.sh
+
+python3 - dump/$RTASK/deltafalse/data.json $OUT/data.json $NUTT <<EOF
+import sys, json
+utts = json.load(open(sys.argv[1], 'rb'))['utts']
+names = sorted(utts)[:int(sys.argv[3])] if int(sys.argv[3]) > 0 else sorted(utts)
+json.dump({'utts': {name: utts[name] for name in names}}, open(sys.argv[2], 'w'), indent=4)
+EOF
+
+# Reference, as one job of stage 5
+time asr_recog.py --config conf/decode.yaml --ngpu 0 --backend pytorch --recog-json $OUT/data.json \
+    --result-label $OUT/asr_recog/data.1.json --model $MODEL --word-rnnlm $LM
+time python3 $PROJECT_ROOT/wsj_asr1/local/mix_wsj_noise/recog_sweep.py --config conf/decode.yaml \
+    --model $MODEL --word-rnnlm $LM $OUT/data.json $OUT/recog_sweep
+cat $OUT/recog_sweep/decode_stats.json
+
+for decode_dir in $OUT/asr_recog $OUT/recog_sweep; do
+    score_sclite.sh --wer true --nlsyms $NLSYMS $decode_dir $DICT
+done
+
+python3 - $OUT/asr_recog $OUT/recog_sweep <<EOF
+import sys, json
+reference, ours = [json.load(open(d + '/data.json', 'rb'))['utts'] for d in sys.argv[1:]]
+assert sorted(reference) == sorted(ours), 'The decoded utterances differ'
+different = [name for name in reference
+             if reference[name]['output'][0]['rec_tokenid'] != ours[name]['output'][0]['rec_tokenid']]
+print('{} of {} hypotheses differ: {}'.format(len(different), len(reference), ' '.join(different)))
+assert not different
+wer = [[line for line in open(d + '/result.wrd.txt') if 'Sum/Avg' in line][0] for d in sys.argv[1:]]
+print('asr_recog.py:   ' + wer[0] + 'recog_sweep.py: ' + wer[1], end='')
+assert wer[0] == wer[1]
+EOF
@@ -39,6 +39,12 @@ lmtag=              # tag for managing LMs
 # decoding parameter
 n_average=10 # use 1 for RNN models
 recog_model=model.acc.best # set a model to be used for decoding: 'model.acc.best' or 'model.loss.best'
+recog_sweep=false   # decode with recog_sweep.py: one load of the model and LM for all test sets, over a process pool
+                    # (check local/mix_wsj_noise/test/recog_sweep_parity_test.sh against asr_recog.py first)
+recog_nj=           # recog_sweep only: decoding processes, one per core by default
+recog_threads=      # recog_sweep only: torch threads of each decoding process, the cores are split by default
+recog_socket=       # recog_sweep only: decode with the recog_sweep.py daemon of this socket, keeping the model loaded
+recog_serve=false   # recog_sweep only: run the daemon of recog_socket in stage 5, until a --shutdown request
 
 # data
 wsj0=/export/corpora5/LDC/LDC93S6B
@@ -51,8 +57,18 @@ tag="" # tag for managing experiments.
 noise_file=$MAIN_ROOT/../wsj_asr1/local/mix_wsj_noise/test/Kalimba.mp3
 mix_snr=3
 noise_timestamp=15.0
+noise_roi=          # noise.roi file: mix from random active parts of these regions instead of noise_timestamp
+active_noise=false  # mix from random active parts of the noise tracks instead of noise_timestamp
 mix_level=0
 noise_ext=wav
+mix_backend=sox     # sox: mix on every read of wav.scp, numpy: mix once to data/$rtask/augmented_wav (opt-in)
+mix_materialize=false   # numpy only: pack the mixes into one archive, data/$rtask/augmented_wav.ark, and point
+                        # wav.scp at offsets in it (ark:offset entries) instead of one wave file per mix
+mix_features=false  # numpy only: compute the stage 1 fbank + pitch features of the mixes in stage 0.5. Opt-in: the
+                    # pitch of features.py only approximates Kaldi pitch, so run local/mix_wsj_noise/test/feature_parity_test.sh
+                    # against Kaldi first. By default stage 1 runs steps/make_fbank_pitch.sh, which the model was trained on
+mix_serve=false     # numpy only: serve the mixes from a daemon until stage 1 read them, instead of the above.
+                    # Stages 0.5 and 1 must run in the same call, the daemons are stopped when run.sh exits
 
 . utils/parse_options.sh || exit 1;
 
@@ -67,6 +83,19 @@ train_dev=test_dev93
 train_test=test_eval92
 recog_set="test_dev93 test_eval92"
 
+# Unix socket of the mixing daemon of a data set, one per recipe directory
+mix_socket() {
+    echo ${TMPDIR:-/tmp}/mix_wsj_noise.$(pwd | md5sum | cut -c1-8).$1.sock
+}
+mix_pids=
+
+if ${mix_serve} && [ ${mix_backend} == numpy ] && [ $(echo $stage'<='0.5 | bc -l) == 1 ] && \
+        [ $(echo $stop_stage'<'1 | bc -l) == 1 ]; then
+    # Nothing would read the mixes before the daemons are stopped
+    echo "$0: --mix_serve true needs stage 1 in the same run (--stop_stage 1 or later)"
+    exit 1
+fi
+
 if [ $(echo $stage'<='0 | bc -l) == 1 ] && [ $(echo $stop_stage'>='0 | bc -l) == 1 ]; then
     ### Task dependent. You have to make data the following preparation part by yourself.
     ### But you can utilize Kaldi recipes in most cases
@@ -82,13 +111,53 @@ if [ $(echo $stage'<='0.5 | bc -l) == 1 ] && [ $(echo $stop_stage'>='0.5 | bc -l
     # Get utt2dur so we know how long to slice the noise source
     # TODO if stage 0 was not run before hand (it generates utt2dur)
     
+    materialize_opt=
+    if ${mix_materialize} && [ ${mix_backend} == numpy ]; then
+        materialize_opt=--materialize
+    fi
+    start_opt="--noise-timestamp ${noise_timestamp}"
+    if [ -n "${noise_roi}" ] || ${active_noise}; then
+        start_opt=
+        if [ -n "${noise_roi}" ]; then
+            start_opt="--noiseROI ${noise_roi}"
+        fi
+        if ${active_noise}; then
+            start_opt="${start_opt} --active-noise"
+        fi
+    fi
+    features_opt=
+    if ${mix_features} && [ ${mix_backend} == numpy ]; then
+        features_opt="--features fbank --fbank-config conf/fbank.conf --pitch-config conf/pitch.conf"
+    fi
+    if ${mix_serve} && [ ${mix_backend} == numpy ]; then
+        materialize_opt=
+        features_opt=
+    fi
     for rtask in ${recog_set}; do
+        serve_opt=
+        if ${mix_serve} && [ ${mix_backend} == numpy ]; then
+            serve_opt="--serve $(mix_socket ${rtask})"
+        fi
         python3 local/mix_wsj_noise.py data/$rtask $noise_file \
             --noise-ext $noise_ext \
             --sph2pipe $KALDI_ROOT/tools/sph2pipe_v2.5/sph2pipe \
             --mix-snr $mix_snr \
             --mix-level $mix_level \
-            --noise-timestamp $noise_timestamp
+            ${start_opt} \
+            --backend $mix_backend ${materialize_opt} ${features_opt} ${serve_opt} &
+        mix_pid=$!
+        if [ -n "${serve_opt}" ]; then
+            # The daemon keeps running, its wav.scp is written once it listens. It is stopped after stage 1,
+            # or when run.sh exits (SIGTERM also removes its socket)
+            mix_pids="${mix_pids} ${mix_pid}"
+            trap "kill ${mix_pids} 2>/dev/null || true" EXIT
+            while [ ! -S $(mix_socket ${rtask}) ]; do
+                kill -0 ${mix_pid} 2>/dev/null || exit 1
+                sleep 1
+            done
+        else
+            wait ${mix_pid}
+        fi
         pushd data/$rtask
         mkdir -vp .backup
         mv -v wav.scp .backup/wav.scp.stg05-$(date +%y-%m-%d_%T)
@@ -108,10 +177,20 @@ if [ $(echo $stage'<='1 | bc -l) == 1 ] && [ $(echo $stop_stage'>='1 | bc -l) ==
     # Generate the fbank features; by default 80-dimensional fbanks with pitch on each frame
     # XXX: When decoding dont need to do train_si284 right?? Only thing unsure is CMVN
     for x in train_si284 test_dev93 test_eval92; do
+        if ${mix_features} && ! ${mix_serve} && [ ${mix_backend} == numpy ] && [[ " ${recog_set} " == *" ${x} "* ]]; then
+            echo "Features of data/${x} were computed with the mixes in stage 0.5"
+            utils/fix_data_dir.sh data/${x}
+            continue
+        fi
         steps/make_fbank_pitch.sh --cmd "$train_cmd" --nj 10 --write_utt2num_frames true \
             data/${x} exp/make_fbank/${x} ${fbankdir}
         utils/fix_data_dir.sh data/${x}
     done
+    if ${mix_serve} && [ ${mix_backend} == numpy ]; then
+        for rtask in ${recog_set}; do
+            python3 $(dirname $(readlink -f local/mix_wsj_noise.py))/mix_client.py $(mix_socket ${rtask}) --shutdown
+        done
+    fi
 
     # compute global CMVN
     compute-cmvn-stats scp:data/${train_set}/feats.scp data/${train_set}/cmvn.ark
@@ -285,32 +364,58 @@ if [ $(echo $stage'<='5 | bc -l) == 1 ] && [ $(echo $stop_stage'>='5 | bc -l) ==
 #                              --num ${n_average}
 #   fi
 
+    if [ ${use_wordlm} = true ]; then
+        recog_opts="--word-rnnlm ${lmexpdir}/rnnlm.model.best"
+    else
+        recog_opts="--rnnlm ${lmexpdir}/rnnlm.model.best"
+    fi
+
+    if ${recog_sweep}; then
+        # The model and LM are loaded once for every test set and shared by the decoding processes,
+        # which get batches of utterances of similar length, longest first
+        recog_sweep_py=$(dirname $(readlink -f local/mix_wsj_noise.py))/recog_sweep.py
+        sweep_opts="--config ${decode_config} --model ${expdir}/results/${recog_model} ${recog_opts}"
+        sweep_opts="${sweep_opts} ${recog_nj:+--nj ${recog_nj}} ${recog_threads:+--threads ${recog_threads}}"
+        if ${recog_serve}; then
+            # Keeps the model loaded for the stage 5 of the next trials, run with --recog_socket
+            [ -z "${recog_socket}" ] && echo "$0: --recog_serve needs --recog_socket" && exit 1
+            exec python3 ${recog_sweep_py} ${sweep_opts} --serve ${recog_socket}
+        fi
+        sweep_sets=
+        for rtask in ${recog_set}; do
+            decode_dir=decode_${rtask}_$(basename ${decode_config%.*})_${lmtag}
+            sweep_sets="${sweep_sets} ${dumpdir}/${rtask}/delta${do_delta}/data.json ${expdir}/${decode_dir}"
+        done
+        if [ -n "${recog_socket}" ]; then
+            python3 ${recog_sweep_py} --connect ${recog_socket} ${sweep_sets}
+        else
+            python3 ${recog_sweep_py} ${sweep_opts} ${sweep_sets}
+        fi
+    fi
+
     pids=() # initialize pids
     for rtask in ${recog_set}; do
     (
         decode_dir=decode_${rtask}_$(basename ${decode_config%.*})_${lmtag}
-        if [ ${use_wordlm} = true ]; then
-            recog_opts="--word-rnnlm ${lmexpdir}/rnnlm.model.best"
-        else
-            recog_opts="--rnnlm ${lmexpdir}/rnnlm.model.best"
-        fi
         feat_recog_dir=${dumpdir}/${rtask}/delta${do_delta}
 
-        # split data
-        splitjson.py --parts ${nj} ${feat_recog_dir}/data.json
-
-        #### use CPU for decoding
-        ngpu=0
-
-        ${decode_cmd} JOB=1:${nj} ${expdir}/${decode_dir}/log/decode.JOB.log \
-            asr_recog.py \
-            --config ${decode_config} \
-            --ngpu ${ngpu} \
-            --backend ${backend} \
-            --recog-json ${feat_recog_dir}/split${nj}utt/data.JOB.json \
-            --result-label ${expdir}/${decode_dir}/data.JOB.json \
-            --model ${expdir}/results/${recog_model}  \
-            ${recog_opts}
+        if ! ${recog_sweep}; then
+            # split data
+            splitjson.py --parts ${nj} ${feat_recog_dir}/data.json
+
+            #### use CPU for decoding
+            ngpu=0
+
+            ${decode_cmd} JOB=1:${nj} ${expdir}/${decode_dir}/log/decode.JOB.log \
+                asr_recog.py \
+                --config ${decode_config} \
+                --ngpu ${ngpu} \
+                --backend ${backend} \
+                --recog-json ${feat_recog_dir}/split${nj}utt/data.JOB.json \
+                --result-label ${expdir}/${decode_dir}/data.JOB.json \
+                --model ${expdir}/results/${recog_model}  \
+                ${recog_opts}
+        fi
 
         score_sclite.sh --wer true --nlsyms ${nlsyms} ${expdir}/${decode_dir} ${dict}
 